@@ -14,9 +14,26 @@
 // ========== SYSTEM SETTINGS ==========
 #define DEBUG_MEMORY_INTERVAL 60000  // Memory status output interval (1 minute)
 #define WATCHDOG_TIMEOUT 15000       // Watchdog timeout (15 seconds)
-#define JSON_BUFFER_SIZE 512         // JSON parsing buffer size
+#define JSON_BUFFER_SIZE 1536        // JSON parsing buffer size (code set + plan)
 #define MIN_HEAP_SIZE 4000           // Minimum heap memory warning threshold
 
+// ========== BINARY FRAME ==========
+// Mirrors lambda/result_save_send/frame_codec.py
+#define FRAME_MAGIC 0xA5             // First byte of a binary frame
+#define FRAME_VERSION 1              // Supported frame version
+#define REC_CODE 0x01                // [index][ir code u32]
+#define REC_CODE_VERSION 0x02        // [version u32]
+#define REC_STEPS 0x03               // [r][g][b]
+#define REC_IR_GAP 0x04              // [gap ms u16]
+#define REC_RGB 0x05                 // [r][g][b]
+#define REC_MODE 0x06                // [index]
+#define REC_DYNAMIC_IR 0x07          // [ir code u32]
+#define REC_SEQ 0x08                 // [seq u32]
+#define REC_TRACE 0x09               // [trace id, ASCII]
+#define REC_POWER 0x10               // [on]
+#define REC_PRESET 0x11              // [ir code u32][r][g][b]
+#define REC_ADJUST 0x12              // [r][g][b]
+
 // ========== DATA STRUCTURE ==========
 struct MyData {
   uint8_t powerOn;          // Power state (0=off, 1=on)
@@ -53,6 +70,19 @@ uint32_t ir_music2   = 0xFF32CD;     // Music mode 2
 uint32_t ir_music3   = 0xFFF807;     // Music mode 3
 uint32_t ir_music4   = 0xFFD827;     // Music mode 4
 
+// IR code names as sent by the server, and the code each one updates
+const char* irCommands[] = {
+  "enterDiy", "power", "rup", "rdown", "gup", "gdown", "bup", "bdown",
+  "auto", "slow", "quick", "flash", "fade7", "fade3", "jump7", "jump3", 
+  "music1", "music2", "music3", "music4"
+};
+uint32_t* irCodes[] = {
+  &ir_enterDiy, &ir_power, &ir_rup, &ir_rdown, &ir_gup, &ir_gdown, &ir_bup, &ir_bdown,
+  &ir_auto, &ir_slow, &ir_quick, &ir_flash, &ir_fade7, &ir_fade3, &ir_jump7, &ir_jump3, 
+  &ir_music1, &ir_music2, &ir_music3, &ir_music4
+};
+const int IR_COMMAND_COUNT = sizeof(irCommands)/sizeof(irCommands[0]);
+
 // ========== NETWORK SETTINGS ==========
 const char* ssid = "Denison-Play";   // WiFi SSID
 const char* password = "";           // WiFi password (public network)
@@ -66,7 +96,7 @@ const char* mac = "C4:D8:D5:03:75:8E"; // MAC address
 const int wifi_timeout = 30000;                  // WiFi connection attempt time (30 seconds)
 const unsigned long WIFI_CHECK_INTERVAL = 60000; // WiFi status check interval (1 minute)
 const unsigned long WS_RECONNECT_INTERVAL = 10000; // WebSocket reconnection interval (10 seconds)
-const unsigned long STATE_REPORT_INTERVAL = 30000; // Status reporting interval (30 seconds)
+const unsigned long STATE_REPORT_INTERVAL = 30000; // Status report / heartbeat interval (30 seconds)
 
 // ========== SYSTEM STATUS VARIABLES ==========
 unsigned long lastMemoryReport = 0;     // Last memory report time
@@ -87,6 +117,13 @@ bool powerOn = false;                  // Power status
 bool eepromNeedsSave = false;          // EEPROM save required flag
 int rgb[3] = {0, 0, 0};                // Current RGB values
 bool processingMessage = false;        // Message processing status
+bool dynamicActive = false;            // Dynamic mode running (DIY must be re-entered)
+int channelSteps[3] = {255, 255, 255}; // Pulses for a full 0-255 sweep per channel
+int irSignalGap = 70;                  // Gap between up/down pulses (ms)
+uint32_t irCodeVersion = 0;            // Version of the IR code set in memory (0 = built-in)
+uint32_t lastCommandSeq = 0;           // Low 32 bits of the last applied command's seq
+bool hasCommandSeq = false;            // Whether a sequenced command was applied
+char pendingTrace[33] = "";            // Trace id of the last message, echoed once in the next report
 // Remove dynamicModeActive variable as it's not needed
 
 // ========== DIAGNOSTIC INFORMATION ==========
@@ -99,13 +136,22 @@ void setupWiFi();                      // WiFi setup and connection
 void setupWebSocket();                 // WebSocket setup
 void handleWebSocketEvent(WStype_t type, uint8_t * payload, size_t length); // WebSocket event handler
 void sendDeviceState();                // Send device state
+void setPendingTrace(const char* value, size_t length); // Remember a message's trace id
 void processJsonMessage(const JsonDocument& doc); // Process JSON message
 String getWiFiStatusString(int status); // Get WiFi status string
 void loadFromEEPROM();                 // Load data from EEPROM
 void saveToEEPROM();                   // Save data to EEPROM
 void markActivity();                   // Record activity
 void handleSerialJson();               // Handle serial JSON commands
-void adjustRGB(int targetR, int targetG, int targetB); // Adjust RGB values
+void adjustRGB(int targetR, int targetG, int targetB, bool enterDiy = true); // Adjust RGB values
+void executePlan(JsonArrayConst plan); // Execute server transition plan
+void updateIrCodes(JsonObjectConst codes); // Update IR codes from a JSON object
+void startDynamicMode(uint32_t code);  // Send a dynamic mode IR code
+void applyPlanPower(bool newPowerState); // Plan step: switch power
+bool applyPlanPreset(uint32_t code, int r, int g, int b); // Plan step: send preset
+bool processBinaryFrame(const uint8_t* payload, size_t length); // Apply binary frame
+bool acceptCommandSeq(uint32_t seq);   // Latest wins: drop stale commands
+uint32_t parseIrCode(const char* value); // Parse hex IR code string
 bool sendIRCode(uint32_t code, bool withDelay = false); // Send IR code
 void sendUpDownSequence(uint32_t updownCode, int count); // Send sequential IR codes
 void reportCurrentState();             // Report current state
@@ -225,6 +271,11 @@ void setupWebSocket() {
     wsFullPath = "/" + wsFullPath;
   }
   wsFullPath += "?uuid=" + String(uuid);
+  wsFullPath += "&mac=" + String(mac);
+  // Report the code set version so the server only resends codes when stale
+  wsFullPath += "&codeVersion=" + String(irCodeVersion);
+  // Ask for the compact binary frame instead of JSON
+  wsFullPath += "&frame=binary";
   
   webSocket.beginSSL(wsHost, wsPort, wsFullPath.c_str());
   webSocket.onEvent(handleWebSocketEvent);
@@ -258,7 +309,28 @@ void handleWebSocketEvent(WStype_t type, uint8_t * payload, size_t length) {
       
       // Length check for safety
       if (length > 0 && length < 1500) {
-        parseAndProcessJson(payload, length);
+        // Binary frames can arrive as text frames, the magic byte tells them apart
+        if (payload[0] == FRAME_MAGIC) {
+          processBinaryFrame(payload, length);
+        } else {
+          parseAndProcessJson(payload, length);
+        }
+        // Report the new state right away to keep the shadow current
+        sendDeviceState();
+      }
+      
+      processingMessage = false;
+      break;
+    
+    case WStype_BIN:
+      // Skip if already processing
+      if (processingMessage) return;
+      
+      processingMessage = true;
+      
+      if (length > 0 && length < 1500) {
+        processBinaryFrame(payload, length);
+        sendDeviceState();
       }
       
       processingMessage = false;
@@ -274,27 +346,50 @@ void handleWebSocketEvent(WStype_t type, uint8_t * payload, size_t length) {
 }
 
 //------------------------------------------------------------------------------
-// Send current device state
+// Send current device state. Doubles as the heartbeat that keeps the device
+// reported as connected, so it must be sent at least every 90 seconds. The
+// server keeps the state as the device shadow and skips commands it already
+// satisfies; seq tells it which command the state reflects.
 //------------------------------------------------------------------------------
 void sendDeviceState() {
   if (!webSocketConnected) return;
   
-  StaticJsonDocument<192> doc;
+  StaticJsonDocument<384> doc;
   
-  doc["action"] = "sendmessage";
+  doc["action"] = "heartbeat";
   doc["state"] = powerOn ? "on" : "off";
   doc["uuid"] = uuid;
+  doc["mac"] = mac;
   
   JsonArray rgbArr = doc.createNestedArray("rgb");
   rgbArr.add(rgb[0]);
   rgbArr.add(rgb[1]);
   rgbArr.add(rgb[2]);
   
-  // Remove dynamicMode field from the state report
+  doc["dynamic"] = dynamicActive;
+  if (hasCommandSeq) {
+    doc["seq"] = lastCommandSeq;
+  }
+  // Ends the trace of the message just applied
+  if (pendingTrace[0]) {
+    doc["trace"] = (const char*)pendingTrace;
+  }
   
   String jsonString;
+  lastStateReport = millis();
   serializeJson(doc, jsonString);
   webSocket.sendTXT(jsonString);
+  pendingTrace[0] = '\0';
+}
+
+//------------------------------------------------------------------------------
+// Remember the trace id of a message for the next state report
+//------------------------------------------------------------------------------
+void setPendingTrace(const char* value, size_t length) {
+  if (length > sizeof(pendingTrace) - 1) length = sizeof(pendingTrace) - 1;
+  memcpy(pendingTrace, value, length);
+  pendingTrace[length] = '\0';
+  Serial.printf("[Trace] %s\n", pendingTrace);
 }
 
 //------------------------------------------------------------------------------
@@ -373,6 +468,41 @@ bool parseAndProcessJson(uint8_t * payload, size_t length) {
 // Process JSON message
 //------------------------------------------------------------------------------
 void processJsonMessage(const JsonDocument& doc) {
+  const char* trace = doc["trace"];
+  if (trace) {
+    setPendingTrace(trace, strlen(trace));
+  }
+
+  // Full code set, sent by the server when the reported version is stale
+  if (doc.containsKey("codes")) {
+    updateIrCodes(doc["codes"].as<JsonObjectConst>());
+    if (doc.containsKey("codeVersion")) {
+      irCodeVersion = doc["codeVersion"].as<uint32_t>();
+      Serial.printf("[IR] Code set version %u\n", irCodeVersion);
+    }
+  }
+
+  // Commands older than the last applied one are stale (the code set above
+  // is still kept). seq is epoch ms, only its low 32 bits are compared.
+  if (doc.containsKey("seq") &&
+      !acceptCommandSeq((uint32_t)(uint64_t)doc["seq"].as<double>())) {
+    return;
+  }
+
+  // Dynamic mode by name, using the codes already in memory
+  if (doc.containsKey("mode")) {
+    const char* mode = doc["mode"];
+    for (int i = 0; mode && i < IR_COMMAND_COUNT; i++) {
+      if (strcasecmp(mode, irCommands[i]) == 0) {
+        Serial.printf("[Dynamic Mode] %s\n", irCommands[i]);
+        startDynamicMode(*irCodes[i]);
+        return;
+      }
+    }
+    Serial.printf("[Dynamic Mode] Unknown mode: %s\n", mode ? mode : "(null)");
+    return;
+  }
+
   // Check for dynamic IR code first
   if (doc.containsKey("dynamicIr")) {
     const char* dynamicValue = doc["dynamicIr"];
@@ -380,31 +510,11 @@ void processJsonMessage(const JsonDocument& doc) {
     // Only process if dynamicIr has a non-empty value
     if (dynamicValue && strlen(dynamicValue) > 0) {
       // Convert hex string to uint32_t properly
-      // Ensure proper format by adding 0x prefix if not present
-      char hexBuffer[16] = {0};
-      if (strncmp(dynamicValue, "0x", 2) != 0 && strncmp(dynamicValue, "0X", 2) != 0) {
-        snprintf(hexBuffer, sizeof(hexBuffer), "0x%s", dynamicValue);
-        ir_dynamic = strtoul(hexBuffer, NULL, 0);
-      } else {
-        ir_dynamic = strtoul(dynamicValue, NULL, 0);
-      }
-      
-      // If device is OFF, turn it ON first
-      if (!powerOn) {
-        Serial.println("[Dynamic Mode] Device is OFF, turning ON first");
-        sendIRCode(ir_power, true);
-        powerOn = true;
-        markActivity();
-        delay(150); // Wait for device to initialize
-      }
+      ir_dynamic = parseIrCode(dynamicValue);
       
       // Debug output with proper hex formatting
       Serial.printf("[Dynamic Mode] Received IR code: %s (0x%08X)\n", dynamicValue, ir_dynamic);
-      
-      // Send the IR code with more robust approach
-      bool success = sendIRCode(ir_dynamic, true);
-      Serial.printf("[Dynamic Mode] Sent IR code: 0x%08X (Success: %s)\n", 
-                    ir_dynamic, success ? "Yes" : "No");
+      startDynamicMode(ir_dynamic);
       
       // Exit early - don't process any other controls when in dynamic mode
       return;
@@ -414,41 +524,25 @@ void processJsonMessage(const JsonDocument& doc) {
   
   // Normal processing for all other cases (when no valid dynamicIr is present)
   
-  // Update IR codes in memory - handle null values properly
-  const char* irCommands[] = {
-    "enterDiy", "power", "rup", "rdown", "gup", "gdown", "bup", "bdown",
-    "auto", "slow", "quick", "flash", "fade7", "fade3", "jump7", "jump3", 
-    "music1", "music2", "music3", "music4"
-  };
-  uint32_t* irCodes[] = {
-    &ir_enterDiy, &ir_power, &ir_rup, &ir_rdown, &ir_gup, &ir_gdown, &ir_bup, &ir_bdown,
-    &ir_auto, &ir_slow, &ir_quick, &ir_flash, &ir_fade7, &ir_fade3, &ir_jump7, &ir_jump3, 
-    &ir_music1, &ir_music2, &ir_music3, &ir_music4
-  };
-  
-  // Process IR code updates from JSON - with improved null handling
-  for (int i = 0; i < sizeof(irCommands)/sizeof(irCommands[0]); i++) {
-    if (doc.containsKey(irCommands[i])) {
-      // Check for null value
-      if (doc[irCommands[i]].isNull()) {
-        Serial.printf("[IR] Skipping null value for %s\n", irCommands[i]);
-        continue;
-      }
-      
-      const char* irValue = doc[irCommands[i]];
-      if (irValue && strlen(irValue) > 0) {
-        // Convert hex string to uint32_t properly
-        char hexBuffer[16] = {0};
-        if (strncmp(irValue, "0x", 2) != 0 && strncmp(irValue, "0X", 2) != 0) {
-          snprintf(hexBuffer, sizeof(hexBuffer), "0x%s", irValue);
-          *irCodes[i] = strtoul(hexBuffer, NULL, 0);
-        } else {
-          *irCodes[i] = strtoul(irValue, NULL, 0);
-        }
-        Serial.printf("[IR] Updated %s code: %s (0x%08X)\n", irCommands[i], irValue, *irCodes[i]);
-      }
+  // Legacy messages carry IR codes at the top level
+  updateIrCodes(doc.as<JsonObjectConst>());
+
+  // Device capability profile: pulses per full sweep and minimum pulse gap
+  if (doc.containsKey("steps") && doc["steps"].size() == 3) {
+    for (int i = 0; i < 3; i++) {
+      channelSteps[i] = constrain(doc["steps"][i].as<int>(), 1, 255);
     }
   }
+  if (doc.containsKey("irGap")) {
+    irSignalGap = constrain(doc["irGap"].as<int>(), 20, 500);
+  }
+
+  // Execute the server-computed transition plan when present.
+  // rgbCode is still sent for firmware without plan support.
+  if (doc.containsKey("plan")) {
+    executePlan(doc["plan"].as<JsonArrayConst>());
+    return;
+  }
 
   // Power control - modified logic
   if (doc.containsKey("powerOn")) {
@@ -520,6 +614,237 @@ void processJsonMessage(const JsonDocument& doc) {
   else if (doc.containsKey("slow")) sendIRCode(ir_slow, true);
 }
 
+//------------------------------------------------------------------------------
+// Update IR codes in memory - handle null values properly
+//------------------------------------------------------------------------------
+void updateIrCodes(JsonObjectConst codes) {
+  for (int i = 0; i < IR_COMMAND_COUNT; i++) {
+    if (codes.containsKey(irCommands[i])) {
+      // Check for null value
+      if (codes[irCommands[i]].isNull()) {
+        Serial.printf("[IR] Skipping null value for %s\n", irCommands[i]);
+        continue;
+      }
+      
+      const char* irValue = codes[irCommands[i]];
+      if (irValue && strlen(irValue) > 0) {
+        // Convert hex string to uint32_t properly
+        *irCodes[i] = parseIrCode(irValue);
+        Serial.printf("[IR] Updated %s code: %s (0x%08X)\n", irCommands[i], irValue, *irCodes[i]);
+      }
+    }
+  }
+}
+
+//------------------------------------------------------------------------------
+// Start dynamic mode
+//------------------------------------------------------------------------------
+void startDynamicMode(uint32_t code) {
+  // If device is OFF, turn it ON first
+  if (!powerOn) {
+    Serial.println("[Dynamic Mode] Device is OFF, turning ON first");
+    sendIRCode(ir_power, true);
+    powerOn = true;
+    markActivity();
+    delay(150); // Wait for device to initialize
+  }
+  
+  // Send the IR code with more robust approach
+  bool success = sendIRCode(code, true);
+  Serial.printf("[Dynamic Mode] Sent IR code: 0x%08X (Success: %s)\n", 
+                code, success ? "Yes" : "No");
+  if (success) dynamicActive = true;
+}
+
+//------------------------------------------------------------------------------
+// Execute transition plan
+//------------------------------------------------------------------------------
+void executePlan(JsonArrayConst plan) {
+  // Set after a preset: up/down pulses apply without re-entering DIY mode
+  bool presetActive = false;
+
+  for (JsonVariantConst entry : plan) {
+    JsonArrayConst step = entry.as<JsonArrayConst>();
+    const char* op = step[0];
+    if (!op) continue;
+
+    ESP.wdtFeed();
+
+    if (strcmp(op, "power") == 0) {
+      applyPlanPower(step[1].as<int>() != 0);
+    }
+    else if (strcmp(op, "preset") == 0) {
+      if (applyPlanPreset(parseIrCode(step[1]), step[2].as<int>(),
+                          step[3].as<int>(), step[4].as<int>())) {
+        presetActive = true;
+      }
+    }
+    else if (strcmp(op, "adjust") == 0) {
+      adjustRGB(constrain(step[1].as<int>(), 0, 255),
+                constrain(step[2].as<int>(), 0, 255),
+                constrain(step[3].as<int>(), 0, 255),
+                !presetActive);
+    }
+  }
+}
+
+//------------------------------------------------------------------------------
+// Plan step: switch power
+//------------------------------------------------------------------------------
+void applyPlanPower(bool newPowerState) {
+  if (newPowerState != powerOn) {
+    sendIRCode(ir_power, true);
+    powerOn = newPowerState;
+    Serial.printf("[Plan] Power %s\n", powerOn ? "On" : "Off");
+    markActivity();
+    if (powerOn) delay(150); // Wait for device to initialize
+  }
+}
+
+//------------------------------------------------------------------------------
+// Plan step: send a preset color code
+//------------------------------------------------------------------------------
+bool applyPlanPreset(uint32_t code, int r, int g, int b) {
+  if (!sendIRCode(code, true)) return false;
+  rgb[0] = constrain(r, 0, 255);
+  rgb[1] = constrain(g, 0, 255);
+  rgb[2] = constrain(b, 0, 255);
+  dynamicActive = false;
+  Serial.printf("[Plan] Preset 0x%08X → [%d,%d,%d]\n", code, rgb[0], rgb[1], rgb[2]);
+  markActivity();
+  return true;
+}
+
+//------------------------------------------------------------------------------
+// Process binary frame: [magic][version] then [type][length][value] records
+//------------------------------------------------------------------------------
+static uint32_t readUint32(const uint8_t* value) {
+  return ((uint32_t)value[0] << 24) | ((uint32_t)value[1] << 16) |
+         ((uint32_t)value[2] << 8) | (uint32_t)value[3];
+}
+
+bool processBinaryFrame(const uint8_t* payload, size_t length) {
+  if (length < 2 || payload[0] != FRAME_MAGIC) return false;
+  if (payload[1] != FRAME_VERSION) {
+    Serial.printf("[Frame] Unsupported version %u\n", payload[1]);
+    return false;
+  }
+
+  // Set after a preset: up/down pulses apply without re-entering DIY mode
+  bool presetActive = false;
+  bool hasPlan = false;
+  size_t pos = 2;
+
+  while (pos + 2 <= length) {
+    uint8_t type = payload[pos];
+    uint8_t len = payload[pos + 1];
+    const uint8_t* value = payload + pos + 2;
+    pos += 2 + len;
+    if (pos > length) {
+      Serial.println("[Frame] Truncated record");
+      return false;
+    }
+
+    ESP.wdtFeed();
+
+    switch (type) {
+      case REC_CODE:
+        if (len >= 5 && value[0] < IR_COMMAND_COUNT) {
+          *irCodes[value[0]] = readUint32(value + 1);
+        }
+        break;
+      case REC_CODE_VERSION:
+        if (len >= 4) {
+          irCodeVersion = readUint32(value);
+          Serial.printf("[IR] Code set version %u\n", irCodeVersion);
+        }
+        break;
+      case REC_SEQ:
+        // Stale command: keep the code set records before it, skip the rest
+        if (len >= 4 && !acceptCommandSeq(readUint32(value))) return true;
+        break;
+      case REC_TRACE:
+        setPendingTrace((const char*)value, len);
+        break;
+      case REC_STEPS:
+        if (len >= 3) {
+          for (int i = 0; i < 3; i++) channelSteps[i] = constrain(value[i], 1, 255);
+        }
+        break;
+      case REC_IR_GAP:
+        if (len >= 2) irSignalGap = constrain((value[0] << 8) | value[1], 20, 500);
+        break;
+      case REC_MODE:
+        if (len >= 1 && value[0] < IR_COMMAND_COUNT) {
+          Serial.printf("[Dynamic Mode] %s\n", irCommands[value[0]]);
+          startDynamicMode(*irCodes[value[0]]);
+        }
+        break;
+      case REC_DYNAMIC_IR:
+        if (len >= 4) {
+          ir_dynamic = readUint32(value);
+          startDynamicMode(ir_dynamic);
+        }
+        break;
+      case REC_POWER:
+        hasPlan = true;
+        if (len >= 1) applyPlanPower(value[0] != 0);
+        break;
+      case REC_PRESET:
+        hasPlan = true;
+        if (len >= 7 && applyPlanPreset(readUint32(value), value[4], value[5], value[6])) {
+          presetActive = true;
+        }
+        break;
+      case REC_ADJUST:
+        hasPlan = true;
+        if (len >= 3) adjustRGB(value[0], value[1], value[2], !presetActive);
+        break;
+      case REC_RGB:
+        // Same as rgbCode without a plan: adjust only when power is on
+        if (!hasPlan && len >= 3 && powerOn &&
+            (value[0] != rgb[0] || value[1] != rgb[1] || value[2] != rgb[2])) {
+          adjustRGB(value[0], value[1], value[2]);
+        }
+        break;
+      default:
+        // Record from a newer server, skip it
+        break;
+    }
+  }
+  return true;
+}
+
+//------------------------------------------------------------------------------
+// Latest wins: accept a command only if its seq is newer than the last one.
+// Compared modulo 2^32 (serial number arithmetic), so the low 32 bits of an
+// epoch-ms seq order correctly across wraparound.
+//------------------------------------------------------------------------------
+bool acceptCommandSeq(uint32_t seq) {
+  if (hasCommandSeq && (int32_t)(seq - lastCommandSeq) <= 0) {
+    Serial.printf("[Seq] Dropping stale command %u (last %u)\n", seq, lastCommandSeq);
+    return false;
+  }
+  lastCommandSeq = seq;
+  hasCommandSeq = true;
+  return true;
+}
+
+//------------------------------------------------------------------------------
+// Parse hex IR code string ("FF02FD" or "0xFF02FD")
+//------------------------------------------------------------------------------
+uint32_t parseIrCode(const char* value) {
+  if (!value || strlen(value) == 0) return 0;
+
+  // Ensure proper format by adding 0x prefix if not present
+  if (strncmp(value, "0x", 2) != 0 && strncmp(value, "0X", 2) != 0) {
+    char hexBuffer[16] = {0};
+    snprintf(hexBuffer, sizeof(hexBuffer), "0x%s", value);
+    return strtoul(hexBuffer, NULL, 0);
+  }
+  return strtoul(value, NULL, 0);
+}
+
 //------------------------------------------------------------------------------
 // Handle serial JSON commands
 //------------------------------------------------------------------------------
@@ -546,9 +871,10 @@ void handleSerialJson() {
 //------------------------------------------------------------------------------
 // Adjust RGB values
 //------------------------------------------------------------------------------
-void adjustRGB(int targetR, int targetG, int targetB) {
-  // Prevent unnecessary IR transmission if values are already the same
-  if (targetR == rgb[0] && targetG == rgb[1] && targetB == rgb[2]) {
+void adjustRGB(int targetR, int targetG, int targetB, bool enterDiy) {
+  // Prevent unnecessary IR transmission if values are already the same,
+  // unless a dynamic mode is running and DIY mode has to be restored
+  if (targetR == rgb[0] && targetG == rgb[1] && targetB == rgb[2] && !dynamicActive) {
     return;
   }
   
@@ -569,10 +895,13 @@ void adjustRGB(int targetR, int targetG, int targetB) {
   }
 
   // Enter DIY mode (attempt twice to account for possible transmission failure)
-  sendIRCode(ir_enterDiy, true);
-  delay(150); // Increased wait time after first DIY command
-  sendIRCode(ir_enterDiy, true);
-  delay(200); // Increased wait time for DIY mode activation
+  if (enterDiy) {
+    sendIRCode(ir_enterDiy, true);
+    delay(150); // Increased wait time after first DIY command
+    sendIRCode(ir_enterDiy, true);
+    delay(200); // Increased wait time for DIY mode activation
+  }
+  dynamicActive = false;
 
   // Adjust channels with larger differences first for efficiency
   struct Channel {  
@@ -603,7 +932,8 @@ void adjustRGB(int targetR, int targetG, int targetB) {
     int diff = (idx == 0) ? rDiff : (idx == 1 ? gDiff : bDiff);
     if (diff != 0) {
       uint32_t code = (diff > 0) ? channels[i].upCode : channels[i].downCode;
-      int count = abs(diff);
+      // One pulse moves the channel by 255 / channelSteps units
+      int count = (abs(diff) * channelSteps[idx] + 127) / 255;
       
       // Add slight delay between each color adjustment
       if (i > 0) delay(100);
@@ -656,8 +986,8 @@ void sendUpDownSequence(uint32_t updownCode, int count) {
     return;
   }
   
-  // IR code interval adjustment (70ms for better reliability)
-  const int IR_SIGNAL_GAP = 70;
+  // IR code interval from the device profile (70ms by default for reliability)
+  const int IR_SIGNAL_GAP = irSignalGap;
   
   Serial.printf("[IR] Sending sequence of %d codes (0x%08X)\n", count, updownCode);
   
@@ -0,0 +1,269 @@
+"""
+Token-bucket admission control in front of the model.
+
+Every model request takes a token from the bucket of its user and from the
+global bucket. Buckets are shared by all containers through RateLimitTable:
+
+    bucketKey   partition key: "user#<uuid>" or "global"
+    fullAt      epoch milliseconds at which the bucket is full again
+    expiresAt   epoch seconds, DynamoDB TTL attribute
+
+Storing the time the bucket is full again instead of a token count (the
+generic cell rate algorithm) turns a take into one conditional update: each
+token pushes fullAt one refill interval further, and a take is allowed
+while fullAt stays within burst intervals of now. No read comes first and
+no clock arithmetic runs inside DynamoDB.
+
+Each container also keeps in-process buckets with the same limits, and
+remembers denials until their retry time. A client flooding one container
+is turned away from memory, without a DynamoDB call.
+
+Buckets are taken from the user's first. If a later bucket denies the
+request, the tokens already taken are given back, so a user turned away by
+the global limit is not charged for it.
+
+The limiter fails open: if DynamoDB is unavailable, requests are admitted
+under the in-process limits only.
+"""
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+GLOBAL_KEY = "global"
+# Tries of a take that races with other containers
+MAX_ATTEMPTS = 3
+# Rows outlive a full refill by this long before the TTL removes them (s)
+EXPIRY_MARGIN = 3600
+# In-process state is dropped when it grows past this many keys
+MAX_LOCAL_KEYS = 10000
+
+
+class LocalBucket:
+    """
+    In-process token bucket.
+
+    Args:
+        rate: Tokens added per second
+        burst: Bucket capacity
+        now: Epoch seconds of creation
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, now):
+        """
+        Take a token.
+
+        Args:
+            now: Epoch seconds
+
+        Returns:
+            0 if a token was taken, else seconds until one is available
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self):
+        """Return a token taken for a request that was not admitted."""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class RateLimiter:
+    """
+    Per-user and global token buckets.
+
+    Args:
+        table: boto3 DynamoDB Table resource of RateLimitTable, or None to
+            limit in-process only
+        user_per_minute: Sustained requests per minute of one user (0 = no limit)
+        user_burst: Requests a user may make at once
+        global_per_minute: Sustained requests per minute of all users (0 = no limit)
+        global_burst: Requests all users may make at once
+    """
+
+    def __init__(self, table, user_per_minute=10, user_burst=5,
+                 global_per_minute=600, global_burst=60):
+        self.table = table
+        self.limits = {"user": (user_per_minute, user_burst),
+                       GLOBAL_KEY: (global_per_minute, global_burst)}
+        self.local_buckets = {}
+        self.blocked_until = {}
+
+    def bucket_limits(self, uuid):
+        """
+        Buckets a request of a user takes from, the user's first.
+
+        Args:
+            uuid: User identifier
+
+        Returns:
+            List of (bucket key, requests per minute, burst)
+        """
+        buckets = []
+        for kind, key in (("user", f"user#{uuid}"), (GLOBAL_KEY, GLOBAL_KEY)):
+            per_minute, burst = self.limits[kind]
+            if per_minute > 0:
+                buckets.append((key, per_minute, max(int(burst), 1)))
+        return buckets
+
+    def admit(self, uuid, now=None):
+        """
+        Take a token for a model request of a user.
+
+        Args:
+            uuid: User identifier
+            now: Epoch seconds (defaults to time.time())
+
+        Returns:
+            0 if the request is admitted, else seconds until it may be retried
+        """
+        now = now if now is not None else time.time()
+        buckets = self.bucket_limits(uuid)
+        if len(self.local_buckets) > MAX_LOCAL_KEYS:
+            self.local_buckets.clear()
+            self.blocked_until.clear()
+
+        # Fast path: denials that still hold and the in-process buckets
+        for key, _, _ in buckets:
+            blocked = self.blocked_until.get(key, 0) - now
+            if blocked > 0:
+                return blocked
+        taken = []
+        for key, per_minute, burst in buckets:
+            bucket = self.local_buckets.get(key)
+            if bucket is None:
+                bucket = self.local_buckets[key] = LocalBucket(per_minute / 60, burst, now)
+            retry_after = bucket.take(now)
+            if retry_after > 0:
+                for taken_bucket in taken:
+                    taken_bucket.give_back()
+                return retry_after
+            taken.append(bucket)
+
+        if self.table is None:
+            return 0.0
+        taken_shared = []
+        for key, per_minute, burst in buckets:
+            try:
+                retry_after = self.take_shared(key, per_minute, burst, now)
+            except Exception as e:
+                logger.warning(f"Rate limit check failed for {key}, admitting: {str(e)}")
+                continue
+            if retry_after > 0:
+                self.blocked_until[key] = now + retry_after
+                for taken_bucket in taken:
+                    taken_bucket.give_back()
+                for taken_key, taken_per_minute in taken_shared:
+                    self.give_back_shared(taken_key, taken_per_minute, now)
+                return retry_after
+            taken_shared.append((key, per_minute))
+        return 0.0
+
+    def take_shared(self, key, per_minute, burst, now):
+        """
+        Take a token from a bucket in RateLimitTable.
+
+        Args:
+            key: Bucket key
+            per_minute: Sustained requests per minute
+            burst: Bucket capacity
+            now: Epoch seconds
+
+        Returns:
+            0 if a token was taken, else seconds until one is available
+        """
+        interval = max(int(60000 / per_minute), 1)
+        now_ms = int(now * 1000)
+        # Latest fullAt that still leaves a token
+        limit = now_ms + (burst - 1) * interval
+        expires_at = int(now) + (burst * interval) // 1000 + EXPIRY_MARGIN
+
+        for _ in range(MAX_ATTEMPTS):
+            try:
+                # Bucket partly used: one more token pushes fullAt further
+                self.table.update_item(
+                    Key={"bucketKey": key},
+                    UpdateExpression="SET fullAt = fullAt + :interval, expiresAt = :expires",
+                    ConditionExpression="fullAt > :now AND fullAt <= :limit",
+                    ExpressionAttributeValues={
+                        ":interval": interval,
+                        ":now": now_ms,
+                        ":limit": limit,
+                        ":expires": expires_at,
+                    },
+                    ReturnValuesOnConditionCheckFailure="ALL_OLD"
+                )
+                return 0.0
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                    raise
+                # The old item comes back in the low-level attribute format
+                item = e.response.get("Item") or {}
+
+            if "fullAt" in item and int(item["fullAt"]["N"]) > limit:
+                # Empty bucket: a token is free once fullAt is back at limit
+                return (int(item["fullAt"]["N"]) - limit) / 1000
+
+            try:
+                # Bucket full (new key or fullAt in the past): start from now
+                self.table.update_item(
+                    Key={"bucketKey": key},
+                    UpdateExpression="SET fullAt = :next, expiresAt = :expires",
+                    ConditionExpression="attribute_not_exists(fullAt) OR fullAt <= :now",
+                    ExpressionAttributeValues={
+                        ":next": now_ms + interval,
+                        ":now": now_ms,
+                        ":expires": expires_at,
+                    }
+                )
+                return 0.0
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                    raise
+                # Another container took a token in between: try again
+
+        # Heavy contention on the key: turn the request away for one interval
+        return interval / 1000
+
+    def give_back_shared(self, key, per_minute, now):
+        """
+        Return a token taken from a bucket in RateLimitTable.
+
+        Args:
+            key: Bucket key
+            per_minute: Sustained requests per minute
+            now: Epoch seconds
+
+        Returns:
+            None
+        """
+        interval = max(int(60000 / per_minute), 1)
+        try:
+            # A bucket that refilled meanwhile has nothing to give back
+            self.table.update_item(
+                Key={"bucketKey": key},
+                UpdateExpression="SET fullAt = fullAt - :interval",
+                ConditionExpression="fullAt > :now",
+                ExpressionAttributeValues={
+                    ":interval": interval,
+                    ":now": int(now * 1000),
+                }
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                logger.warning(f"Failed to give back token of {key}: {str(e)}")
+        except Exception as e:
+            logger.warning(f"Failed to give back token of {key}: {str(e)}")
@@ -1,13 +1,28 @@
 import json
+import math
 import os
 import logging
 import base64
+import io
+import wave
+import time
 import shortuuid
 from datetime import datetime
 from boto3.session import Session
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
 from google import genai
 from gemini_config import get_gemini_config
 from constants import VALID_DYNAMIC_MODES
+from deadline import Deadline, DeadlineExceeded
+from metrics import StageMetrics, NO_METRICS, get_trace_id, epoch_ms
+from profiling import profiled
+from warmup import is_warmup, warm_up, WARMUP_ID
+from admission import RateLimiter
+from circuit_breaker import CircuitBreaker
+from fallback import fallback_recommendation
+from model_router import ModelRouter, parse_tiers
+from model_response import is_truncated, verify_and_parse_json
 
 
 class AuthenticationError(Exception):
@@ -34,8 +49,67 @@ boto_session = Session(region_name=region_name)
 dynamodb = boto_session.resource('dynamodb')
 lambda_client = boto_session.client('lambda')
 
-# Generate unique request ID for tracing
-request_id = shortuuid.uuid()
+# Token buckets per user and for all users in front of the model (requests
+# per minute and burst; 0 disables a limit). The checks get their own
+# DynamoDB client with short timeouts: a slow check must not stall requests.
+# The fallback's history lookup uses it for the same reason.
+rate_limit_dynamodb = boto_session.resource('dynamodb', config=Config(
+    connect_timeout=1, read_timeout=1, retries={'max_attempts': 1}))
+rate_limiter = RateLimiter(
+    rate_limit_dynamodb.Table(os.environ.get('RATE_LIMIT_TABLE', 'RateLimitTable')),
+    user_per_minute=float(os.environ.get('USER_RATE_PER_MINUTE', '10')),
+    user_burst=int(os.environ.get('USER_RATE_BURST', '5')),
+    global_per_minute=float(os.environ.get('GLOBAL_RATE_PER_MINUTE', '600')),
+    global_burst=int(os.environ.get('GLOBAL_RATE_BURST', '60'))
+)
+
+# Optional queue hop to result_save_send; invoke it directly when unset
+RESULT_QUEUE_URL = os.environ.get('RESULT_QUEUE_URL')
+sqs_client = boto_session.client('sqs') if RESULT_QUEUE_URL else None
+
+# Deadline handling: time kept back from the Lambda timeout to build the
+# response and hand the result on (ms), the least time worth starting a
+# model call with and the longest a single model call may take (seconds)
+DEADLINE_RESERVE_MS = int(os.environ.get('DEADLINE_RESERVE_MS', '1500'))
+MIN_MODEL_CALL_SECONDS = float(os.environ.get('MIN_MODEL_CALL_SECONDS', '3'))
+MODEL_CALL_TIMEOUT = float(os.environ.get('MODEL_CALL_TIMEOUT', '12'))
+# Output token cap. A complete answer to the response schema takes under 300
+# tokens; the cap leaves room for long texts and stops a runaway answer early.
+MAX_OUTPUT_TOKENS = int(os.environ.get('MAX_OUTPUT_TOKENS', '512'))
+# Least time left to look up the user's last setting for a fallback (seconds);
+# the lookup's client times out after one second
+FALLBACK_LOOKUP_SECONDS = 1.5
+
+# Gemini models, lightest first, each with the largest input it takes
+# (seconds of audio). The router picks the model of each request
+# from the input size and the recent latency and validity of each model,
+# see model_router.py.
+model_router = ModelRouter(
+    parse_tiers(os.environ.get('MODEL_TIERS', 'gemini-2.0-flash-lite:15,gemini-2.0-flash')),
+    slo_seconds=float(os.environ.get('MODEL_SLO_SECONDS', '6')),
+    percentile=float(os.environ.get('MODEL_SLO_PERCENTILE', '0.9')),
+    min_validity=float(os.environ.get('MODEL_MIN_VALIDITY', '0.8'))
+)
+# Default model, also the Model dimension of requests that never reach one
+MODEL_NAME = model_router.default_model
+# Generation config, built by get_model_config on first use or warm-up
+model_config = None
+
+# Circuit breaker around the calls of each model: after BREAKER_FAILURES
+# failed or slow calls in a row, requests get a fallback recommendation for
+# BREAKER_OPEN_SECONDS instead of waiting on the model. Openings are shared
+# with other containers through RateLimitTable unless BREAKER_SHARED=false.
+model_breakers = {
+    model: CircuitBreaker(
+        model,
+        failure_threshold=int(os.environ.get('BREAKER_FAILURES', '3')),
+        open_seconds=float(os.environ.get('BREAKER_OPEN_SECONDS', '30')),
+        slow_seconds=float(os.environ.get('BREAKER_SLOW_SECONDS', '10')),
+        table=(rate_limiter.table
+               if os.environ.get('BREAKER_SHARED', 'true').lower() == 'true' else None)
+    )
+    for model in model_router.models
+}
 
 # Gemini API initialization
 google_gemini_api_key = os.environ.get('GOOGLE_GEMINI_API_KEY')
@@ -54,6 +128,42 @@ CORS_HEADERS = {
 }
 
 
+def deadline_response(message):
+    """
+    Build the fast 503 response returned when the deadline is too close.
+
+    Args:
+        message: Error message for the client
+
+    Returns:
+        API Gateway response
+    """
+    return {
+        'statusCode': 503,
+        'headers': {**CORS_HEADERS, 'Retry-After': '1'},
+        'body': json.dumps(message)
+    }
+
+
+def throttled_response(retry_after):
+    """
+    Build the fast 429 response returned when a rate limit is hit.
+
+    Args:
+        retry_after: Seconds until the request may be retried
+
+    Returns:
+        API Gateway response
+    """
+    seconds = max(math.ceil(retry_after), 1)
+    return {
+        'statusCode': 429,
+        'headers': {**CORS_HEADERS, 'Retry-After': str(seconds),
+                    'Access-Control-Expose-Headers': 'Retry-After'},
+        'body': json.dumps(f"Too many requests, please try again in {seconds} seconds")
+    }
+
+
 def auth_user(uuid, pin):
     """
     Authenticate user against DynamoDB.
@@ -86,6 +196,39 @@ def auth_user(uuid, pin):
         raise AuthenticationError("Authentication failed")
 
 
+def get_last_response(uuid, timestamp=None):
+    """
+    Get the user's latest stored response up to the current time of day.
+
+    Feeds the fallback recommendation, so it uses the short-timeout client
+    and never raises.
+
+    Args:
+        uuid: User identifier
+        timestamp: Client-provided timestamp dictionary (optional)
+
+    Returns:
+        List with at most one ResponseTable item
+    """
+    current_time = None
+    if isinstance(timestamp, dict) and isinstance(timestamp.get("time"), str):
+        current_time = timestamp["time"]
+    current_time = current_time or datetime.now().strftime("%H:%M:%S")
+
+    try:
+        # Sort keys are TIME#HH:MM:SS#DAY#d; "~" sorts after every day suffix
+        response = rate_limit_dynamodb.Table('ResponseTable').query(
+            KeyConditionExpression=Key('uuid').eq(f'uuid#{uuid}') &
+            Key('TIME#DAY').lte(f"TIME#{current_time}#~"),
+            ScanIndexForward=False,
+            Limit=1
+        )
+        return response.get('Items', [])
+    except Exception as e:
+        logger.warning(f"Failed to read the last response for the fallback: {str(e)}")
+        return []
+
+
 def store_wav_file(uuid, file):
     """
     Store binary audio to temporary location.
@@ -113,29 +256,35 @@ def store_wav_file(uuid, file):
         raise IOError(f"Failed to write audio file: {str(e)}")
 
 
-def get_genai_response(file):
+def audio_duration(data):
     """
-    Generate response from Gemini AI based on audio.
+    Duration of a WAV recording, read from its header.
 
     Args:
-        file: Path to audio file
+        data: Binary audio data
 
     Returns:
-        Response from Gemini AI
-
-    Raises:
-        AIProcessingError: If AI processing fails
+        Seconds, or None if the data is not a PCM WAV file
     """
     try:
-        # Read the audio file directly
-        with open(file, 'rb') as f:
-            audio_data = f.read()
+        with wave.open(io.BytesIO(data), "rb") as wav:
+            return wav.getnframes() / float(wav.getframerate())
+    except (wave.Error, EOFError, ZeroDivisionError):
+        return None
 
-        # Create prompt for user query
-        prompt_text = "Analyze this audio and recommend optimal lighting settings."
 
-        # Create system instruction for proper context
-        system_instruction = """# Personalized Lighting Assistant
+def build_model_config():
+    """
+    Build the generation config shared by all requests.
+
+    Holds the system instruction, response schema and sampling settings;
+    per-call HTTP options are added by get_genai_response.
+
+    Returns:
+        GenerateContentConfig
+    """
+    # Create system instruction for proper context
+    system_instruction = """# Personalized Lighting Assistant
 
 You are an AI that analyzes audio input to create personalized lighting recommendations based on emotional state, context, and time of day.
 
@@ -237,6 +386,109 @@ Theme-Based Color Selection
 Fallback Protocol
 - Use time-appropriate defaults when context is unclear."""
 
+    # Set up response schema
+    response_schema = genai.types.Schema(
+        type=genai.types.Type.OBJECT,
+        required=["lightSetting", "emotion", "recommendation", "context"],
+        properties={
+            "lightSetting": genai.types.Schema(
+                type=genai.types.Type.OBJECT,
+                required=["power"],
+                properties={
+                    "color": genai.types.Schema(
+                        type=genai.types.Type.ARRAY,
+                        items=genai.types.Schema(
+                            type=genai.types.Type.STRING,
+                        ),
+                    ),
+                    "power": genai.types.Schema(
+                        type=genai.types.Type.BOOLEAN,
+                    ),
+                    "dynamic": genai.types.Schema(
+                        type=genai.types.Type.STRING,
+                        enum=VALID_DYNAMIC_MODES,
+                    ),
+                },
+            ),
+            "emotion": genai.types.Schema(
+                type=genai.types.Type.OBJECT,
+                description="Emotion analysis result",
+                required=["main", "subcategories"],
+                properties={
+                    "main": genai.types.Schema(
+                        type=genai.types.Type.STRING,
+                        enum=["Positive", "Negative", "Neutral"],
+                    ),
+                    "subcategories": genai.types.Schema(
+                        type=genai.types.Type.ARRAY,
+                        items=genai.types.Schema(
+                            type=genai.types.Type.STRING,
+                            enum=["Happy", "Excited", "Thankful", "Proud", "Relaxed", "Satisfied", "Peaceful", "Relieved", "Surprised (Good)", "Energetic", "Motivated", "Loved", "Hopeful", "Disappointed", "Sad", "Lonely", "Regretful", "Frustrated",
+                                  "Annoyed", "Angry", "Hurt", "Anxious", "Scared", "Worried", "Doubtful", "Helpless", "Disgusted", "Uncomfortable", "Shocked (Bad)", "Conflicted", "Indifferent", "Practical", "Logical", "Clear-headed", "Balanced", "Neutral"],
+                        ),
+                    ),
+                },
+            ),
+            "recommendation": genai.types.Schema(
+                type=genai.types.Type.STRING,
+            ),
+            "context": genai.types.Schema(
+                type=genai.types.Type.STRING,
+            ),
+        },
+    )
+
+    # Create the generation config
+    return genai.types.GenerateContentConfig(
+        temperature=0.65,
+        top_p=0.95,
+        top_k=40,
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        response_mime_type="application/json",
+        response_schema=response_schema,
+        system_instruction=system_instruction,
+    )
+
+
+def get_model_config():
+    """
+    Get the generation config, built once per container.
+
+    Returns:
+        GenerateContentConfig without HTTP options
+    """
+    global model_config
+    if model_config is None:
+        model_config = build_model_config()
+    return model_config
+
+
+def get_genai_response(file, timeout=None, metrics=NO_METRICS, model=MODEL_NAME):
+    """
+    Generate response from Gemini AI based on audio.
+
+    Args:
+        file: Path to audio file
+        timeout: Call timeout in seconds (optional)
+        metrics: StageMetrics recording prompt_build and model (optional)
+        model: Gemini model to call (optional)
+
+    Returns:
+        Response from Gemini AI
+
+    Raises:
+        AIProcessingError: If AI processing fails
+    """
+    try:
+        build_started = time.perf_counter()
+
+        # Read the audio file directly
+        with open(file, 'rb') as f:
+            audio_data = f.read()
+
+        # Create prompt for user query
+        prompt_text = "Analyze this audio and recommend optimal lighting settings."
+
         # Create combined text and audio content
         contents = [
             genai.types.Content(
@@ -249,75 +501,20 @@ Fallback Protocol
             ),
         ]
 
-        # Set up response schema
-        response_schema = genai.types.Schema(
-            type=genai.types.Type.OBJECT,
-            required=["lightSetting", "emotion", "recommendation", "context"],
-            properties={
-                "lightSetting": genai.types.Schema(
-                    type=genai.types.Type.OBJECT,
-                    required=["power"],
-                    properties={
-                        "color": genai.types.Schema(
-                            type=genai.types.Type.ARRAY,
-                            items=genai.types.Schema(
-                                type=genai.types.Type.STRING,
-                            ),
-                        ),
-                        "power": genai.types.Schema(
-                            type=genai.types.Type.BOOLEAN,
-                        ),
-                        "dynamic": genai.types.Schema(
-                            type=genai.types.Type.STRING,
-                            enum=VALID_DYNAMIC_MODES,
-                        ),
-                    },
-                ),
-                "emotion": genai.types.Schema(
-                    type=genai.types.Type.OBJECT,
-                    description="Emotion analysis result",
-                    required=["main", "subcategories"],
-                    properties={
-                        "main": genai.types.Schema(
-                            type=genai.types.Type.STRING,
-                            enum=["Positive", "Negative", "Neutral"],
-                        ),
-                        "subcategories": genai.types.Schema(
-                            type=genai.types.Type.ARRAY,
-                            items=genai.types.Schema(
-                                type=genai.types.Type.STRING,
-                                enum=["Happy", "Excited", "Thankful", "Proud", "Relaxed", "Satisfied", "Peaceful", "Relieved", "Surprised (Good)", "Energetic", "Motivated", "Loved", "Hopeful", "Disappointed", "Sad", "Lonely", "Regretful", "Frustrated",
-                                      "Annoyed", "Angry", "Hurt", "Anxious", "Scared", "Worried", "Doubtful", "Helpless", "Disgusted", "Uncomfortable", "Shocked (Bad)", "Conflicted", "Indifferent", "Practical", "Logical", "Clear-headed", "Balanced", "Neutral"],
-                            ),
-                        ),
-                    },
-                ),
-                "recommendation": genai.types.Schema(
-                    type=genai.types.Type.STRING,
-                ),
-                "context": genai.types.Schema(
-                    type=genai.types.Type.STRING,
-                ),
-            },
-        )
-
-        # Create the generation config
-        generate_content_config = genai.types.GenerateContentConfig(
-            temperature=0.65,
-            top_p=0.95,
-            top_k=40,
-            max_output_tokens=8192,
-            response_mime_type="application/json",
-            response_schema=response_schema,
-            system_instruction=system_instruction,
-        )
+        # System instruction, schema and sampling settings are built once per
+        # container
+        generate_content_config = get_model_config().model_copy(
+            update={"http_options": model_http_options(timeout)})
+        metrics.put("prompt_build", (time.perf_counter() - build_started) * 1000)
 
         # Call the Gemini API with the same format as pattern_to_ai.py
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=contents,
-            config=generate_content_config,
-        )
+        with metrics.stage("model"):
+            response = client.models.generate_content(
+                model=model,
+                contents=contents,
+                config=generate_content_config,
+            )
+        record_token_usage(response, metrics)
 
         return response
     except Exception as e:
@@ -325,87 +522,86 @@ Fallback Protocol
         raise AIProcessingError(f"Gemini AI processing failed: {str(e)}")
 
 
-def verify_and_parse_json(response):
+def model_http_options(timeout):
+    """
+    Build per-call HTTP options for the Gemini client.
+
+    Args:
+        timeout: Call timeout in seconds or None for the client default
+
+    Returns:
+        HttpOptions or None
+    """
+    if timeout is None:
+        return None
+    # HttpOptions.timeout is in milliseconds
+    return genai.types.HttpOptions(timeout=max(int(timeout * 1000), 1))
+
+
+def record_token_usage(response, metrics=NO_METRICS):
     """
-    Validate AI-generated lighting configuration.
+    Record the token counts of a model response.
 
     Args:
         response: Response object from Gemini API
+        metrics: StageMetrics of the invocation (optional)
 
     Returns:
-        Parsed JSON if valid, None otherwise
+        None
     """
-    try:
-        # Log the full response from Gemini
-        logger.info(f"Response from Gemini AI: {response.text}")
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None)
+    completion_tokens = getattr(usage, "candidates_token_count", None)
+    if prompt_tokens is not None:
+        metrics.count("prompt_tokens", prompt_tokens)
+    if completion_tokens is not None:
+        metrics.count("completion_tokens", completion_tokens)
+    if is_truncated(response):
+        metrics.count("truncated")
+        logger.warning(
+            f"Gemini AI response cut off at {MAX_OUTPUT_TOKENS} output tokens")
+    logger.info(f"Token usage: prompt={prompt_tokens}, completion={completion_tokens}")
 
-        # Extract JSON from Gemini response
-        json_response = json.loads(response.text)
-    except Exception as e:
-        logger.error(f"Not valid JSON: {str(e)}")
-        return None
 
-    # Check for required fields
-    required_fields = ["context", "emotion", "lightSetting", "recommendation"]
-    for field in required_fields:
-        if json_response.get(field) is None:
-            logger.error(f"Failed. Missing required field: {field}")
-            return None
-
-    light_setting = json_response["lightSetting"]
-
-    # Extract lighting parameters - note the field name change from dynamicMode to dynamic
-    color = light_setting.get("color")
-    # Changed from dynamicMode to dynamic
-    dynamic_mode = light_setting.get("dynamic")
-    power = light_setting.get("power")
-
-    # Validate light configuration based on power state and mode
-    if color is None and dynamic_mode is None:
-        if power is False:  # if power is off, no need to check color and dynamic mode
-            pass
-        else:
-            logger.error(
-                "Failed. Error in light mode: neither color nor dynamic specified when power is on")
-            return None
+def warmup_steps():
+    """
+    Steps that prime a new container for its first request.
+
+    Returns:
+        List of (name, callable) for warm_up
+    """
+    steps = [
+        ("model_config", get_model_config),
+        ("auth_table", lambda: dynamodb.Table("AuthTable").get_item(
+            Key={'uuid': WARMUP_ID, 'pin': WARMUP_ID})),
+        ("rate_limit_table", lambda: rate_limiter.table.get_item(
+            Key={'bucketKey': WARMUP_ID})),
+        # Picks up an opening shared by another container
+        ("circuit_breaker", lambda: [breaker.allow() for breaker in model_breakers.values()]),
+        ("gemini", lambda: client.models.get(
+            model=MODEL_NAME,
+            config=genai.types.GetModelConfig(
+                http_options=model_http_options(MODEL_CALL_TIMEOUT)))),
+    ]
+    if sqs_client:
+        steps.append(("result_queue", lambda: sqs_client.get_queue_attributes(
+            QueueUrl=RESULT_QUEUE_URL, AttributeNames=['QueueArn'])))
     else:
-        # Validate dynamic mode option if color is not specified
-        if color is None:
-            if dynamic_mode not in VALID_DYNAMIC_MODES:
-                logger.error(f"Failed. Error in dynamic mode: {dynamic_mode}")
-                return None
-        # Validate RGB color format if dynamic mode is not specified
-        if dynamic_mode is None:
-            if not isinstance(color, list) or len(color) != 3:
-                logger.error(f"Failed. Error in color code format: {color}")
-                return None
-            # Convert string values to integers if they're strings
-            try:
-                if all(isinstance(code, str) for code in color):
-                    color_int = [int(code) for code in color]
-                    if not all(0 <= code < 256 for code in color_int):
-                        logger.error(
-                            f"Failed. Color values out of range: {color}")
-                        return None
-                    # Update the color values to integers in the response
-                    json_response["lightSetting"]["color"] = color_int
-                elif not all(isinstance(code, int) and 0 <= code < 256 for code in color):
-                    logger.error(f"Failed. Invalid color values: {color}")
-                    return None
-            except ValueError:
-                logger.error(
-                    f"Failed. Color values not convertible to integers: {color}")
-                return None
-
-    return json_response
+        # DryRun checks the invoke permission without running the function
+        steps.append(("result_lambda", lambda: lambda_client.invoke(
+            FunctionName=os.environ.get('RESULT_LAMBDA_NAME', 'result-save-send'),
+            InvocationType='DryRun')))
+    return steps
 
 
+@profiled("audio_to_ai")
 def lambda_handler(event, context):
     """
     Process audio-based lighting requests.
 
     Authenticates user, processes audio, gets AI recommendation,
-    and returns lighting configuration.
+    and returns lighting configuration. Stage latencies are emitted as one
+    embedded-metric-format record per invocation.
 
     Args:
         event: Lambda event with user identification and audio file
@@ -414,6 +610,49 @@ def lambda_handler(event, context):
     Returns:
         API Gateway response with status code, headers and body
     """
+    # Scheduled warm-ups prime the container instead of running a request
+    if is_warmup(event):
+        return warm_up("audio_to_ai", warmup_steps())
+
+    metrics = StageMetrics("audio_to_ai", model=MODEL_NAME)
+    try:
+        response = process_request(event, context, metrics)
+        metrics.set_property("statusCode", response["statusCode"])
+        return response
+    finally:
+        metrics.flush()
+
+
+def process_request(event, context, metrics):
+    """
+    Authenticate, run the model and hand the result on.
+
+    Args:
+        event: Lambda event with user identification and audio file
+        context: Lambda context
+        metrics: StageMetrics of the invocation
+
+    Returns:
+        API Gateway response with status code, headers and body
+    """
+    deadline = Deadline.from_context(context, reserve_ms=DEADLINE_RESERVE_MS)
+
+    # Generate a unique request ID per invocation for tracing and idempotency
+    request_id = shortuuid.uuid()
+    metrics.set_property("requestId", request_id)
+    # One trace id follows the request to result_save_send and the device;
+    # clients can pass their own in X-Trace-Id
+    trace_id = get_trace_id(event, request_id)
+    metrics.set_property("traceId", trace_id)
+    # API Gateway stamps the request on arrival: the span covers the gateway,
+    # Lambda queueing and a cold start
+    request_time = (event.get('requestContext') or {}).get('requestTimeEpoch')
+    if request_time:
+        metrics.add_epoch_span("api_gateway", request_time, epoch_ms())
+    # Sequence number of the resulting command: arrival time in epoch ms, so
+    # the device ends up with the result of the latest request
+    seq = time.time_ns() // 1000000
+
     # Validate required environment variables
     required_vars = ['REGION_NAME', 'GOOGLE_GEMINI_API_KEY']
     missing_vars = [var for var in required_vars if not os.environ.get(var)]
@@ -526,7 +765,8 @@ def lambda_handler(event, context):
     try:
         logger.info(
             f"Attempting to decode base64 file of length: {len(event['file'])}")
-        file = base64.b64decode(event['file'])
+        with metrics.stage("base64_decode"):
+            file = base64.b64decode(event['file'])
         logger.info(f"Successfully decoded file, binary length: {len(file)}")
     except Exception as e:
         logger.error(f"Failed to decode base64 file: {str(e)}")
@@ -538,7 +778,12 @@ def lambda_handler(event, context):
 
     # Authenticate the user
     try:
-        auth_user(uuid, pin)
+        deadline.check("authentication", MIN_MODEL_CALL_SECONDS)
+        with metrics.stage("auth"):
+            auth_user(uuid, pin)
+    except DeadlineExceeded as e:
+        logger.warning(str(e))
+        return deadline_response("Request timed out, please try again")
     except AuthenticationError as e:
         return {
             'statusCode': 401,
@@ -546,6 +791,15 @@ def lambda_handler(event, context):
             'body': json.dumps(str(e))
         }
 
+    # Take rate limit tokens before any model work, so one client cannot use
+    # up the shared model quota and push everyone into the retry loop
+    with metrics.stage("admission"):
+        retry_after = rate_limiter.admit(uuid)
+    if retry_after > 0:
+        metrics.count("throttled")
+        logger.warning(f"Rate limit hit for UUID: {uuid}, retry in {retry_after:.1f}s")
+        return throttled_response(retry_after)
+
     wav_file = None
     # Store the audio file in temporary storage
     try:
@@ -558,23 +812,67 @@ def lambda_handler(event, context):
             'body': json.dumps(f"Failed to store audio file: {str(e)}")
         }
 
+    # Pick the model from the input size and how each model has been doing
+    input_size = audio_duration(file)
+    # Models whose breaker is open are left out while another one can answer
+    model = model_router.choose(
+        input_size, deadline.remaining(),
+        exclude=[name for name, breaker in model_breakers.items()
+                 if breaker.retry_after() > 0])
+    model_breaker = model_breakers[model]
+    metrics.model = model
+    metrics.set_property("inputSize", input_size)
+    logger.info(f"Routing input of size {input_size} to {model}: "
+                f"{json.dumps(model_router.snapshot())}")
+
     # Generate AI recommendation with retry mechanism
     retry = 0
+    invalid = 0
     parsed_json = None
     gemini_response = None
+    out_of_time = False
+    # Time the next attempt is expected to need; updated from the last attempt
+    attempt_seconds = MIN_MODEL_CALL_SECONDS
 
     # Retry up to 3 times to get a valid response
     while retry < 3 and parsed_json is None:
+        # Only start a model call that can finish before the deadline
+        if deadline.remaining() < max(attempt_seconds, MIN_MODEL_CALL_SECONDS):
+            logger.warning(
+                f"Skipping attempt {retry+1}/3: {deadline.remaining():.1f}s left")
+            out_of_time = True
+            break
+        # Skip the model while it is failing; the fallback answers instead
+        if not model_breaker.allow():
+            logger.warning(
+                f"Skipping attempt {retry+1}/3: circuit breaker open for "
+                f"{model_breaker.retry_after():.0f}s")
+            break
+
+        attempt_started = time.monotonic()
         try:
-            gemini_response = get_genai_response(wav_file)
-            parsed_json = verify_and_parse_json(gemini_response)
+            gemini_response = get_genai_response(
+                wav_file, timeout=deadline.timeout(MODEL_CALL_TIMEOUT), metrics=metrics,
+                model=model)
+            # An answer that fails validation still shows the model is up
+            model_breaker.record(True, time.monotonic() - attempt_started)
+            with metrics.stage("validation"):
+                parsed_json = verify_and_parse_json(gemini_response)
             if parsed_json is None:
                 logger.warning(
                     f"Attempt {retry+1}/3: Invalid response from Gemini AI")
         except AIProcessingError as e:
             logger.error(f"Attempt {retry+1}/3: {str(e)}")
+            model_breaker.record(False, time.monotonic() - attempt_started)
+        attempt_seconds = time.monotonic() - attempt_started
+        # Latency and validity per model drive the routing of later requests
+        model_router.record(model, attempt_seconds, parsed_json is not None)
+        if parsed_json is None:
+            invalid += 1
 
         retry += 1
+    metrics.count("retries", max(retry - 1, 0))
+    metrics.count("invalid", invalid)
 
     # Clean up temp file regardless of success or failure
     if wav_file and os.path.exists(wav_file):
@@ -583,7 +881,22 @@ def lambda_handler(event, context):
         except Exception as e:
             logger.warning(f"Failed to delete temp file: {str(e)}")
 
+    # Degraded mode: while the breaker is open, answer at once with a
+    # recommendation built without the model
+    if not parsed_json and model_breaker.is_open():
+        # The user's last setting at this time of day, if there is time to
+        # look it up, otherwise the time-of-day palette
+        past_responses = []
+        if deadline.remaining() > FALLBACK_LOOKUP_SECONDS:
+            past_responses = get_last_response(uuid, timestamp)
+        parsed_json = fallback_recommendation(past_responses, timestamp)
+        parsed_json["fallback"] = True
+        metrics.count("fallback")
+        logger.warning(f"Circuit breaker open, returning a fallback recommendation for UUID: {uuid}")
+
     # If all retries failed, return error
+    if not parsed_json and out_of_time:
+        return deadline_response("AI did not respond in time, please try again")
     if not parsed_json:
         return {
             'statusCode': 400,
@@ -593,6 +906,8 @@ def lambda_handler(event, context):
 
     # Add metadata to the response
     parsed_json["request_id"] = request_id
+    parsed_json["traceId"] = trace_id
+    parsed_json["seq"] = seq
     parsed_json["uuid"] = uuid
 
     # Use client timestamp or create a new timestamp in the correct format
@@ -609,17 +924,27 @@ def lambda_handler(event, context):
 
     # Invoke result-save-send Lambda to process the recommendation asynchronously
     try:
-        result_lambda_name = os.environ.get(
-            'RESULT_LAMBDA_NAME', 'result-save-send')
-        logger.info(f"Invoking Lambda function: {result_lambda_name}")
-
-        # Make sure timestamp is included in the payload
-        lambda_client.invoke(
-            FunctionName=result_lambda_name,
-            InvocationType='Event',  # for async invocation
-            Payload=json.dumps(parsed_json)
-        )
-        logger.info(f"Successfully invoked {result_lambda_name} Lambda")
+        parsed_json["handoffAt"] = epoch_ms()
+        with metrics.stage("handoff"):
+            if RESULT_QUEUE_URL:
+                # result-save-send consumes the queue in batches
+                sqs_client.send_message(
+                    QueueUrl=RESULT_QUEUE_URL,
+                    MessageBody=json.dumps(parsed_json)
+                )
+                logger.info(f"Successfully queued result for {RESULT_QUEUE_URL}")
+            else:
+                result_lambda_name = os.environ.get(
+                    'RESULT_LAMBDA_NAME', 'result-save-send')
+                logger.info(f"Invoking Lambda function: {result_lambda_name}")
+
+                # Make sure timestamp is included in the payload
+                lambda_client.invoke(
+                    FunctionName=result_lambda_name,
+                    InvocationType='Event',  # for async invocation
+                    Payload=json.dumps(parsed_json)
+                )
+                logger.info(f"Successfully invoked {result_lambda_name} Lambda")
     except Exception as e:
         logger.error(f"Failed to invoke result Lambda: {str(e)}")
         # Continue execution to at least return recommendation to user
@@ -632,6 +957,8 @@ def lambda_handler(event, context):
         'body': json.dumps({
             "recommendation": parsed_json["recommendation"],
             "request_id": request_id,
+            "trace_id": trace_id,
+            "fallback": parsed_json.get("fallback", False),
             "complete_data": parsed_json  # Include full data in case Lambda invocation failed
         })
     }
@@ -0,0 +1,177 @@
+"""
+Circuit breaker around the model call.
+
+The breaker lives at module level, so it carries over between the
+invocations of a container:
+
+    closed     calls go through; a failed or slow call counts as a failure
+    open       after failure_threshold failures in a row calls are skipped
+               for open_seconds, and the caller answers with a fallback
+    half_open  once open_seconds are over, the next call is a trial: its
+               success closes the breaker, its failure opens it again
+
+With a table, an opening is also written to RateLimitTable under
+bucketKey "breaker#<name>" with the time it ends (openUntil, epoch ms).
+Closed breakers read that row at most every sync_seconds. A new or idle
+container then learns about an outage without making failing calls of its
+own. Shared state only ever opens a breaker; every container runs its own
+trial.
+"""
+import logging
+import time
+
+logger = logging.getLogger()
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# Shared rows outlive the opening by this long before the TTL removes them (s)
+EXPIRY_MARGIN = 3600
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker with optional state shared through DynamoDB.
+
+    Args:
+        name: Breaker name, part of its key in the shared table
+        failure_threshold: Failures in a row that open the breaker
+        open_seconds: How long the breaker stays open before a trial call
+        slow_seconds: Calls that take longer count as failures
+        table: boto3 DynamoDB Table resource of RateLimitTable, or None to
+            keep the state in-process
+        sync_seconds: How often a closed breaker reads the shared state
+    """
+
+    def __init__(self, name, failure_threshold=3, open_seconds=30, slow_seconds=10,
+                 table=None, sync_seconds=5):
+        self.name = name
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.open_seconds = open_seconds
+        self.slow_seconds = slow_seconds
+        self.table = table
+        self.sync_seconds = sync_seconds
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.synced_at = None
+
+    @property
+    def key(self):
+        """Key of the breaker's row in the shared table"""
+        return f"breaker#{self.name}"
+
+    def allow(self, now=None):
+        """
+        Check whether a call may be made.
+
+        Args:
+            now: Epoch seconds (defaults to time.time())
+
+        Returns:
+            True if the call should be made, False to answer without it
+        """
+        now = now if now is not None else time.time()
+        if self.state == STATE_CLOSED:
+            self.sync(now)
+        if self.state == STATE_OPEN:
+            if now < self.open_until:
+                return False
+            self.state = STATE_HALF_OPEN
+            logger.info(f"Circuit breaker {self.name} half-open: trying a call")
+        return True
+
+    def is_open(self):
+        """True while calls are being skipped"""
+        return self.state == STATE_OPEN
+
+    def retry_after(self, now=None):
+        """
+        Seconds until the breaker lets a trial call through.
+
+        Args:
+            now: Epoch seconds (defaults to time.time())
+
+        Returns:
+            Seconds, 0 if calls go through
+        """
+        now = now if now is not None else time.time()
+        return max(self.open_until - now, 0.0) if self.state == STATE_OPEN else 0.0
+
+    def record(self, succeeded, seconds, now=None):
+        """
+        Record the outcome of a call.
+
+        Args:
+            succeeded: False if the call raised
+            seconds: Duration of the call
+            now: Epoch seconds (defaults to time.time())
+
+        Returns:
+            None
+        """
+        now = now if now is not None else time.time()
+        if succeeded and seconds <= self.slow_seconds:
+            if self.state != STATE_CLOSED:
+                logger.info(f"Circuit breaker {self.name} closed")
+            self.state = STATE_CLOSED
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trip(now)
+
+    def trip(self, now):
+        """
+        Open the breaker and share the opening.
+
+        Args:
+            now: Epoch seconds
+
+        Returns:
+            None
+        """
+        self.state = STATE_OPEN
+        self.failures = 0
+        self.open_until = now + self.open_seconds
+        logger.warning(
+            f"Circuit breaker {self.name} open for {self.open_seconds}s")
+        if self.table is None:
+            return
+        try:
+            self.table.put_item(Item={
+                "bucketKey": self.key,
+                "openUntil": int(self.open_until * 1000),
+                "expiresAt": int(self.open_until) + EXPIRY_MARGIN,
+            })
+        except Exception as e:
+            logger.warning(f"Failed to share circuit breaker state: {str(e)}")
+
+    def sync(self, now):
+        """
+        Open the breaker if another container opened it.
+
+        Args:
+            now: Epoch seconds
+
+        Returns:
+            None
+        """
+        if self.table is None or (
+                self.synced_at is not None and now - self.synced_at < self.sync_seconds):
+            return
+        self.synced_at = now
+        try:
+            item = self.table.get_item(Key={"bucketKey": self.key}).get("Item")
+        except Exception as e:
+            logger.warning(f"Failed to read circuit breaker state: {str(e)}")
+            return
+        open_until = int(item.get("openUntil", 0)) / 1000 if item else 0
+        if open_until > now:
+            self.state = STATE_OPEN
+            self.open_until = open_until
+            logger.warning(
+                f"Circuit breaker {self.name} open for {open_until - now:.0f}s "
+                f"(opened by another container)")
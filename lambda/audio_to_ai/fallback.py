@@ -0,0 +1,160 @@
+"""
+Fallback recommendations for when the model is unavailable.
+
+While the circuit breaker is open, the AI lambdas answer without calling the
+model. The fallback has the same shape verify_and_parse_json returns, so
+result_save_send and the clients handle it like any other result:
+
+- the user's usual setting at this time of day, if their history has a
+  valid one (pattern_to_ai already holds it from the history query)
+- otherwise a precomputed palette of the time of day: cool and bright in
+  the morning, neutral white at midday, warm and dim towards night
+
+Nothing here makes a network call.
+"""
+from collections import Counter
+from datetime import datetime
+
+from constants import VALID_DYNAMIC_MODES
+
+# (first hour, color, recommendation) of each time of day, in hour order;
+# the last entry also covers the hours before the first one
+TIME_OF_DAY_PALETTE = [
+    (5, [255, 220, 180], "A soft sunrise tone to ease into the morning."),
+    (8, [255, 255, 230], "Bright, cool light to help you focus this morning."),
+    (12, [255, 255, 255], "Clear white light for the middle of the day."),
+    (17, [255, 180, 100], "A warm evening glow to help you unwind."),
+    (20, [180, 100, 50], "Dim amber light to wind down for the night."),
+    (23, [60, 20, 0], "A faint warm light that won't keep you up."),
+]
+
+
+def current_hour(timestamp=None, now=None):
+    """
+    Hour of the request, from the client timestamp if it has a valid one.
+
+    Args:
+        timestamp: Client-provided timestamp dictionary (optional)
+        now: datetime to fall back to (defaults to the server time)
+
+    Returns:
+        Hour from 0 to 23
+    """
+    if isinstance(timestamp, dict) and isinstance(timestamp.get("time"), str):
+        try:
+            hour = int(timestamp["time"].split(":")[0])
+            if 0 <= hour < 24:
+                return hour
+        except ValueError:
+            pass
+    return (now or datetime.now()).hour
+
+
+def palette_setting(hour):
+    """
+    Color and recommendation of the time of day.
+
+    Args:
+        hour: Hour from 0 to 23
+
+    Returns:
+        (color, recommendation)
+    """
+    _, color, recommendation = TIME_OF_DAY_PALETTE[-1]
+    for first_hour, hour_color, hour_recommendation in TIME_OF_DAY_PALETTE:
+        if hour >= first_hour:
+            color, recommendation = hour_color, hour_recommendation
+    return list(color), recommendation
+
+
+def clean_light_setting(light_setting):
+    """
+    Validate a stored light setting and convert its numbers.
+
+    Args:
+        light_setting: lightSetting of a ResponseTable item
+
+    Returns:
+        Light setting with plain ints, or None if it is not valid
+    """
+    if not isinstance(light_setting, dict):
+        return None
+    power = light_setting.get("power")
+    if power is False:
+        return {"power": False}
+    if power is not True:
+        return None
+
+    dynamic_mode = light_setting.get("dynamic")
+    if dynamic_mode is not None:
+        return {"power": True, "dynamic": dynamic_mode} if dynamic_mode in VALID_DYNAMIC_MODES else None
+    color = light_setting.get("color")
+    if not isinstance(color, list) or len(color) != 3:
+        return None
+    try:
+        # DynamoDB returns numbers as Decimal
+        color = [int(c) for c in color]
+    except (TypeError, ValueError):
+        return None
+    if not all(0 <= c < 256 for c in color):
+        return None
+    return {"power": True, "color": color}
+
+
+def usual_setting(past_responses):
+    """
+    The user's most used valid setting among past responses.
+
+    Args:
+        past_responses: ResponseTable items, most recent first
+
+    Returns:
+        (light setting, item it came from), or (None, None)
+    """
+    settings = {}
+    counts = Counter()
+    for item in past_responses or []:
+        setting = clean_light_setting(item.get("lightSetting"))
+        if setting is None:
+            continue
+        key = repr(sorted(setting.items()))
+        # Keep the most recent item of each setting for its context
+        settings.setdefault(key, (setting, item))
+        counts[key] += 1
+    if not counts:
+        return None, None
+    # most_common keeps first-seen order among ties, i.e. the most recent
+    return settings[counts.most_common(1)[0][0]]
+
+
+def fallback_recommendation(past_responses=None, timestamp=None, now=None):
+    """
+    Build a recommendation without the model.
+
+    Args:
+        past_responses: ResponseTable items of the user, most recent first
+        timestamp: Client-provided timestamp dictionary (optional)
+        now: datetime to fall back to (defaults to the server time)
+
+    Returns:
+        Parsed result in the shape of verify_and_parse_json
+    """
+    setting, item = usual_setting(past_responses)
+    if setting is not None:
+        main = item.get("emotionTag")
+        if main not in ("Positive", "Negative", "Neutral"):
+            main = "Neutral"
+        return {
+            "lightSetting": setting,
+            "emotion": {"main": main, "subcategories": []},
+            "recommendation": "Your usual lighting for this time of day.",
+            "context": str(item.get("context") or "Based on your lighting history."),
+        }
+
+    color, recommendation = palette_setting(current_hour(timestamp, now))
+    return {
+        "lightSetting": {"power": True, "color": color},
+        "emotion": {"main": "Neutral", "subcategories": ["Neutral"]},
+        "recommendation": recommendation,
+        "context": "Lighting picked for the time of day.",
+    }
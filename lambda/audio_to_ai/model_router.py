@@ -0,0 +1,271 @@
+"""
+Model routing by input size and observed latency.
+
+Tiers are listed lightest first, each with the largest input it takes:
+
+    MODEL_TIERS="gemini-2.0-flash-lite:15,gemini-2.0-flash"
+
+The unit of the size is the caller's: seconds of audio in audio_to_ai,
+history items in pattern_to_ai. The last tier takes any size.
+
+For each request the router starts at the lightest tier that fits the
+input and takes the first tier that is healthy:
+
+- validity: at least min_validity of its recent answers passed validation
+- latency: its recent latency percentile is within the SLO, or within the
+  time the request has left if that is less
+
+Without enough recent samples, a tier counts as healthy, so every tier keeps
+being tried. Samples are kept for window_seconds per container, so a tier
+that went unhealthy is tried again once its bad samples age out. If no tier
+that fits is healthy, the fastest tier with valid answers takes the request,
+lighter ones included: the request is too big for them, but a late answer
+is worse.
+"""
+import logging
+import math
+import time
+from collections import deque
+
+logger = logging.getLogger()
+
+# Samples kept per model
+MAX_SAMPLES = 200
+
+
+def parse_tiers(spec):
+    """
+    Parse a MODEL_TIERS setting.
+
+    Args:
+        spec: Comma separated "model:max size" entries, lightest first; the
+            size of the last entry may be left out
+
+    Returns:
+        List of (model, max size or None)
+
+    Raises:
+        ValueError: If the setting is empty or a size is not a number
+    """
+    tiers = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        model, _, max_size = entry.partition(":")
+        tiers.append((model.strip(), float(max_size) if max_size.strip() else None))
+    if not tiers:
+        raise ValueError("MODEL_TIERS lists no model")
+    # The heaviest tier takes whatever the others do not
+    tiers[-1] = (tiers[-1][0], None)
+    return tiers
+
+
+class ModelStats:
+    """
+    Recent latencies and validation results of one model.
+
+    Args:
+        window_seconds: How long samples are kept
+    """
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        # (monotonic time, seconds, valid)
+        self.samples = deque(maxlen=MAX_SAMPLES)
+
+    def record(self, seconds, valid, now=None):
+        """
+        Record a model call.
+
+        Args:
+            seconds: Duration of the call
+            valid: False if the call raised or its answer failed validation
+            now: time.monotonic() reading (optional)
+
+        Returns:
+            None
+        """
+        self.samples.append(
+            (now if now is not None else time.monotonic(), seconds, bool(valid)))
+
+    def recent(self, now=None):
+        """
+        Drop expired samples.
+
+        Args:
+            now: time.monotonic() reading (optional)
+
+        Returns:
+            The samples still in the window
+        """
+        now = now if now is not None else time.monotonic()
+        while self.samples and now - self.samples[0][0] > self.window_seconds:
+            self.samples.popleft()
+        return self.samples
+
+    def latency(self, percentile, now=None):
+        """
+        Latency percentile of the recent calls (nearest rank).
+
+        Args:
+            percentile: Fraction between 0 and 1, e.g. 0.9
+            now: time.monotonic() reading (optional)
+
+        Returns:
+            Seconds, or None without samples
+        """
+        latencies = sorted(seconds for _, seconds, _ in self.recent(now))
+        if not latencies:
+            return None
+        return latencies[max(math.ceil(percentile * len(latencies)) - 1, 0)]
+
+    def validity(self, now=None):
+        """
+        Share of the recent calls with a valid answer.
+
+        Args:
+            now: time.monotonic() reading (optional)
+
+        Returns:
+            Fraction between 0 and 1, or None without samples
+        """
+        samples = self.recent(now)
+        if not samples:
+            return None
+        return sum(1 for _, _, valid in samples if valid) / len(samples)
+
+
+class ModelRouter:
+    """
+    Picks the model of a request.
+
+    Args:
+        tiers: List of (model, max size or None), lightest first
+        slo_seconds: Latency a model call should stay within
+        percentile: Latency percentile held against the SLO
+        min_validity: Least share of valid answers of a healthy tier
+        min_samples: Samples needed before a tier can count as unhealthy
+        window_seconds: How long samples are kept
+    """
+
+    def __init__(self, tiers, slo_seconds=6, percentile=0.9, min_validity=0.8,
+                 min_samples=5, window_seconds=300):
+        self.tiers = list(tiers)
+        self.slo_seconds = slo_seconds
+        self.percentile = percentile
+        self.min_validity = min_validity
+        self.min_samples = min_samples
+        self.stats = {model: ModelStats(window_seconds) for model, _ in self.tiers}
+
+    @property
+    def models(self):
+        """Models of all tiers, lightest first"""
+        return [model for model, _ in self.tiers]
+
+    @property
+    def default_model(self):
+        """Model of the heaviest tier"""
+        return self.tiers[-1][0]
+
+    def choose(self, size, budget_seconds=None, exclude=(), now=None):
+        """
+        Pick the model of a request.
+
+        Args:
+            size: Input size in the unit of the tiers, or None if unknown
+            budget_seconds: Time the request has left for the call (optional)
+            exclude: Models to leave out while another one is left, e.g.
+                those whose circuit breaker is open
+            now: time.monotonic() reading (optional)
+
+        Returns:
+            Model name
+        """
+        target = self.slo_seconds
+        if budget_seconds is not None:
+            target = min(target, budget_seconds)
+
+        fitting = [model for model, max_size in self.tiers
+                   if max_size is None or (size is not None and size <= max_size)]
+        candidates = [model for model in self.models if model not in exclude]
+        if not candidates:
+            return fitting[0]
+        for model in fitting:
+            if model in exclude:
+                continue
+            if self.healthy(model, target, now):
+                return model
+
+        # Nothing that fits meets the target: take the fastest tier whose
+        # answers still validate
+        best, best_latency = None, None
+        for model in candidates:
+            stats = self.stats[model]
+            samples = len(stats.recent(now))
+            validity = stats.validity(now)
+            if samples >= self.min_samples and validity < self.min_validity:
+                continue
+            latency = stats.latency(self.percentile, now)
+            if latency is not None and (best_latency is None or latency < best_latency):
+                best, best_latency = model, latency
+        chosen = best or next((model for model in fitting if model not in exclude),
+                              candidates[-1])
+        logger.info(f"No model meets {target:.1f}s for size {size}, routing to {chosen}")
+        return chosen
+
+    def healthy(self, model, target, now=None):
+        """
+        Check a model against the validity floor and a latency target.
+
+        Args:
+            model: Model name
+            target: Latency target in seconds
+            now: time.monotonic() reading (optional)
+
+        Returns:
+            True if the model is healthy or has too few samples to tell
+        """
+        stats = self.stats[model]
+        if len(stats.recent(now)) < self.min_samples:
+            return True
+        return (stats.validity(now) >= self.min_validity and
+                stats.latency(self.percentile, now) <= target)
+
+    def record(self, model, seconds, valid, now=None):
+        """
+        Record a model call.
+
+        Args:
+            model: Model name
+            seconds: Duration of the call
+            valid: False if the call raised or its answer failed validation
+            now: time.monotonic() reading (optional)
+
+        Returns:
+            None
+        """
+        stats = self.stats.get(model)
+        if stats is not None:
+            stats.record(seconds, valid, now)
+
+    def snapshot(self, now=None):
+        """
+        Recent stats of all models, for the log.
+
+        Args:
+            now: time.monotonic() reading (optional)
+
+        Returns:
+            {model: {"samples", "latency", "validity"}}
+        """
+        result = {}
+        for model, stats in self.stats.items():
+            latency = stats.latency(self.percentile, now)
+            validity = stats.validity(now)
+            result[model] = {
+                "samples": len(stats.recent(now)),
+                "latency": round(latency, 2) if latency is not None else None,
+                "validity": round(validity, 2) if validity is not None else None,
+            }
+        return result
@@ -0,0 +1,380 @@
+"""
+On-demand profiling of single invocations.
+
+profiled() wraps a Lambda handler. An invocation picked by PROFILE_MODE runs
+under cProfile and tracemalloc and leaves three files:
+
+    <function>/<YYYY-MM-DD>/<request id>.collapsed  collapsed stacks in
+        microseconds (flamegraph.pl, speedscope)
+    <function>/<YYYY-MM-DD>/<request id>.txt  top functions by cumulative
+        and own time, peak traced memory and the allocation sites of the
+        memory still held when the handler returned
+    <function>/<YYYY-MM-DD>/<request id>.pstats  raw stats for pstats or
+        snakeviz
+
+    @profiled("audio_to_ai")
+    def lambda_handler(event, context):
+        ...
+
+Modes:
+    off     never profile (default). profiled() returns the handler itself,
+            so a disabled profiler adds nothing to an invocation
+    header  profile requests whose X-Profile header, or the "profile" field
+            of a direct invocation, equals PROFILE_TOKEN
+    all     profile every invocation
+
+PROFILE_LIMIT caps the profiled invocations of one container. The files go
+to PROFILE_BUCKET under PROFILE_PREFIX, or to PROFILE_DIR without a bucket
+(e.g. when running locally). A profiled API response names the location in
+its X-Profile-Location header.
+
+cProfile only sees the thread that enabled it: blocking calls handed to a
+thread pool are profiled by wrapping them in profile_in_thread().
+"""
+import cProfile
+import functools
+import hmac
+import io
+import logging
+import marshal
+import os
+import pstats
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+logger = logging.getLogger()
+
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'off').lower()
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_LIMIT = int(os.environ.get('PROFILE_LIMIT', '5'))
+PROFILE_MEMORY = os.environ.get('PROFILE_MEMORY', 'true').lower() == 'true'
+PROFILE_BUCKET = os.environ.get('PROFILE_BUCKET')
+PROFILE_PREFIX = os.environ.get('PROFILE_PREFIX', 'profiles')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+
+PROFILE_HEADER = 'x-profile'
+LOCATION_HEADER = 'X-Profile-Location'
+
+# Header mode without a token would let any caller slow a request down
+PROFILE_ENABLED = PROFILE_MODE == 'all' or (PROFILE_MODE == 'header' and bool(PROFILE_TOKEN))
+
+# Frames kept per allocation traceback
+TRACE_FRAMES = 10
+# Rows of each table in the report
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+TOP_TRACEBACKS = 5
+# Deepest stack of the collapsed file, and the smallest share of time (s)
+# worth following down the call graph
+MAX_STACK_DEPTH = 64
+MIN_SHARE = 1e-6
+
+_s3_client = None
+_profiled_count = 0
+# Profile of the running invocation, collecting the profilers of I/O threads
+_active = None
+
+
+class _Session:
+    """Profilers of one profiled invocation"""
+
+    __slots__ = ("threads",)
+
+    def __init__(self):
+        self.threads = []
+
+
+def should_profile(event):
+    """
+    Decide whether an invocation is profiled.
+
+    Args:
+        event: Lambda event
+
+    Returns:
+        True if the invocation runs under the profiler
+    """
+    if _profiled_count >= PROFILE_LIMIT:
+        return False
+    if PROFILE_MODE == 'all':
+        return True
+    if not isinstance(event, dict):
+        return False
+    token = event.get('profile')
+    if token is None:
+        headers = event.get('headers') or {}
+        for name, value in headers.items():
+            if name.lower() == PROFILE_HEADER:
+                token = value
+                break
+    return isinstance(token, str) and hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+def profiled(function):
+    """
+    Decorator profiling the handler invocations picked by PROFILE_MODE.
+
+    Args:
+        function: Function name used in the profile paths
+
+    Returns:
+        Decorator returning the handler unchanged when profiling is off
+    """
+    def decorator(handler):
+        if not PROFILE_ENABLED:
+            if PROFILE_MODE != 'off':
+                logger.warning(
+                    f"Profiling disabled: PROFILE_MODE={PROFILE_MODE} needs "
+                    f"'all', or 'header' with PROFILE_TOKEN")
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not should_profile(event):
+                return handler(event, context)
+            return run_profiled(handler, event, context, function)
+        return wrapper
+    return decorator
+
+
+def profile_in_thread(call):
+    """
+    Profile a call made on another thread during a profiled invocation.
+
+    Args:
+        call: Callable without arguments, about to be run on a worker thread
+
+    Returns:
+        The call itself, or a wrapper profiling it when an invocation is
+        being profiled
+    """
+    session = _active
+    if session is None:
+        return call
+
+    def run():
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return call()
+        finally:
+            profiler.disable()
+            session.threads.append(profiler)
+    return run
+
+
+def run_profiled(handler, event, context, function):
+    """
+    Run one invocation under cProfile and tracemalloc and write the profile.
+
+    Args:
+        handler: Lambda handler
+        event: Lambda event
+        context: Lambda context
+        function: Function name used in the profile paths
+
+    Returns:
+        Handler response, with X-Profile-Location added to API responses
+    """
+    global _profiled_count, _active
+    _profiled_count += 1
+    request_id = getattr(context, 'aws_request_id', None) or str(time.time_ns())
+    memory = PROFILE_MEMORY and not tracemalloc.is_tracing()
+    if memory:
+        tracemalloc.start(TRACE_FRAMES)
+
+    session = _active = _Session()
+    profiler = cProfile.Profile()
+    location = None
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        response = handler(event, context)
+    finally:
+        profiler.disable()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        _active = None
+        snapshot = peak = None
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        try:
+            stats = pstats.Stats(profiler)
+            if session.threads:
+                stats.add(*session.threads)
+            location = write_profile(function, request_id, stats, snapshot, peak, elapsed_ms)
+            logger.info(f"Profile of {function} request {request_id} written to {location}")
+        except Exception as e:
+            logger.error(f"Failed to write profile: {str(e)}")
+
+    if location and isinstance(response, dict) and isinstance(response.get('headers'), dict):
+        response['headers'] = {**response['headers'], LOCATION_HEADER: location}
+    return response
+
+
+def frame_label(func):
+    """
+    Label of a pstats function key in collapsed stacks.
+
+    Args:
+        func: (filename, line, function name) key of pstats
+
+    Returns:
+        "name (file:line)", or the name alone for built-ins
+    """
+    filename, line, name = func
+    if filename == '~':
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(filename)}:{line})"
+    # ';' separates the frames of a collapsed stack
+    return label.replace(';', ',')
+
+
+def collapsed_stacks(stats):
+    """
+    Build collapsed stacks from cProfile stats.
+
+    cProfile keeps caller/callee pairs rather than whole stacks, so each
+    stack is rebuilt down the call graph from the entry points: a function's
+    time along a path is split between its callers in proportion to the time
+    each call edge took. Recursive edges are not followed.
+
+    Args:
+        stats: pstats.Stats
+
+    Returns:
+        List of "frame;frame;... microseconds" lines
+    """
+    entries = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    totals = {}
+
+    def walk(func, path, on_path, share):
+        _, _, own_time, cumulative, _ = entries[func]
+        scale = share / cumulative if cumulative else 0
+        path = path + [frame_label(func)]
+        own = own_time * scale
+        if own > 0:
+            key = ";".join(path)
+            totals[key] = totals.get(key, 0) + own
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        on_path = on_path | {func}
+        for callee, edge_time in callees.get(func, ()):
+            callee_share = edge_time * scale
+            if callee not in on_path and callee_share >= MIN_SHARE:
+                walk(callee, path, on_path, callee_share)
+
+    for func, entry in entries.items():
+        if not any(caller in entries for caller in entry[4]):
+            walk(func, [], frozenset(), entry[3])
+
+    return [f"{stack} {round(seconds * 1e6)}"
+            for stack, seconds in sorted(totals.items())
+            if round(seconds * 1e6) > 0]
+
+
+def memory_report(snapshot, peak):
+    """
+    Describe the traced memory of an invocation.
+
+    Args:
+        snapshot: tracemalloc snapshot taken when the handler returned
+        peak: Peak traced memory in bytes
+
+    Returns:
+        List of report lines
+    """
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+    lines = [f"Peak traced memory: {peak / 1024:.1f} KiB", "",
+             "Top allocation sites still held at return"]
+    lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS])
+    lines.extend(["", "Top allocation tracebacks"])
+    for stat in snapshot.statistics('traceback')[:TOP_TRACEBACKS]:
+        lines.append(f"{stat.size / 1024:.1f} KiB in {stat.count} blocks")
+        lines.extend(f"    {line}" for line in stat.traceback.format(most_recent_first=True))
+    return lines
+
+
+def build_report(function, request_id, stats, snapshot, peak, elapsed_ms):
+    """
+    Build the text report of a profiled invocation.
+
+    Args:
+        function: Function name
+        request_id: Lambda request id
+        stats: pstats.Stats
+        snapshot: tracemalloc snapshot, or None without memory profiling
+        peak: Peak traced memory in bytes
+        elapsed_ms: Wall time of the handler under the profiler
+
+    Returns:
+        Report text
+    """
+    stream = io.StringIO()
+    stats.stream = stream
+    stream.write(f"Profile of {function} request {request_id}\n")
+    stream.write(f"Wall time under the profiler: {elapsed_ms:.1f} ms\n\n")
+    stream.write("Top functions by cumulative time\n")
+    stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+    stream.write("Top functions by own time\n")
+    stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+    if snapshot is not None:
+        stream.write("\n".join(memory_report(snapshot, peak)) + "\n")
+    return stream.getvalue()
+
+
+def write_profile(function, request_id, stats, snapshot, peak, elapsed_ms):
+    """
+    Write the profile files to PROFILE_BUCKET, or to PROFILE_DIR without one.
+
+    Args:
+        function: Function name
+        request_id: Lambda request id
+        stats: pstats.Stats
+        snapshot: tracemalloc snapshot, or None
+        peak: Peak traced memory in bytes
+        elapsed_ms: Wall time of the handler under the profiler
+
+    Returns:
+        s3:// URI or local path of the files, without extension
+    """
+    global _s3_client
+    day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    key = f"{function}/{day}/{request_id}"
+    files = {
+        ".collapsed": ("\n".join(collapsed_stacks(stats)) + "\n").encode('utf-8'),
+        ".txt": build_report(function, request_id, stats, snapshot, peak,
+                             elapsed_ms).encode('utf-8'),
+        # Same format as pstats.Stats.dump_stats
+        ".pstats": marshal.dumps(stats.stats),
+    }
+
+    if PROFILE_BUCKET:
+        if _s3_client is None:
+            # Imported here so a disabled profiler costs no client at cold start
+            from boto3.session import Session
+            _s3_client = Session().client('s3')
+        key = f"{PROFILE_PREFIX}/{key}"
+        for extension, body in files.items():
+            _s3_client.put_object(Bucket=PROFILE_BUCKET, Key=key + extension, Body=body)
+        return f"s3://{PROFILE_BUCKET}/{key}"
+
+    path = os.path.join(PROFILE_DIR, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for extension, body in files.items():
+        with open(path + extension, 'wb') as f:
+            f.write(body)
+    return path
@@ -0,0 +1,109 @@
+"""
+Validation of the model's answers.
+
+Kept apart from the handler, which needs the Gemini client, so the checks
+can be run on their own. fallback.py builds results in the shape
+verify_and_parse_json returns.
+"""
+import json
+import logging
+
+from constants import VALID_DYNAMIC_MODES
+
+logger = logging.getLogger()
+
+
+def is_truncated(response):
+    """
+    Check whether a response stopped at max_output_tokens.
+
+    Args:
+        response: Response object from Gemini API
+
+    Returns:
+        True if the answer was cut off
+    """
+    candidates = getattr(response, "candidates", None) or []
+    # FinishReason is a str enum, so no genai import is needed to compare it
+    return bool(candidates) and candidates[0].finish_reason == "MAX_TOKENS"
+
+
+def verify_and_parse_json(response):
+    """
+    Verify and validate JSON response from AI.
+
+    Args:
+        response: Response object from Gemini API
+
+    Returns:
+        Parsed JSON if valid, None otherwise
+    """
+    logger.info(f"Verifying response from Gemini AI: {response.text}")
+
+    # A cut-off answer is never complete JSON
+    if is_truncated(response):
+        logger.error("Failed. Response truncated at max_output_tokens")
+        return None
+
+    try:
+        # Extract JSON from Gemini response
+        json_response = json.loads(response.text)
+    except Exception as e:
+        logger.error(f"Not valid JSON: {str(e)}")
+        return None
+
+    # Check for required fields
+    required_fields = ["context", "emotion", "lightSetting", "recommendation"]
+    for field in required_fields:
+        if json_response.get(field) is None:
+            logger.error(f"Failed. Missing required field: {field}")
+            return None
+
+    light_setting = json_response["lightSetting"]
+
+    # Extract lighting parameters
+    color = light_setting.get("color")
+    # Check both 'dynamic' and 'dynamicMode' fields
+    dynamic_mode = light_setting.get("dynamic")
+    power = light_setting.get("power")
+
+    # Validate light configuration based on power state and mode
+    if color is None and dynamic_mode is None:
+        if power is False:  # if power is off, no need to check color and dynamic mode
+            pass
+        else:
+            logger.error(
+                "Failed. Error in light mode: neither color nor dynamic mode specified when power is on")
+            return None
+    else:
+        # Validate dynamic mode option if color is not specified
+        if color is None:
+            if dynamic_mode not in VALID_DYNAMIC_MODES:
+                logger.error(f"Failed. Error in dynamic mode: {dynamic_mode}")
+                return None
+        # Validate RGB color format if dynamic mode is not specified
+        if dynamic_mode is None and color is not None:
+            # Check if color is a list of strings or integers
+            if not isinstance(color, list) or len(color) != 3:
+                logger.error(f"Failed. Error in color code format: {color}")
+                return None
+
+            # Convert strings to integers if needed
+            try:
+                color_values = [int(c) if isinstance(
+                    c, str) else c for c in color]
+                if not all(isinstance(code, int) and 0 <= code < 256 for code in color_values):
+                    logger.error(
+                        f"Failed. Error in color code values: {color}")
+                    return None
+                # Update color with integer values
+                light_setting["color"] = color_values
+            except ValueError:
+                logger.error(f"Failed. Error converting color values: {color}")
+                return None
+
+    # Standardize dynamic field name to 'dynamic' if it exists as 'dynamicMode'
+    if light_setting.get("dynamicMode") and not light_setting.get("dynamic"):
+        light_setting["dynamic"] = light_setting.pop("dynamicMode")
+
+    return json_response
@@ -0,0 +1,99 @@
+"""
+Prompt token budgeting of the user history.
+
+The history of past responses is the part of the prompt that grows. It is
+cut to a token budget before the model call, estimated from its length so
+no count_tokens call is made.
+"""
+import json
+import math
+from decimal import Decimal
+
+# Characters per token of the prompt estimate; JSON takes more tokens per
+# character than prose, so this errs on the high side
+CHARS_PER_TOKEN = 3
+
+
+# Custom JSON encoder to handle Decimal objects
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return float(obj) if obj % 1 else int(obj)
+        return super(DecimalEncoder, self).default(obj)
+
+
+def estimate_tokens(text):
+    """
+    Estimate the tokens of a text without a count_tokens call.
+
+    Args:
+        text: Prompt text
+
+    Returns:
+        Estimated token count
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def minutes_apart(time_a, time_b):
+    """
+    Minutes between two times of day, across midnight.
+
+    Args:
+        time_a: Time as HH:MM[:SS]
+        time_b: Time as HH:MM[:SS]
+
+    Returns:
+        Minutes from 0 to 720, or None if a time cannot be parsed
+    """
+    try:
+        hour_a, minute_a = (int(part) for part in time_a.split(":")[:2])
+        hour_b, minute_b = (int(part) for part in time_b.split(":")[:2])
+    except (AttributeError, ValueError):
+        return None
+    difference = abs((hour_a * 60 + minute_a) - (hour_b * 60 + minute_b)) % 1440
+    return min(difference, 1440 - difference)
+
+
+def budget_history(past_response, time_of_day, token_budget):
+    """
+    Serialize as much of the history as fits a token budget.
+
+    ResponseTable items only carry the time of day they were made, not a
+    date, so the items farthest from the current time of day are dropped
+    first: they say the least about what the user is doing now.
+
+    Args:
+        past_response: Past user responses from DynamoDB
+        time_of_day: Current time as HH:MM:SS
+        token_budget: Tokens the history may take
+
+    Returns:
+        (JSON list of the kept items in their original order or None if
+        none is kept, number of dropped items)
+    """
+    if not past_response:
+        return None, 0
+
+    def distance(item):
+        # Sort key "TIME#HH:MM:SS#DAY#d"
+        item_time = str(item.get('TIME#DAY', '')).split('#')[1:2]
+        minutes = minutes_apart(item_time[0], time_of_day) if item_time else None
+        return minutes if minutes is not None else 1440
+
+    # Each item costs its JSON plus a separator
+    serialized = [json.dumps(item, cls=DecimalEncoder) for item in past_response]
+    kept = set()
+    used = 1
+    for index in sorted(range(len(past_response)),
+                        key=lambda index: distance(past_response[index])):
+        cost = estimate_tokens(serialized[index]) + 1
+        if used + cost > token_budget:
+            break
+        kept.add(index)
+        used += cost
+
+    dropped = len(past_response) - len(kept)
+    if not kept:
+        return None, dropped
+    return "[" + ", ".join(serialized[index] for index in sorted(kept)) + "]", dropped
@@ -0,0 +1,168 @@
+"""
+Buffered archival of AI responses to S3.
+
+Instead of one small JSON object per request, records are appended to an
+in-memory NDJSON batch and written as a single gzip object when the batch
+grows past max_bytes or gets older than max_age seconds:
+
+    {prefix}dt=2025-01-31/hour=14/20250131T140512Z-<writer id>-<seq>.ndjson.gz
+
+Batches never span an hour, so every object belongs to exactly one partition.
+Fields that ResponseTable already stores (lightSetting, context and the main
+emotion) are dropped; records keep uuid and requestId to join with it.
+
+The batch lives in the container. A container that is shut down before its
+next flush loses at most max_age seconds of archive records, which only hold
+the fields missing from ResponseTable.
+"""
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+# Event fields already stored in ResponseTable or renamed in the record
+DEDUPED_FIELDS = ("uuid", "request_id", "requestId", "lightSetting", "context")
+
+# Re-queued lines kept after failed flushes, as a multiple of max_bytes
+MAX_BACKLOG_FACTOR = 4
+
+
+def build_archive_record(event, uuid, request_id, now=None):
+    """
+    Build the archive record of an AI response without ResponseTable fields.
+
+    Args:
+        event: Result event from the AI lambda
+        uuid: User identifier
+        request_id: Request identifier
+        now: Epoch seconds of the record (defaults to time.time())
+
+    Returns:
+        Record dict
+    """
+    record = {
+        "uuid": uuid,
+        "requestId": request_id,
+        "archivedAt": round(now if now is not None else time.time(), 3),
+    }
+    for key, value in event.items():
+        if key in DEDUPED_FIELDS:
+            continue
+        if key == "emotion" and isinstance(value, dict):
+            # emotion.main is stored as emotionTag
+            value = {k: v for k, v in value.items() if k != "main"}
+            if not value:
+                continue
+        record[key] = value
+    return record
+
+
+class ArchiveWriter:
+    """
+    NDJSON batch that is flushed on size or age.
+
+    Args:
+        prefix: S3 key prefix of the archive
+        max_bytes: Uncompressed batch size that triggers a flush
+        max_age: Age in seconds of the oldest record that triggers a flush
+    """
+
+    def __init__(self, prefix="archive/", max_bytes=1024 * 1024, max_age=60):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.writer_id = os.urandom(4).hex()
+        self.sequence = 0
+        self.lines = []
+        self.size = 0
+        self.started_at = None
+
+    def add(self, record, now=None):
+        """
+        Append a record to the batch.
+
+        Args:
+            record: JSON-serializable dict
+            now: Epoch seconds (defaults to time.time())
+
+        Returns:
+            The previous batch as returned by take() if the hour changed and
+            it has to be written first, otherwise None
+        """
+        now = now if now is not None else time.time()
+        pending = None
+        if self.lines and self._hour(now) != self._hour(self.started_at):
+            pending = self.take()
+
+        line = json.dumps(record, separators=(",", ":"), default=str) + "\n"
+        if not self.lines:
+            self.started_at = now
+        self.lines.append(line)
+        self.size += len(line)
+        return pending
+
+    def should_flush(self, now=None):
+        """
+        Check whether the batch is due.
+
+        Args:
+            now: Epoch seconds (defaults to time.time())
+
+        Returns:
+            True if the batch is over max_bytes or older than max_age
+        """
+        if not self.lines:
+            return False
+        now = now if now is not None else time.time()
+        return self.size >= self.max_bytes or now - self.started_at >= self.max_age
+
+    def take(self):
+        """
+        Remove the batch and render it as a gzip object.
+
+        Returns:
+            (key, body, lines) for the S3 put, or None if the batch is empty.
+            Pass lines to restore() if the put fails.
+        """
+        if not self.lines:
+            return None
+        lines, started_at = self.lines, self.started_at
+        self.lines, self.size, self.started_at = [], 0, None
+
+        stamp = datetime.fromtimestamp(started_at, tz=timezone.utc)
+        self.sequence += 1
+        key = (f"{self.prefix}dt={stamp:%Y-%m-%d}/hour={stamp:%H}/"
+               f"{stamp:%Y%m%dT%H%M%SZ}-{self.writer_id}-{self.sequence:06d}.ndjson.gz")
+        body = gzip.compress("".join(lines).encode("utf-8"))
+        return key, body, (lines, started_at)
+
+    def restore(self, taken):
+        """
+        Put the lines of a failed flush back in front of the batch.
+
+        Lines beyond MAX_BACKLOG_FACTOR * max_bytes are dropped.
+
+        Args:
+            taken: Third element of the tuple returned by take()
+
+        Returns:
+            Number of dropped lines
+        """
+        lines, started_at = taken
+        if self.lines and self._hour(started_at) != self._hour(self.started_at):
+            # Never merge two partitions; keep the newer batch
+            return len(lines)
+        self.lines = lines + self.lines
+        self.size = sum(len(line) for line in self.lines)
+        self.started_at = started_at
+
+        dropped = 0
+        while self.size > self.max_bytes * MAX_BACKLOG_FACTOR and len(self.lines) > 1:
+            self.size -= len(self.lines.pop(0))
+            dropped += 1
+        return dropped
+
+    @staticmethod
+    def _hour(epoch):
+        return int(epoch // 3600)
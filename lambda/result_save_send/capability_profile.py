@@ -0,0 +1,94 @@
+"""
+Per-device-type capability profiles and color quantization.
+
+A profile is stored in IrCodeTable next to the IR codes of a deviceType, under
+the reserved id CAPABILITY_PROFILE_ID:
+
+    {
+        "deviceType": "light",
+        "id": 100,
+        "steps": [16, 16, 16],       # up/down pulses for a full 0-255 sweep
+        "minGapMs": 70,              # minimum gap between two pulses
+        "presets": [                 # preset buttons and the color they recall
+            {"code": "FF1AE5", "rgb": [255, 0, 0], "adjustable": false}
+        ],
+        "codeVersion": 3             # bumped whenever an IR code changes
+    }
+
+The AI picks colors on a 0-255 scale, but a controller with 16 steps per
+channel cannot show more than 16 levels. Snapping the requested color to the
+nearest level the device can produce avoids sending pulses it cannot resolve.
+"""
+from constants import DEFAULT_CAPABILITY_PROFILE
+
+MAX_CHANNEL_VALUE = 255
+
+
+def parse_capability_profile(item):
+    """
+    Build a capability profile from an IrCodeTable item.
+
+    Args:
+        item: DynamoDB item or None
+
+    Returns:
+        Profile dict with steps, minGapMs, presets and codeVersion
+    """
+    profile = {
+        "steps": list(DEFAULT_CAPABILITY_PROFILE["steps"]),
+        "minGapMs": DEFAULT_CAPABILITY_PROFILE["minGapMs"],
+        "presets": [],
+        "codeVersion": DEFAULT_CAPABILITY_PROFILE["codeVersion"],
+    }
+    if not item:
+        return profile
+
+    steps = item.get("steps")
+    if steps and len(steps) == 3:
+        profile["steps"] = [
+            min(max(int(value), 1), MAX_CHANNEL_VALUE) for value in steps]
+    if item.get("minGapMs") is not None:
+        profile["minGapMs"] = int(item["minGapMs"])
+    if item.get("codeVersion") is not None:
+        profile["codeVersion"] = int(item["codeVersion"])
+
+    for preset in item.get("presets") or []:
+        if preset.get("code") and preset.get("rgb"):
+            profile["presets"].append({
+                "code": preset["code"],
+                "rgb": quantize_rgb([int(value) for value in preset["rgb"]],
+                                    profile["steps"]),
+                "adjustable": bool(preset.get("adjustable", False)),
+            })
+    return profile
+
+
+def quantize_channel(value, steps):
+    """
+    Snap a 0-255 channel value to the nearest level a channel can produce.
+
+    Args:
+        value: Requested value (0-255)
+        steps: Pulses for a full 0-255 sweep on this channel
+
+    Returns:
+        Nearest producible value (0-255)
+    """
+    value = min(max(int(value), 0), MAX_CHANNEL_VALUE)
+    level = round(value * steps / MAX_CHANNEL_VALUE)
+    return round(level * MAX_CHANNEL_VALUE / steps)
+
+
+def quantize_rgb(rgb, steps):
+    """
+    Snap an RGB color to the nearest color the device can produce.
+
+    Args:
+        rgb: Requested [r, g, b] (0-255)
+        steps: Pulses for a full sweep per channel, [r, g, b]
+
+    Returns:
+        Quantized [r, g, b]
+    """
+    return [quantize_channel(value, channel_steps)
+            for value, channel_steps in zip(rgb, steps)]
@@ -49,3 +49,34 @@ DEFAULT_IR_RESULT = {
     "dynamic": None,
     "enterDiy": None
 }
+
+# IrCodeTable ID of the capability profile item of a device type
+CAPABILITY_PROFILE_ID = 100
+
+# Profile used when a device type has none stored: one pulse per unit on each
+# channel, the firmware's 70 ms pulse gap, no presets and the first version
+# of the IR code set
+DEFAULT_CAPABILITY_PROFILE = {
+    "steps": [255, 255, 255],
+    "minGapMs": 70,
+    "presets": [],
+    "codeVersion": 1
+}
+
+# IR code ID to the key the firmware stores the code under
+FIRMWARE_IR_KEYS = {
+    12: "rup",
+    13: "rdown",
+    14: "gup",
+    15: "gdown",
+    16: "bup",
+    17: "bdown",
+    18: "power",
+    19: "enterDiy"
+}
+
+# Inline IR code keys of the legacy message format
+LEGACY_CODE_KEYS = [
+    "dynamicIr", "enterDiy", "power", "rup", "rdown",
+    "gup", "gdown", "bup", "bdown"
+]
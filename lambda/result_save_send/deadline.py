@@ -0,0 +1,89 @@
+"""
+Request deadline derived from the Lambda context.
+
+A Deadline is created once per invocation from
+context.get_remaining_time_in_millis(), minus a reserve for building the
+response. Every stage asks it how much time is left before starting work,
+so the function returns a fast error instead of being killed at its timeout.
+"""
+import time
+
+# Used when there is no Lambda context (local runs)
+DEFAULT_REMAINING_MS = 30000
+
+
+class DeadlineExceeded(Exception):
+    """Exception raised when a stage cannot finish before the deadline"""
+    pass
+
+
+class Deadline:
+    """
+    Point in time by which the invocation has to be done.
+
+    Args:
+        remaining_ms: Milliseconds until the deadline
+    """
+
+    def __init__(self, remaining_ms):
+        self.expires_at = time.monotonic() + max(remaining_ms, 0) / 1000
+
+    @classmethod
+    def from_context(cls, context, reserve_ms=0, budget_ms=None):
+        """
+        Build a deadline from the Lambda context.
+
+        Args:
+            context: Lambda context or None
+            reserve_ms: Time kept back for building the response
+            budget_ms: Optional upper bound for the whole invocation
+
+        Returns:
+            Deadline
+        """
+        get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+        remaining_ms = get_remaining() if get_remaining else DEFAULT_REMAINING_MS
+        remaining_ms -= reserve_ms
+        if budget_ms is not None:
+            remaining_ms = min(remaining_ms, budget_ms)
+        return cls(remaining_ms)
+
+    def remaining(self):
+        """Seconds left before the deadline (never negative)."""
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def remaining_ms(self):
+        """Milliseconds left before the deadline (never negative)."""
+        return int(self.remaining() * 1000)
+
+    def expired(self):
+        """True once the deadline has passed."""
+        return self.remaining() <= 0
+
+    def timeout(self, cap):
+        """
+        Timeout for a single call: the remaining time, at most cap seconds.
+
+        Args:
+            cap: Largest timeout the call should get
+
+        Returns:
+            Timeout in seconds
+        """
+        return min(self.remaining(), cap)
+
+    def check(self, stage, needed=0.0):
+        """
+        Make sure a stage can still finish.
+
+        Args:
+            stage: Stage name for the error message
+            needed: Seconds the stage needs at least
+
+        Raises:
+            DeadlineExceeded: If less than needed seconds are left
+        """
+        remaining = self.remaining()
+        if remaining <= needed:
+            raise DeadlineExceeded(
+                f"Not enough time left for {stage}: {remaining:.2f}s left, {needed:.2f}s needed")
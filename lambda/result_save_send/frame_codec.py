@@ -0,0 +1,266 @@
+"""
+Compact binary framing for device messages.
+
+Devices that connect with ?frame=binary receive this frame instead of the
+JSON message. The frame carries the same information in a few dozen bytes
+and can be applied by the firmware in a single pass without a JSON parser:
+
+    byte 0     FRAME_MAGIC (0xA5, never the first byte of a JSON message)
+    byte 1     FRAME_VERSION
+    byte 2..   records: [type u8][length u8][value, length bytes]
+
+Multi-byte integers are big-endian and IR codes are sent as uint32 instead
+of hex strings. Records are applied in order, and unknown record types are
+skipped by their length so newer servers can add records without breaking
+older firmware.
+
+Run this module directly for a size and encode-time comparison with JSON.
+"""
+import json
+import struct
+import time
+
+FRAME_MAGIC = 0xA5
+FRAME_VERSION = 1
+
+# Record types
+REC_CODE = 0x01          # [index u8][ir code u32]: update one stored code
+REC_CODE_VERSION = 0x02  # [version u32]
+REC_STEPS = 0x03         # [r u8][g u8][b u8]: pulses for a full sweep
+REC_IR_GAP = 0x04        # [gap ms u16]
+REC_RGB = 0x05           # [r u8][g u8][b u8]: target color without a plan
+REC_MODE = 0x06          # [index u8]: start the dynamic mode stored at index
+REC_DYNAMIC_IR = 0x07    # [ir code u32]: start a dynamic mode by code
+REC_SEQ = 0x08           # [seq u32]: low 32 bits of the command sequence number
+REC_TRACE = 0x09         # [trace id, ASCII]: echoed in the next state report
+REC_POWER = 0x10         # [on u8]: plan step ["power", on]
+REC_PRESET = 0x11        # [ir code u32][r u8][g u8][b u8]: plan step "preset"
+REC_ADJUST = 0x12        # [r u8][g u8][b u8]: plan step "adjust"
+
+# Code indexes, in the order of irCommands in hardware.ino
+FRAME_CODE_KEYS = [
+    "enterDiy", "power", "rup", "rdown", "gup", "gdown", "bup", "bdown",
+    "auto", "slow", "quick", "flash", "fade7", "fade3", "jump7", "jump3",
+    "music1", "music2", "music3", "music4"
+]
+
+
+def parse_ir_code(value):
+    """
+    Parse a hex IR code string ("FF02FD" or "0xFF02FD").
+
+    Args:
+        value: IR code string
+
+    Returns:
+        IR code as an int
+
+    Raises:
+        ValueError: If the code is not a 32-bit hex value
+    """
+    code = int(value, 16)
+    if not 0 <= code <= 0xFFFFFFFF:
+        raise ValueError(f"IR code out of range: {value}")
+    return code
+
+
+def _record(record_type, value):
+    return struct.pack(">BB", record_type, len(value)) + value
+
+
+def _rgb(values):
+    return struct.pack(">BBB", *[min(max(int(v), 0), 255) for v in values])
+
+
+def encode_frame(message):
+    """
+    Encode a device message as a binary frame.
+
+    Args:
+        message: Message dict as sent in JSON (legacy inline codes, "codes",
+            "mode", "plan", "rgbCode", "steps", "irGap", "codeVersion", "seq",
+            "trace")
+
+    Returns:
+        Frame bytes
+
+    Raises:
+        ValueError: If an IR code or plan step cannot be encoded
+    """
+    records = []
+
+    # Code set first so the commands below already use the new codes
+    codes = dict(message.get("codes") or {})
+    for key in FRAME_CODE_KEYS:
+        if message.get(key) and not codes.get(key):
+            codes[key] = message[key]
+    for index, key in enumerate(FRAME_CODE_KEYS):
+        if codes.get(key):
+            records.append(_record(
+                REC_CODE, struct.pack(">BI", index, parse_ir_code(codes[key]))))
+    if message.get("codeVersion") is not None:
+        records.append(_record(
+            REC_CODE_VERSION, struct.pack(">I", int(message["codeVersion"]))))
+    # Before seq, so the device echoes the trace even of a stale command
+    if message.get("trace"):
+        records.append(_record(REC_TRACE, message["trace"].encode("ascii")[:32]))
+    # After the code set, so a stale command still updates the stored codes.
+    # The firmware compares sequence numbers modulo 2^32.
+    if message.get("seq") is not None:
+        records.append(_record(
+            REC_SEQ, struct.pack(">I", int(message["seq"]) & 0xFFFFFFFF)))
+
+    if message.get("steps"):
+        records.append(_record(REC_STEPS, _rgb(message["steps"])))
+    if message.get("irGap") is not None:
+        records.append(_record(
+            REC_IR_GAP, struct.pack(">H", int(message["irGap"]))))
+
+    # Command
+    if message.get("mode"):
+        records.append(_record(REC_MODE, struct.pack(
+            ">B", FRAME_CODE_KEYS.index(message["mode"].lower()))))
+    elif message.get("dynamicIr"):
+        records.append(_record(REC_DYNAMIC_IR, struct.pack(
+            ">I", parse_ir_code(message["dynamicIr"]))))
+    elif "plan" in message:
+        # The plan already ends on the target color, rgbCode is not needed
+        for step in message["plan"]:
+            if step[0] == "power":
+                records.append(_record(REC_POWER, struct.pack(">B", 1 if step[1] else 0)))
+            elif step[0] == "preset":
+                records.append(_record(
+                    REC_PRESET,
+                    struct.pack(">I", parse_ir_code(step[1])) + _rgb(step[2:5])))
+            elif step[0] == "adjust":
+                records.append(_record(REC_ADJUST, _rgb(step[1:4])))
+            else:
+                raise ValueError(f"Unknown plan step: {step[0]}")
+    elif isinstance(message.get("rgbCode"), list):
+        records.append(_record(REC_RGB, _rgb(message["rgbCode"])))
+
+    return struct.pack(">BB", FRAME_MAGIC, FRAME_VERSION) + b"".join(records)
+
+
+def decode_frame(frame):
+    """
+    Decode a binary frame back into the message dict it was built from.
+
+    Codes are always returned under "codes" as uppercase hex strings and
+    "seq" holds only the low 32 bits of the sequence number.
+
+    Args:
+        frame: Frame bytes
+
+    Returns:
+        Message dict
+
+    Raises:
+        ValueError: If the frame header or a record is malformed
+    """
+    if len(frame) < 2 or frame[0] != FRAME_MAGIC:
+        raise ValueError("Not a binary frame")
+    if frame[1] != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version: {frame[1]}")
+
+    message = {}
+    pos = 2
+    while pos < len(frame):
+        if pos + 2 > len(frame):
+            raise ValueError("Truncated record header")
+        record_type, length = frame[pos], frame[pos + 1]
+        value = frame[pos + 2:pos + 2 + length]
+        if len(value) != length:
+            raise ValueError("Truncated record value")
+        pos += 2 + length
+
+        if record_type == REC_CODE:
+            index, code = struct.unpack(">BI", value)
+            message.setdefault("codes", {})[FRAME_CODE_KEYS[index]] = f"{code:X}"
+        elif record_type == REC_CODE_VERSION:
+            message["codeVersion"] = struct.unpack(">I", value)[0]
+        elif record_type == REC_SEQ:
+            message["seq"] = struct.unpack(">I", value)[0]
+        elif record_type == REC_TRACE:
+            message["trace"] = value.decode("ascii")
+        elif record_type == REC_STEPS:
+            message["steps"] = list(value)
+        elif record_type == REC_IR_GAP:
+            message["irGap"] = struct.unpack(">H", value)[0]
+        elif record_type == REC_RGB:
+            message["rgbCode"] = list(value)
+        elif record_type == REC_MODE:
+            message["mode"] = FRAME_CODE_KEYS[value[0]]
+        elif record_type == REC_DYNAMIC_IR:
+            message["dynamicIr"] = f"{struct.unpack('>I', value)[0]:X}"
+        elif record_type == REC_POWER:
+            message.setdefault("plan", []).append(["power", value[0]])
+        elif record_type == REC_PRESET:
+            code = struct.unpack(">I", value[:4])[0]
+            message.setdefault("plan", []).append(
+                ["preset", f"{code:X}"] + list(value[4:7]))
+        elif record_type == REC_ADJUST:
+            message.setdefault("plan", []).append(["adjust"] + list(value))
+        # Unknown record types are skipped
+
+    return message
+
+
+def benchmark(iterations=10000):
+    """
+    Compare frame and JSON size and encode time for typical messages.
+
+    Args:
+        iterations: Encodes per message and format
+
+    Returns:
+        List of {"name", "jsonBytes", "frameBytes", "jsonUs", "frameUs"}
+    """
+    code_set = {key: f"FF{index:04X}" for index, key in enumerate(FRAME_CODE_KEYS)}
+    legacy = {
+        "rgbCode": [175, 96, 48], "dynamicIr": None,
+        "enterDiy": "FF30CF", "power": "FF02FD", "rup": "FF28D7", "rdown": "FF08F7",
+        "gup": "FFA857", "gdown": "FF8877", "bup": "FF6897", "bdown": "FF48B7",
+        "steps": [16, 16, 16], "irGap": 70,
+        "plan": [["power", 1], ["preset", "FF1AE5", 255, 0, 0], ["adjust", 175, 96, 48]],
+    }
+    messages = {
+        "legacy color": legacy,
+        "code set + color": {
+            "rgbCode": [175, 96, 48], "steps": [16, 16, 16], "irGap": 70,
+            "plan": [["adjust", 175, 96, 48]], "codes": code_set, "codeVersion": 3,
+        },
+        "color only": {
+            "rgbCode": [175, 96, 48], "steps": [16, 16, 16], "irGap": 70,
+            "plan": [["adjust", 175, 96, 48]],
+        },
+        "dynamic mode": {"mode": "fade7"},
+    }
+
+    results = []
+    for name, message in messages.items():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            json_bytes = json.dumps(message).encode('utf-8')
+        json_us = (time.perf_counter() - start) / iterations * 1e6
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            frame = encode_frame(message)
+        frame_us = (time.perf_counter() - start) / iterations * 1e6
+
+        results.append({
+            "name": name,
+            "jsonBytes": len(json_bytes),
+            "frameBytes": len(frame),
+            "jsonUs": round(json_us, 2),
+            "frameUs": round(frame_us, 2),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    print(f"{'message':<18}{'json B':>8}{'frame B':>9}{'json us':>9}{'frame us':>10}")
+    for row in benchmark():
+        print(f"{row['name']:<18}{row['jsonBytes']:>8}{row['frameBytes']:>9}"
+              f"{row['jsonUs']:>9}{row['frameUs']:>10}")
@@ -0,0 +1,109 @@
+"""
+Idempotency store for result processing.
+
+Every result carries the requestId generated by the AI lambda. Before
+storing or sending a result, result_save_send claims its requestId in
+ProcessedRequestTable with a conditional put:
+
+    requestId   partition key
+    status      "in_progress" while the result is processed, then "done"
+    leaseUntil  epoch seconds after which an unfinished claim may be taken over
+    expiresAt   epoch seconds, DynamoDB TTL attribute
+
+A redelivered event (async-invoke retry or SQS redelivery) finds the claim
+and is skipped. A claim whose processing failed is released so the retry
+runs again, and a claim left behind by a crashed invocation can be taken
+over once its lease has run out.
+"""
+import time
+
+from botocore.exceptions import ClientError
+
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_DONE = "done"
+
+
+class IdempotencyStore:
+    """
+    Conditional claims on requestIds.
+
+    Args:
+        table: boto3 DynamoDB Table resource of ProcessedRequestTable
+        ttl_seconds: How long a processed requestId is remembered
+        lease_seconds: How long an unfinished claim blocks other invocations
+    """
+
+    def __init__(self, table, ttl_seconds=86400, lease_seconds=60):
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+
+    def claim(self, request_id, now=None):
+        """
+        Claim a requestId for processing.
+
+        Args:
+            request_id: Request identifier
+            now: Epoch seconds (defaults to time.time())
+
+        Returns:
+            True if the caller owns the request now, False if it was already
+            processed or is being processed by another invocation
+        """
+        now = int(now if now is not None else time.time())
+        try:
+            self.table.put_item(
+                Item={
+                    "requestId": request_id,
+                    "status": STATUS_IN_PROGRESS,
+                    "leaseUntil": now + self.lease_seconds,
+                    "expiresAt": now + self.ttl_seconds,
+                },
+                ConditionExpression=(
+                    "attribute_not_exists(requestId) OR "
+                    "(#status = :in_progress AND leaseUntil < :now)"),
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues={
+                    ":in_progress": STATUS_IN_PROGRESS,
+                    ":now": now,
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    def complete(self, request_id):
+        """
+        Mark a claimed requestId as processed.
+
+        Args:
+            request_id: Request identifier
+
+        Returns:
+            None
+        """
+        self.table.update_item(
+            Key={"requestId": request_id},
+            UpdateExpression="SET #status = :done REMOVE leaseUntil",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":done": STATUS_DONE}
+        )
+
+    def release(self, request_id):
+        """
+        Drop an unfinished claim so a retry can process the request.
+
+        Args:
+            request_id: Request identifier
+
+        Returns:
+            None
+        """
+        self.table.delete_item(
+            Key={"requestId": request_id},
+            ConditionExpression="#status = :in_progress",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":in_progress": STATUS_IN_PROGRESS}
+        )
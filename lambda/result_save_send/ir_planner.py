@@ -0,0 +1,228 @@
+"""
+IR transition planner for RGB LED controllers.
+
+hardware.ino reaches a color by entering DIY mode and sending one up/down
+pulse per unit of difference on each channel. Depending on where the device
+starts, that can take tens of seconds. The planner uses the last known device
+state to pick the cheapest command sequence the firmware can execute:
+
+- reuse the current state and adjust from it
+- power the strip off instead of walking every channel down to black
+- jump to a preset color first and fine-tune from there
+
+Plan steps are small JSON arrays executed in order by the firmware:
+
+    ["power", 0|1]                 switch power to the given state
+    ["preset", "<ir code>", r, g, b]  send a preset code, device is now r, g, b
+    ["adjust", r, g, b]            pulse up/down from the current color
+"""
+
+# Timing model mirrored from hardware.ino (milliseconds)
+IR_FRAME_MS = 108           # IRsend::sendNEC pads every frame to 108 ms
+SEND_DELAY_MS = 50          # sendIRCode(code, true) trailing delay
+POWER_ON_SETTLE_MS = 150    # wait after switching on before adjusting
+DIY_ENTRY_MS = 2 * (IR_FRAME_MS + SEND_DELAY_MS) + 150 + 200
+PULSE_GAP_MS = 70           # IR_SIGNAL_GAP in sendUpDownSequence
+BATCH_PAUSE_MS = 70         # extra pause after every 10th pulse of a long run
+BATCH_SIZE = 10
+CHANNEL_GAP_MS = 100        # delay between adjusted channels
+
+# Cost of a plan that does nothing
+NO_OP_MS = 0
+
+# One pulse per unit on every channel (no capability profile)
+DEFAULT_STEPS = [255, 255, 255]
+
+
+def channel_pulses(diff, steps=255):
+    """
+    Number of up/down pulses for a change on one channel.
+
+    Args:
+        diff: Absolute change on the 0-255 scale
+        steps: Pulses for a full 0-255 sweep on the channel
+
+    Returns:
+        Number of pulses
+    """
+    # Same integer rounding as adjustRGB in hardware.ino
+    return (abs(diff) * steps + 127) // 255
+
+
+def estimate_pulses_ms(count, pulse_gap_ms=PULSE_GAP_MS):
+    """
+    Estimate the time to send a run of identical up/down pulses.
+
+    Args:
+        count: Number of pulses
+        pulse_gap_ms: Gap after each pulse
+
+    Returns:
+        Estimated duration in milliseconds
+    """
+    if count <= 0:
+        return 0
+    pauses = count // BATCH_SIZE if count > BATCH_SIZE else 0
+    return count * (IR_FRAME_MS + pulse_gap_ms) + pauses * BATCH_PAUSE_MS
+
+
+def estimate_adjust_ms(current, target, enter_diy=True,
+                       pulse_gap_ms=PULSE_GAP_MS, steps=DEFAULT_STEPS):
+    """
+    Estimate the time adjustRGB needs to move from one color to another.
+
+    Args:
+        current: Current [r, g, b]
+        target: Target [r, g, b]
+        enter_diy: Whether the firmware enters DIY mode first
+        pulse_gap_ms: Gap after each pulse
+        steps: Pulses for a full 0-255 sweep per channel, [r, g, b]
+
+    Returns:
+        Estimated duration in milliseconds
+    """
+    pulses = [channel_pulses(t - c, s)
+              for c, t, s in zip(current, target, steps)]
+    if not any(pulses):
+        return NO_OP_MS
+
+    total = DIY_ENTRY_MS if enter_diy else 0
+    adjusted = 0
+    for count in sorted(pulses, reverse=True):
+        if count == 0:
+            continue
+        if adjusted > 0:
+            total += CHANNEL_GAP_MS
+        total += estimate_pulses_ms(count, pulse_gap_ms)
+        adjusted += 1
+    return total
+
+
+def estimate_power_ms(turning_on):
+    """
+    Estimate the time of a power toggle.
+
+    Args:
+        turning_on: True when the device is switched on
+
+    Returns:
+        Estimated duration in milliseconds
+    """
+    total = IR_FRAME_MS + SEND_DELAY_MS
+    if turning_on:
+        total += POWER_ON_SETTLE_MS
+    return total
+
+
+def worst_case_rgb(target):
+    """
+    Return the furthest possible starting color from a target.
+
+    Used as the starting point when the device state is unknown.
+
+    Args:
+        target: Target [r, g, b]
+
+    Returns:
+        [r, g, b] that maximises the per-channel distance to target
+    """
+    return [0 if value >= 128 else 255 for value in target]
+
+
+def plan_transition(current_state, target_state, presets=None,
+                    pulse_gap_ms=PULSE_GAP_MS, steps=DEFAULT_STEPS):
+    """
+    Compute the cheapest command sequence to reach a target state.
+
+    Args:
+        current_state: Last known {"power": bool, "rgb": [r, g, b],
+            "dynamic": bool} or None
+        target_state: Desired {"power": bool, "rgb": [r, g, b]}
+        presets: List of {"code": str, "rgb": [r, g, b], "adjustable": bool}
+        pulse_gap_ms: Gap after each up/down pulse
+        steps: Pulses for a full 0-255 sweep per channel, [r, g, b]
+
+    Returns:
+        Tuple of (plan steps, estimated_ms)
+    """
+    presets = presets or []
+    target_rgb = list(target_state.get("rgb") or [0, 0, 0])
+    target_power = bool(target_state.get("power", True))
+
+    known = current_state is not None and current_state.get("rgb") is not None
+    current_power = bool(current_state.get("power")) if known else None
+    current_rgb = list(current_state["rgb"]) if known else None
+
+    # Black is cheapest as "off": one power pulse instead of walking down
+    if not target_power or not any(target_rgb):
+        if current_power is False:
+            return [], NO_OP_MS
+        return [["power", 0]], estimate_power_ms(False)
+
+    candidates = []
+
+    # Power on first if needed; the controller resumes its last color
+    prefix = []
+    prefix_ms = 0
+    if current_power is not True:
+        prefix = [["power", 1]]
+        prefix_ms = estimate_power_ms(True)
+
+    # Option 1: adjust from the current (or worst-case unknown) color.
+    # A device running a dynamic mode must re-enter DIY even without a diff.
+    start_rgb = current_rgb if known else worst_case_rgb(target_rgb)
+    dynamic = bool(current_state.get("dynamic")) if known else False
+    adjust_ms = estimate_adjust_ms(
+        start_rgb, target_rgb, pulse_gap_ms=pulse_gap_ms, steps=steps)
+    if known and adjust_ms == NO_OP_MS and not dynamic:
+        candidates.append((prefix, prefix_ms))
+    else:
+        candidates.append((
+            prefix + [["adjust"] + target_rgb],
+            prefix_ms + (adjust_ms or DIY_ENTRY_MS)
+        ))
+
+    # Option 2: jump to a preset, then fine-tune when the preset allows it
+    for preset in presets:
+        preset_rgb = list(preset["rgb"])
+        preset_ms = prefix_ms + IR_FRAME_MS + SEND_DELAY_MS
+        preset_steps = prefix + [["preset", preset["code"]] + preset_rgb]
+        if preset_rgb == target_rgb:
+            candidates.append((preset_steps, preset_ms))
+        elif preset.get("adjustable"):
+            candidates.append((
+                preset_steps + [["adjust"] + target_rgb],
+                preset_ms + estimate_adjust_ms(
+                    preset_rgb, target_rgb, enter_diy=False,
+                    pulse_gap_ms=pulse_gap_ms, steps=steps)
+            ))
+
+    return min(candidates, key=lambda candidate: candidate[1])
+
+
+def resulting_state(current_state, steps):
+    """
+    Apply a plan to a state to get the state the device ends up in.
+
+    Args:
+        current_state: Last known {"power": bool, "rgb": [r, g, b]} or None
+        steps: Plan steps from plan_transition
+
+    Returns:
+        New {"power": bool, "rgb": [r, g, b] or None, "dynamic": bool} state
+    """
+    current_state = current_state or {}
+    rgb = current_state.get("rgb")
+    state = {
+        "power": bool(current_state.get("power")),
+        "rgb": list(rgb) if rgb is not None else None,
+        "dynamic": bool(current_state.get("dynamic")),
+    }
+    for step in steps:
+        if step[0] == "power":
+            state["power"] = bool(step[1])
+        elif step[0] == "preset":
+            state.update(power=True, rgb=list(step[2:5]), dynamic=False)
+        elif step[0] == "adjust":
+            state.update(power=True, rgb=list(step[1:4]), dynamic=False)
+    return state
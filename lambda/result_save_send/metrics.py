@@ -0,0 +1,299 @@
+"""
+Stage latency metrics and trace spans in CloudWatch embedded metric format (EMF).
+
+Each invocation collects the durations of its stages in a StageMetrics and
+prints them as a single EMF record when it ends. CloudWatch Logs extracts
+the metrics from the record, so the hot path makes no PutMetricData calls:
+
+    metrics = StageMetrics("audio_to_ai", model="gemini-2.0-flash")
+    with metrics.stage("auth"):
+        auth_user(uuid, pin)
+    metrics.count("retries", 1)
+    metrics.flush()
+
+Durations are in milliseconds. A stage that runs more than once, such as
+one model call per attempt, records one value per run. Records carry the
+Function dimension, plus Model when a model is set.
+
+Every stage is also kept as a span [name, start epoch ms, duration ms] in
+the record's "spans" field. With the request's trace id set as the traceId
+property, tools/trace_waterfall.py rebuilds the timeline of one request
+across all functions from the log lines.
+
+METRICS_ENABLED=false turns the records off; stages then cost a method
+call and nothing is collected.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AILightingBackend')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# EMF accepts at most 100 values per metric in one record
+MAX_VALUES = 100
+# Spans kept per record
+MAX_SPANS = 100
+
+# Clients may pass their own trace id; it travels to the device, so keep it
+# short and plain
+TRACE_HEADER = 'x-trace-id'
+TRACE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+
+def get_trace_id(event, default):
+    """
+    Trace id of a request: the X-Trace-Id header if it is valid, else default.
+
+    Args:
+        event: API Gateway event
+        default: Trace id to use without a valid header (e.g. the request id)
+
+    Returns:
+        Trace id string
+    """
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == TRACE_HEADER and isinstance(value, str) and \
+                TRACE_ID_PATTERN.match(value):
+            return value
+    return default
+
+
+def epoch_ms():
+    """Current time in epoch milliseconds."""
+    return time.time_ns() // 1000000
+
+
+class _Stage:
+    """Context manager timing one run of a stage"""
+
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.add_span(self.name, self.started, time.perf_counter())
+        return False
+
+
+class _NoStage:
+    """Context manager of disabled metrics"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class StageMetrics:
+    """
+    Stage durations and counts of one invocation.
+
+    Args:
+        function: Value of the Function dimension
+        model: Value of the Model dimension, or None to leave it out
+        enabled: Overrides METRICS_ENABLED
+    """
+
+    def __init__(self, function, model=None, enabled=None):
+        self.function = function
+        self.model = model
+        self.enabled = METRICS_ENABLED if enabled is None else enabled
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+        self.spans = []
+        # Converts perf_counter() readings to epoch seconds
+        self.clock_offset = time.time() - time.perf_counter()
+
+    def stage(self, name):
+        """
+        Time a block as one run of a stage.
+
+        Args:
+            name: Metric name of the stage
+
+        Returns:
+            Context manager
+        """
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def put(self, name, value, unit="Milliseconds"):
+        """
+        Record a value of a metric.
+
+        Args:
+            name: Metric name
+            value: Value to record
+            unit: CloudWatch unit of the metric
+
+        Returns:
+            None
+        """
+        if not self.enabled:
+            return
+        values = self.values.get(name)
+        if values is None:
+            self.values[name] = [round(value, 2)]
+            self.units[name] = unit
+        elif len(values) < MAX_VALUES:
+            values.append(round(value, 2))
+
+    def add_span(self, name, started, ended, metric=True):
+        """
+        Record a stage from perf_counter() readings.
+
+        Args:
+            name: Span name, also the metric name
+            started: perf_counter() at the start of the stage
+            ended: perf_counter() at its end
+            metric: Also record the duration as a metric; pass False for
+                names that would make too many metrics (e.g. per device)
+
+        Returns:
+            None
+        """
+        if not self.enabled:
+            return
+        duration = (ended - started) * 1000
+        if metric:
+            self.put(name, duration)
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append(
+                [name, int((started + self.clock_offset) * 1000), round(duration, 2)])
+
+    def add_epoch_span(self, name, start_ms, end_ms, metric=True):
+        """
+        Record a stage from epoch milliseconds, e.g. a time stamped by
+        another service.
+
+        Args:
+            name: Span name, also the metric name
+            start_ms: Start in epoch milliseconds
+            end_ms: End in epoch milliseconds
+            metric: Also record the duration as a metric
+
+        Returns:
+            None
+        """
+        if not self.enabled:
+            return
+        duration = max(end_ms - start_ms, 0)
+        if metric:
+            self.put(name, duration)
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append([name, int(start_ms), round(duration, 2)])
+
+    def put_timings(self, timings):
+        """
+        Record a dict of durations in milliseconds, one value per entry.
+
+        Args:
+            timings: {stage name: milliseconds}
+
+        Returns:
+            None
+        """
+        for name, value in timings.items():
+            self.put(name, value)
+
+    def count(self, name, value=1):
+        """
+        Record a count, e.g. the retries of an invocation.
+
+        Args:
+            name: Metric name
+            value: Count to record
+
+        Returns:
+            None
+        """
+        self.put(name, value, unit="Count")
+
+    def set_property(self, name, value):
+        """
+        Attach a searchable field that is not a metric (e.g. a request id).
+
+        Args:
+            name: Field name
+            value: JSON-serializable value
+
+        Returns:
+            None
+        """
+        if self.enabled:
+            self.properties[name] = value
+
+    def render(self, now=None):
+        """
+        Build the EMF record of what was collected.
+
+        Args:
+            now: Epoch seconds of the record (defaults to time.time())
+
+        Returns:
+            Record dict, or None if nothing was collected
+        """
+        if not self.values and not self.spans:
+            return None
+        dimensions = ["Function", "Model"] if self.model else ["Function"]
+        record = {
+            "_aws": {
+                "Timestamp": int((now if now is not None else time.time()) * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [dimensions],
+                    "Metrics": [{"Name": name, "Unit": self.units[name]}
+                                for name in self.values],
+                }],
+            },
+        }
+        record.update(self.properties)
+        record["Function"] = self.function
+        if self.model:
+            record["Model"] = self.model
+        for name, values in self.values.items():
+            record[name] = values[0] if len(values) == 1 else values
+        if self.spans:
+            record["spans"] = self.spans
+        return record
+
+    def flush(self):
+        """
+        Print the EMF record to stdout and start over.
+
+        The record is printed rather than logged: the Lambda log format
+        prefixes logger lines, and CloudWatch only parses bare JSON lines.
+
+        Returns:
+            None
+        """
+        record = self.render()
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+        self.spans = []
+        if record is not None:
+            sys.stdout.write(json.dumps(record, separators=(",", ":"), default=str) + "\n")
+            sys.stdout.flush()
+
+
+# Default for helpers called without an invocation's metrics
+NO_METRICS = StageMetrics(None, enabled=False)
@@ -2,9 +2,34 @@ import json
 import os
 import logging
 import asyncio
+import functools
+import time
+import struct
+import copy
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from boto3.session import Session
-from constants import DYNAMIC_MODES, IR_CODE_MAP, DEFAULT_IR_RESULT
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from decimal import Decimal
+from constants import (DYNAMIC_MODES, IR_CODE_MAP, DEFAULT_IR_RESULT, CAPABILITY_PROFILE_ID,
+                       FIRMWARE_IR_KEYS, LEGACY_CODE_KEYS)
+from capability_profile import parse_capability_profile, quantize_rgb
+from ir_planner import plan_transition, resulting_state
+from frame_codec import encode_frame
+from archive_writer import ArchiveWriter, build_archive_record
+from deadline import Deadline
+from idempotency import IdempotencyStore
+from metrics import StageMetrics, epoch_ms
+from profiling import profiled, profile_in_thread, PROFILE_ENABLED
+from warmup import is_warmup, warm_up, WARMUP_ID
+
+
+class ResultDeliveryError(Exception):
+    """Raised when a result could not be delivered, so Lambda retries it"""
+    pass
 
 
 # Initialize the logger
@@ -17,9 +42,143 @@ region_name = os.environ.get('REGION_NAME', 'us-east-1')
 # Create a session to use for clients
 boto_session = Session(region_name=region_name)
 
+# Bounded thread pool for blocking boto3 calls and per-call deadline (seconds)
+IO_MAX_WORKERS = int(os.environ.get('IO_MAX_WORKERS', '8'))
+IO_CALL_TIMEOUT = float(os.environ.get('IO_CALL_TIMEOUT', '3'))
+io_executor = ThreadPoolExecutor(
+    max_workers=IO_MAX_WORKERS, thread_name_prefix='io')
+
+# Overall budget of a direct invocation (ms) and the time kept back from the
+# Lambda timeout for logging and returning (ms)
+RESULT_BUDGET_MS = int(os.environ.get('RESULT_BUDGET_MS', '5000'))
+DEADLINE_RESERVE_MS = int(os.environ.get('DEADLINE_RESERVE_MS', '500'))
+
+# Keep botocore timeouts close to the call deadline so worker threads are
+# released instead of hanging on a slow connection after the caller gave up
+boto_config = Config(
+    connect_timeout=2,
+    read_timeout=IO_CALL_TIMEOUT,
+    retries={'max_attempts': 2, 'mode': 'standard'},
+    max_pool_connections=IO_MAX_WORKERS
+)
+
+# Delivery is the last hop before the lights change: keep its pooled
+# connections alive with TCP keep-alive and never retry into the deadline
+websocket_config = boto_config.merge(Config(
+    tcp_keepalive=True,
+    retries={'max_attempts': 1, 'mode': 'standard'}
+))
+
 # Generate clients
-s3_client = boto_session.client('s3')
-dynamodb = boto_session.resource('dynamodb')
+s3_client = boto_session.client('s3', config=boto_config)
+dynamodb = boto_session.resource('dynamodb', config=boto_config)
+
+# API Gateway Management clients cached per endpoint URL
+apigateway_clients = {}
+
+# IR code tables cached per device type (seconds). Codes only change together
+# with the profile's codeVersion, so warm containers skip IrCodeTable.
+CODE_TABLE_TTL = float(os.environ.get('CODE_TABLE_TTL', '300'))
+code_tables = {}
+# Device types whose code tables warm-ups load ahead of the first request
+WARMUP_DEVICE_TYPES = [device_type.strip() for device_type in
+                       os.environ.get('WARMUP_DEVICE_TYPES', 'light').split(',')
+                       if device_type.strip()]
+
+# Archive mode: "object" writes one JSON object per request, "batch" appends
+# records to gzip NDJSON objects that are flushed on size or age
+ARCHIVE_MODE = os.environ.get('ARCHIVE_MODE', 'object')
+archive_writer = ArchiveWriter(
+    prefix=os.environ.get('ARCHIVE_PREFIX', 'archive/'),
+    max_bytes=int(os.environ.get('ARCHIVE_MAX_BYTES', str(1024 * 1024))),
+    max_age=float(os.environ.get('ARCHIVE_MAX_AGE', '60'))
+)
+
+# Connections without a heartbeat for this many seconds are treated as gone,
+# so results are not posted to dead connections
+PRESENCE_TIMEOUT = int(os.environ.get('PRESENCE_TIMEOUT', '90'))
+
+# How a failed post_to_connection is handled: "gone" connections are closed
+# and their row is removed, "rejected" sends fail the same way on every try,
+# everything else (throttling, timeouts, network errors) is retried
+DELIVERY_GONE = "gone"
+DELIVERY_REJECTED = "rejected"
+DELIVERY_RETRY = "retry"
+REJECTED_ERROR_CODES = ("BadRequestException", "ForbiddenException",
+                        "PayloadTooLargeException")
+
+# A user can drive several devices, each connected under its own deviceId.
+# Devices that connect without one share DEFAULT_DEVICE_ID. Results are sent
+# to at most FANOUT_CONCURRENCY devices of a user at a time.
+DEFAULT_DEVICE_ID = "default"
+FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', '4'))
+
+# Commands for the same device that reach result_save_send within this many
+# milliseconds collapse into the newest one (0 disables the wait; the result
+# queue collapses each batch regardless)
+COALESCE_WINDOW_MS = int(os.environ.get('COALESCE_WINDOW_MS', '0'))
+
+# StageMetrics of the running invocation; timed() and the fan-out add their
+# spans to it
+current_metrics = contextvars.ContextVar('current_metrics', default=None)
+
+# Processed requestIds are remembered for IDEMPOTENCY_TTL seconds so
+# redelivered results are neither stored nor sent twice
+idempotency_store = IdempotencyStore(
+    dynamodb.Table('ProcessedRequestTable'),
+    ttl_seconds=int(os.environ.get('IDEMPOTENCY_TTL', '86400')),
+    lease_seconds=int(os.environ.get('IDEMPOTENCY_LEASE', '60'))
+)
+
+
+async def run_io(func, *args, timeout=IO_CALL_TIMEOUT, **kwargs):
+    """
+    Run a blocking call on the I/O thread pool with a deadline.
+
+    Args:
+        func: Blocking callable (typically a boto3 client/table method)
+        *args: Positional arguments for func
+        timeout: Deadline in seconds for this call
+        **kwargs: Keyword arguments for func
+
+    Returns:
+        Return value of func
+
+    Raises:
+        asyncio.TimeoutError: If the call does not finish before the deadline
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if PROFILE_ENABLED:
+        # cProfile only sees its own thread: profile the call on the worker
+        call = profile_in_thread(call)
+    return await asyncio.wait_for(loop.run_in_executor(io_executor, call), timeout)
+
+
+async def timed(name, coro, timings):
+    """
+    Await a coroutine and record its wall-clock duration.
+
+    The run is also added as a span to the invocation's StageMetrics.
+
+    Args:
+        name: Task name used as the key in timings
+        coro: Coroutine to await
+        timings: Dictionary collecting durations in milliseconds
+
+    Returns:
+        Result of the coroutine
+    """
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        end = time.perf_counter()
+        timings[name] = round((end - start) * 1000, 1)
+        metrics = current_metrics.get()
+        if metrics is not None:
+            # The durations are recorded as metrics from timings at the end
+            metrics.add_span(name, start, end, metric=False)
 
 
 async def configure_light_settings(json_response):
@@ -30,25 +189,29 @@ async def configure_light_settings(json_response):
         json_response: Parsed JSON response with light settings
 
     Returns:
-        JSON string with light configuration and IR codes
+        Tuple of (message dict with light configuration and IR codes,
+        code table of the device type from load_code_table)
     """
     light_setting = json_response["lightSetting"]
-    device_type = "light"
+    device_type = json_response.get("deviceType", "light")
 
     result = {}
 
+    # One cached read holds every code and the profile of the device type
+    code_table = await run_io(load_code_table, device_type)
+
     # Set power state from light_setting
     power = light_setting.get("power", True)
 
     if not power:
         # If power is off, we don't need RGB values or dynamic mode
         result["rgbCode"] = [0, 0, 0]
-        ir_codes = get_ir_code(device_type)
+        ir_codes = get_ir_code(code_table)
     elif "color" in light_setting:
         # Get RGB values from the response
         result["rgbCode"] = light_setting.get("color", [0, 0, 0])
         # Get IR codes for controlling RGB light
-        ir_codes = get_ir_code(device_type)
+        ir_codes = get_ir_code(code_table)
     elif "dynamic" in light_setting:
         # Set rgbCode to default for dynamic mode
         result["rgbCode"] = ""
@@ -57,11 +220,14 @@ async def configure_light_settings(json_response):
         # Log the dynamic mode being used
         logger.info(f"Using dynamic mode: {dynamic_mode}")
         # Get IR codes for dynamic mode
-        ir_codes = get_dynamic_mode(dynamic_mode, device_type)
+        ir_codes = get_dynamic_mode(dynamic_mode, code_table)
+        # Firmware with the code set looks the mode up by name
+        if dynamic_mode in DYNAMIC_MODES:
+            result["mode"] = dynamic_mode.lower()
     else:
         # Default case - use standard IR codes
         result["rgbCode"] = [0, 0, 0]
-        ir_codes = get_ir_code(device_type)
+        ir_codes = get_ir_code(code_table)
 
     # Add IR codes to the result
     result["dynamicIr"] = ir_codes.get("dynamic", "")
@@ -74,8 +240,20 @@ async def configure_light_settings(json_response):
     result["bup"] = ir_codes.get("b_up", "")
     result["bdown"] = ir_codes.get("b_down", "")
 
-    # Convert the result to JSON string
-    return json.dumps(result)
+    profile = code_table["profile"]
+    if isinstance(result["rgbCode"], list):
+        # Snap the requested color to the nearest one the device can produce
+        requested = result["rgbCode"]
+        result["rgbCode"] = quantize_rgb(requested, profile["steps"])
+        if result["rgbCode"] != requested:
+            logger.info(
+                f"Quantized color {requested} to {result['rgbCode']} for {device_type}")
+        # Tell the firmware how many pulses a full sweep takes and how fast
+        # it may send them
+        result["steps"] = profile["steps"]
+        result["irGap"] = profile["minGapMs"]
+
+    return result, code_table
 
 
 def get_ir_code_from_table(device_type, ir_id):
@@ -112,35 +290,91 @@ def get_ir_code_from_table(device_type, ir_id):
     return None
 
 
-def get_ir_code(device_type):
+def load_code_table(device_type):
     """
-    Get IR codes for RGB control.
+    Load every IR code and the capability profile of a device type.
+
+    The table is read with a single batch_get_item and cached for
+    CODE_TABLE_TTL seconds. Incomplete reads are not cached, so a throttled
+    batch is retried by the next invocation.
 
     Args:
         device_type: Type of device
 
     Returns:
-        Dictionary of IR codes for RGB controls
+        {"codes": {ir_id: ir_code}, "profile": capability profile}
     """
-    result = DEFAULT_IR_RESULT.copy()
+    cached = code_tables.get(device_type)
+    if cached and time.monotonic() - cached["loadedAt"] < CODE_TABLE_TTL:
+        return cached
+
+    code_table = {
+        "codes": {},
+        "profile": parse_capability_profile(None),
+        "loadedAt": time.monotonic(),
+    }
+    ir_ids = sorted(set(DYNAMIC_MODES.values()) | set(IR_CODE_MAP))
+    complete = True
 
     try:
-        # Query for each item with the specified deviceType and id
-        for ir_id, key in IR_CODE_MAP.items():
-            result[key] = get_ir_code_from_table(device_type, ir_id)
+        response = dynamodb.batch_get_item(
+            RequestItems={
+                "IrCodeTable": {
+                    "Keys": [{'deviceType': device_type, 'id': ir_id}
+                             for ir_id in ir_ids + [CAPABILITY_PROFILE_ID]],
+                }
+            }
+        )
+        for item in response.get("Responses", {}).get("IrCodeTable", []):
+            ir_id = int(item["id"])
+            if ir_id == CAPABILITY_PROFILE_ID:
+                code_table["profile"] = parse_capability_profile(item)
+            elif item.get("ir_code"):
+                code_table["codes"][ir_id] = item["ir_code"]
+
+        # Fall back to single reads for anything DynamoDB left unprocessed
+        unprocessed = response.get("UnprocessedKeys", {}).get(
+            "IrCodeTable", {}).get("Keys", [])
+        for key_item in unprocessed:
+            complete = False
+            ir_id = int(key_item["id"])
+            if ir_id != CAPABILITY_PROFILE_ID:
+                ir_code = get_ir_code_from_table(device_type, ir_id)
+                if ir_code:
+                    code_table["codes"][ir_id] = ir_code
     except Exception as e:
         logger.error(f"Failed to retrieve items from DynamoDB: {str(e)}")
+        complete = False
+
+    if complete:
+        code_tables[device_type] = code_table
+    return code_table
+
+
+def get_ir_code(code_table):
+    """
+    Get IR codes for RGB control.
+
+    Args:
+        code_table: Code table of the device type from load_code_table
 
+    Returns:
+        Dictionary of IR codes for RGB controls
+    """
+    result = DEFAULT_IR_RESULT.copy()
+    codes = code_table["codes"]
+    for ir_id, key in IR_CODE_MAP.items():
+        result[key] = codes.get(ir_id)
     return result
 
 
-def get_dynamic_mode(dynamic_mode, device_type):
+def get_dynamic_mode(dynamic_mode, code_table):
     """
     Get IR code for dynamic mode.
 
     Args:
         dynamic_mode: Dynamic mode name
-        device_type: Type of device
+        code_table: Code table of the device type from load_code_table
 
     Returns:
         Dictionary with IR codes for dynamic mode
@@ -148,34 +382,78 @@ def get_dynamic_mode(dynamic_mode, device_type):
     # Initialize result with default values
     result = DEFAULT_IR_RESULT.copy()
 
-    try:
-        # Check if dynamic_mode is None or empty
-        if not dynamic_mode:
-            logger.warning(
-                f"No dynamic mode specified, using default settings")
-            return result
+    # Check if dynamic_mode is None or empty
+    if not dynamic_mode:
+        logger.warning(
+            f"No dynamic mode specified, using default settings")
+        return result
+
+    dynamic_mode_id = DYNAMIC_MODES.get(dynamic_mode)
+    if dynamic_mode_id is None:
+        logger.error(f"Unknown dynamic mode: {dynamic_mode}")
+        return result
+
+    codes = code_table["codes"]
+    result["dynamic"] = codes.get(dynamic_mode_id)
+    result["power"] = codes.get(18)  # ID for power
+    result["enterDiy"] = codes.get(19)  # ID for enter DIY mode
+    return result
 
-        dynamic_mode_id = DYNAMIC_MODES.get(dynamic_mode)
-        if dynamic_mode_id is None:
-            logger.error(f"Unknown dynamic mode: {dynamic_mode}")
-            return result
 
-        # Get the dynamic mode IR code
-        result["dynamic"] = get_ir_code_from_table(
-            device_type, dynamic_mode_id)
+def build_code_set(code_table):
+    """
+    Build the full IR code set keyed by the names the firmware stores them under.
 
-        # Get the power IR code
-        result["power"] = get_ir_code_from_table(
-            device_type, 18)  # ID for power
+    Args:
+        code_table: Code table from load_code_table
 
-        # Get the DIY IR code
-        result["enterDiy"] = get_ir_code_from_table(
-            device_type, 19)  # ID for enter DIY mode
+    Returns:
+        Dictionary of firmware code name to IR code
+    """
+    code_set = {}
+    for mode, ir_id in DYNAMIC_MODES.items():
+        code_set[mode.lower()] = code_table["codes"].get(ir_id)
+    for ir_id, key in FIRMWARE_IR_KEYS.items():
+        code_set[key] = code_table["codes"].get(ir_id)
+    return code_set
 
-    except Exception as e:
-        logger.error(f"Failed to retrieve item from DynamoDB: {str(e)}")
 
-    return result
+def apply_code_sync(message, code_table, reported_version):
+    """
+    Strip IR codes the device already has from a message.
+
+    Devices that report a codeVersion on connect keep the code set in
+    memory. They receive the full set once when their version is stale and
+    only the command afterwards. Devices that report no version get the
+    legacy message with the codes inline.
+
+    Args:
+        message: Message dict from configure_light_settings
+        code_table: Code table from load_code_table
+        reported_version: Code set version reported by the device or None
+
+    Returns:
+        The code set version sent with the message, or None if no code set
+        was sent
+    """
+    if reported_version is None:
+        message.pop("mode", None)
+        return None
+
+    for key in LEGACY_CODE_KEYS:
+        message.pop(key, None)
+    if "mode" in message:
+        message.pop("rgbCode", None)
+
+    current_version = code_table["profile"]["codeVersion"]
+    if reported_version == current_version:
+        return None
+
+    logger.info(
+        f"Device code set v{reported_version} is stale, sending v{current_version}")
+    message["codes"] = build_code_set(code_table)
+    message["codeVersion"] = current_version
+    return current_version
 
 
 async def upload_response_s3(response, uuid, request_id):
@@ -202,7 +480,8 @@ async def upload_response_s3(response, uuid, request_id):
     file_name = f"responses/{uuid}/{request_id}.json"
 
     try:
-        s3_client.put_object(
+        await run_io(
+            s3_client.put_object,
             Body=response,
             Bucket=bucket_name,
             Key=file_name,
@@ -214,9 +493,80 @@ async def upload_response_s3(response, uuid, request_id):
         return None
 
 
-async def upload_response_dynamo(response, uuid, request_id):
+async def put_archive_batch(bucket_name, taken):
     """
-    Upload AI response to DynamoDB.
+    Write a batch taken from the archive writer to S3.
+
+    The batch is put back into the writer if the upload fails, so the next
+    invocation retries it.
+
+    Args:
+        bucket_name: S3 bucket name
+        taken: Batch returned by ArchiveWriter.take() or add()
+
+    Returns:
+        S3 key of the uploaded batch or None if failed
+    """
+    key, body, lines = taken
+    try:
+        await run_io(
+            s3_client.put_object,
+            Body=body,
+            Bucket=bucket_name,
+            Key=key,
+            ContentType='application/x-ndjson',
+            ContentEncoding='gzip'
+        )
+        logger.info(f"Archived {len(lines[0])} responses to {key}")
+        return key
+    except Exception as e:
+        dropped = archive_writer.restore(lines)
+        logger.error(f"Failed to upload archive batch to S3: {str(e)}")
+        if dropped:
+            logger.error(f"Archive backlog full, dropped {dropped} records")
+        return None
+
+
+async def archive_response(event, uuid, request_id):
+    """
+    Archive the AI response in S3 according to ARCHIVE_MODE.
+
+    Args:
+        event: Result event from the AI lambda
+        uuid: User identifier
+        request_id: Request identifier
+
+    Returns:
+        List of S3 keys written by this call
+    """
+    if ARCHIVE_MODE != 'batch':
+        key = await upload_response_s3(json.dumps(event), uuid, request_id)
+        return [key] if key else []
+
+    bucket_name = os.environ.get('BUCKET_NAME')
+    if not bucket_name:
+        logger.error("BUCKET_NAME environment variable not set")
+        return []
+
+    batches = []
+    previous = archive_writer.add(
+        build_archive_record(event, uuid, request_id))
+    if previous:
+        batches.append(previous)
+    if archive_writer.should_flush():
+        batches.append(archive_writer.take())
+
+    keys = []
+    for batch in batches:
+        key = await put_archive_batch(bucket_name, batch)
+        if key:
+            keys.append(key)
+    return keys
+
+
+def build_response_item(response, uuid, request_id):
+    """
+    Build the ResponseTable item of an AI response.
 
     Args:
         response: Parsed JSON with emotion and light settings
@@ -224,7 +574,7 @@ async def upload_response_dynamo(response, uuid, request_id):
         request_id: Request identifier
 
     Returns:
-        None
+        ResponseTable item
     """
     # Use client-provided timestamp if available
     day_of_week = None
@@ -269,18 +619,34 @@ async def upload_response_dynamo(response, uuid, request_id):
     light_settings = response["lightSetting"]
     context = response["context"]
 
+    # When using boto3 resource interface (Table), we don't need type annotations
+    return {
+        'uuid': uuid_key,
+        'requestId': request_id,
+        'TIME#DAY': day_time_key,
+        'emotionTag': emotion_tag,
+        'lightSetting': light_settings,
+        'context': context
+    }
+
+
+async def upload_response_dynamo(response, uuid, request_id):
+    """
+    Upload AI response to DynamoDB.
+
+    Args:
+        response: Parsed JSON with emotion and light settings
+        uuid: User/device identifier
+        request_id: Request identifier
+
+    Returns:
+        None
+    """
     try:
         # Store the data in DynamoDB - fix the item format
-        # When using boto3 resource interface (Table), we don't need type annotations
-        dynamodb.Table('ResponseTable').put_item(
-            Item={
-                'uuid': uuid_key,
-                'requestId': request_id,
-                'TIME#DAY': day_time_key,
-                'emotionTag': emotion_tag,
-                'lightSetting': light_settings,
-                'context': context
-            }
+        await run_io(
+            dynamodb.Table('ResponseTable').put_item,
+            Item=build_response_item(response, uuid, request_id)
         )
         logger.info(
             f"Successfully stored response in DynamoDB for UUID: {uuid}")
@@ -289,183 +655,1404 @@ async def upload_response_dynamo(response, uuid, request_id):
         raise
 
 
-async def get_connection_id(uuid):
+def parse_connection_item(item):
     """
-    Get WebSocket connection ID from DynamoDB.
+    Convert a ConnectionIdTable item into a connection dict.
 
     Args:
-        uuid: User identifier
+        item: DynamoDB item or None
 
     Returns:
-        Connection ID or None if not found
+        Connection dict as returned by get_connections, or None
     """
-    table = dynamodb.Table("ConnectionIdTable")
+    if not item or not item.get("connectionId"):
+        return None
+    code_version = item.get("codeVersion")
+    last_seen = item.get("lastSeen")
+    reported = item.get("reported")
+    return {
+        "connectionId": item["connectionId"],
+        "deviceId": item.get("deviceId", DEFAULT_DEVICE_ID),
+        "codeVersion": int(code_version) if code_version is not None else None,
+        "frameFormat": item.get("frameFormat", "json"),
+        "lastSeen": int(last_seen) if last_seen is not None else None,
+        "reported": parse_reported_state(reported) if reported else None,
+    }
+
+
+def parse_reported_state(reported):
+    """
+    Convert the device shadow of a connection row.
 
+    Args:
+        reported: "reported" map written by connection_manager
+
+    Returns:
+        {"power": bool, "rgb": [r, g, b], "dynamic": bool, "seq": int or
+        None, "at": int} or None if the map is malformed
+    """
     try:
-        response = table.get_item(Key={'uuid': uuid})
-        connection_id = response.get("Item", {}).get("connectionId")
-        if not connection_id:
-            logger.error(f"Connection ID not found for UUID: {uuid}")
-            return None
-        return connection_id
-    except Exception as e:
-        logger.error(f"Failed to retrieve item from DynamoDB: {str(e)}")
+        return {
+            "power": bool(reported["power"]),
+            "rgb": [int(value) for value in reported["rgb"]],
+            "dynamic": bool(reported.get("dynamic", False)),
+            "seq": int(reported["seq"]) if reported.get("seq") is not None else None,
+            "at": int(reported["at"]),
+        }
+    except (KeyError, TypeError, ValueError):
         return None
 
 
-async def send_data_to_arduino(connection_id, response):
+def confirmed_state(connection, last_seq, now=None):
     """
-    Send response data to Arduino via WebSocket.
+    Get the state a device reported, if it can be trusted for planning.
+
+    A report counts if it is at most PRESENCE_TIMEOUT seconds old and the
+    device had already applied the newest command stored for it, so no
+    command was still on its way. The firmware reports the low 32 bits of
+    that command's seq.
 
     Args:
-        connection_id: WebSocket connection ID
-        response: Response data
+        connection: Connection dict from parse_connection_item
+        last_seq: Sequence number of the newest command stored for the device
+        now: Epoch seconds (defaults to time.time())
 
     Returns:
-        API Gateway response
+        {"power": bool, "rgb": [r, g, b], "dynamic": bool} or None
+    """
+    reported = connection.get("reported")
+    if not reported:
+        return None
+    now = now if now is not None else time.time()
+    if now - reported["at"] > PRESENCE_TIMEOUT:
+        return None
+    if last_seq is not None:
+        if reported["seq"] is None:
+            return None
+        # Serial number arithmetic: applied if not behind last_seq
+        behind = ((last_seq & 0xFFFFFFFF) - reported["seq"]) & 0xFFFFFFFF
+        if 0 < behind < 0x80000000:
+            return None
+    return {key: reported[key] for key in ("power", "rgb", "dynamic")}
 
-    Raises:
-        ValueError: If required params missing
-        Exception: If sending fails
+
+def is_connection_stale(connection, now=None):
     """
-    websocket_url = os.environ.get('WEBSOCKET_URL')
-    if not websocket_url:
-        raise ValueError("WEBSOCKET_URL environment variable not set")
+    Check whether a connection missed its heartbeats.
 
-    if not connection_id:
-        raise ValueError("Connection ID cannot be empty")
+    Connections stored before heartbeats existed have no lastSeen and are
+    never stale.
 
-    try:
-        # Log the response being sent to Arduino
-        logger.info(f"Sending response to Arduino: {response}")
-
-        # Fix WebSocket URL format for the API Gateway client
-        # Extract the domain part without the stage
-        if websocket_url.startswith('wss://'):
-            # Remove wss:// and any path including stage
-            domain = websocket_url[6:].split('/', 1)[0]
-            endpoint_url = f'https://{domain}/develop'
-        elif websocket_url.startswith('https://'):
-            # Remove https:// and any path including stage
-            domain = websocket_url[8:].split('/', 1)[0]
-            endpoint_url = f'https://{domain}/develop'
-        else:
-            # Just extract the domain without any path/stage
-            domain = websocket_url.split('/', 1)[0]
-            endpoint_url = f'https://{domain}/develop'
+    Args:
+        connection: Connection dict from parse_connection_item
+        now: Epoch seconds (defaults to time.time())
 
-        logger.info(f"Using endpoint URL: {endpoint_url}")
-        apigateway_client = boto_session.client(
-            'apigatewaymanagementapi', endpoint_url=endpoint_url)
-        api_response = apigateway_client.post_to_connection(
-            ConnectionId=connection_id,
-            Data=response.encode('utf-8')
-        )
-        return api_response
-    except Exception as e:
-        logger.error(f"Failed to send data to Arduino: {str(e)}")
-        raise
+    Returns:
+        True if the last heartbeat is older than PRESENCE_TIMEOUT
+    """
+    if connection["lastSeen"] is None:
+        return False
+    now = now if now is not None else time.time()
+    return now - connection["lastSeen"] > PRESENCE_TIMEOUT
 
 
-async def main(event, context):
+def classify_delivery_error(error):
     """
-    Orchestrate response processing workflow.
+    Sort a failed delivery by how it should be handled.
 
-    Configures light settings, retrieves connection ID,
-    stores response, and sends to device.
+    Args:
+        error: Exception raised by send_data_to_arduino
+
+    Returns:
+        DELIVERY_GONE, DELIVERY_REJECTED or DELIVERY_RETRY
+    """
+    if isinstance(error, ValueError):
+        return DELIVERY_REJECTED
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        if code == "GoneException":
+            return DELIVERY_GONE
+        if code in REJECTED_ERROR_CODES:
+            return DELIVERY_REJECTED
+    return DELIVERY_RETRY
+
+
+def needs_retry(results):
+    """
+    Check whether a fan-out has to be retried.
+
+    Gone and rejected devices would fail again, so only deliveries that
+    may succeed later count.
 
     Args:
-        event: Lambda event with UUID, request ID and AI response
-        context: Lambda context
+        results: Results returned by fan_out_result
 
     Returns:
-        None
+        True if any device failed with a retryable error
     """
-    # Extract identifiers from the event
-    uuid = event.get("uuid")
-    request_id = event.get("request_id") or event.get(
-        "requestId")  # Check both formats
+    return any(isinstance(result, Exception) and
+               classify_delivery_error(result) == DELIVERY_RETRY
+               for result in results)
 
-    if not uuid or not request_id:
-        logger.error("Missing required fields: uuid or requestId")
-        return
+
+async def purge_connection(uuid, connection):
+    """
+    Remove the row of a connection that API Gateway reported as gone.
+
+    The delete is conditional on the connection ID, so a device that
+    reconnected meanwhile keeps its new row.
+
+    Args:
+        uuid: User identifier
+        connection: Connection dict of the gone connection
+
+    Returns:
+        None
+    """
+    table = dynamodb.Table("ConnectionIdTable")
 
     try:
-        # Set timeout for all tasks to avoid Lambda timeout
-        timeout = 5  # seconds
+        await run_io(
+            table.delete_item,
+            Key={'uuid': uuid, 'deviceId': connection["deviceId"]},
+            ConditionExpression="connectionId = :conn_id",
+            ExpressionAttributeValues={":conn_id": connection["connectionId"]}
+        )
+        logger.info(
+            f"Removed gone connection of UUID {uuid} device {connection['deviceId']}")
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            logger.error(f"Failed to remove gone connection: {str(e)}")
+    except Exception as e:
+        logger.error(f"Failed to remove gone connection: {str(e)}")
 
-        # Create tasks for concurrent execution
-        tasks = [
-            asyncio.create_task(configure_light_settings(event)),
-            asyncio.create_task(get_connection_id(uuid)),
-        ]
-
-        # Only upload to S3 and DynamoDB if we have a complete response
-        if event:
-            event_text = json.dumps(event)
-            try:
-                upload_s3_task = asyncio.create_task(
-                    upload_response_s3(event_text, uuid, request_id))
-                upload_dynamo_task = asyncio.create_task(
-                    upload_response_dynamo(event, uuid, request_id))
-                tasks.append(upload_s3_task)
-                tasks.append(upload_dynamo_task)
-            except Exception as e:
-                logger.error(f"Error setting up storage tasks: {str(e)}")
-        else:
-            # Add dummy tasks to maintain task indices
-            tasks.append(asyncio.create_task(asyncio.sleep(0)))
-            tasks.append(asyncio.create_task(asyncio.sleep(0)))
 
-        # Execute with timeout
-        done, pending = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.ALL_COMPLETED)
+def query_connections(uuid):
+    """
+    Read all ConnectionIdTable rows of a user.
 
-        # Cancel any pending tasks
-        for task in pending:
-            task.cancel()
+    Args:
+        uuid: User identifier
 
-        # Check if all tasks completed
-        if len(done) != len(tasks):
-            raise TimeoutError("Some tasks didn't complete in time")
+    Returns:
+        List of DynamoDB items
+    """
+    table = dynamodb.Table("ConnectionIdTable")
+    query = {"KeyConditionExpression": Key("uuid").eq(uuid)}
+    items = []
+    while True:
+        response = table.query(**query)
+        items.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return items
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
 
-        # Get results, handling exceptions
-        arduino_response = tasks[0].result()
-        connection_id = tasks[1].result()
 
-        # Validate connection_id and send data
-        if connection_id:
-            try:
-                await send_data_to_arduino(connection_id, arduino_response)
-                logger.info(
-                    "Successfully sent data to Arduino and saved response")
-            except Exception as e:
-                logger.error(f"Failed to send data to Arduino: {str(e)}")
-        else:
-            logger.error("No connection ID found for the device")
+def live_connections(uuid, items):
+    """
+    Parse the connection rows of a user, skipping stale connections.
 
-    except TimeoutError as e:
-        logger.error(f"Operation timed out: {str(e)}")
+    Args:
+        uuid: User identifier
+        items: ConnectionIdTable items of the user
+
+    Returns:
+        List of connection dicts
+    """
+    connections = []
+    for item in items:
+        connection = parse_connection_item(item)
+        if not connection:
+            continue
+        if is_connection_stale(connection):
+            logger.error(
+                f"Connection of UUID {uuid} device {connection['deviceId']} "
+                f"missed its heartbeats, skipping")
+            continue
+        connections.append(connection)
+    return connections
+
+
+async def get_connections(uuid):
+    """
+    Get the live WebSocket connections of a user from DynamoDB.
+
+    Args:
+        uuid: User identifier
 
+    Returns:
+        List of {"connectionId": str, "deviceId": str, "codeVersion": int or
+        None, "frameFormat": "json" or "binary", "lastSeen": int or None},
+        empty if none was found
+    """
+    try:
+        items = await run_io(query_connections, uuid)
     except Exception as e:
-        logger.error(f"Error in processing: {str(e)}")
-        # Consider adding more specific exception handling
+        logger.error(f"Failed to retrieve item from DynamoDB: {str(e)}")
+        return []
 
-    return None
+    connections = live_connections(uuid, items)
+    if not connections:
+        logger.error(f"Connection ID not found for UUID: {uuid}")
+    return connections
 
 
-def lambda_handler(event, context):
+async def save_code_version(uuid, device_id, connection_id, code_version):
     """
-    Process incoming events and orchestrate response workflow.
+    Record the code set version a connection was sent.
 
-    Parses event, runs async workflow, and returns API response.
+    The update is conditional on the connection ID so a reconnect that
+    reported its own version is not overwritten.
 
     Args:
-        event: Lambda event with response data
-        context: Lambda context
+        uuid: User identifier
+        device_id: Device identifier of the connection
+        connection_id: WebSocket connection ID the code set was sent to
+        code_version: Code set version that was sent
 
     Returns:
-        API Gateway response
+        None
+    """
+    table = dynamodb.Table("ConnectionIdTable")
+
+    try:
+        await run_io(
+            table.update_item,
+            Key={'uuid': uuid, 'deviceId': device_id},
+            UpdateExpression="SET codeVersion = :version",
+            ConditionExpression="connectionId = :conn_id",
+            ExpressionAttributeValues={
+                ":version": code_version,
+                ":conn_id": connection_id,
+            }
+        )
+    except Exception as e:
+        logger.error(f"Failed to store code version: {str(e)}")
+
+
+def parse_device_state_item(item):
     """
+    Convert a DeviceStateTable item into a device state.
+
+    Args:
+        item: DynamoDB item or None
+
+    Returns:
+        {"power": bool, "rgb": [r, g, b] or None, "dynamic": bool}, or None
+        if the item holds no state yet
+    """
+    if not item or "power" not in item:
+        return None
+    rgb = item.get("rgb")
+    return {
+        "power": bool(item.get("power", False)),
+        "rgb": [int(value) for value in rgb] if rgb is not None else None,
+        "dynamic": bool(item.get("dynamic", False)),
+    }
+
+
+def device_state_key(uuid, device_id):
+    """
+    Get the DeviceStateTable key of a user's device.
+
+    The default device keeps the plain UUID, so single-device users keep
+    their stored state.
+
+    Args:
+        uuid: User identifier
+        device_id: Device identifier of the connection
+
+    Returns:
+        deviceId key
+    """
+    if device_id == DEFAULT_DEVICE_ID:
+        return uuid
+    return f"{uuid}#{device_id}"
+
+
+def parse_last_seq(item):
+    """
+    Get the sequence number of the newest command stored for a device.
+
+    Args:
+        item: DeviceStateTable item or None
+
+    Returns:
+        Sequence number or None
+    """
+    if not item or item.get("lastSeq") is None:
+        return None
+    return int(item["lastSeq"])
+
+
+def get_event_seq(event):
+    """
+    Get the sequence number of a result event.
+
+    Args:
+        event: Result event from the AI lambda
+
+    Returns:
+        Sequence number or None for events without one
+    """
+    try:
+        return int(event["seq"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def result_order(event, sent_at=None):
+    """
+    Get the sort key that puts the newest of several results last.
+
+    A result with a sequence number is newer than one without, so a
+    sequenced command is never replaced by an unsequenced one. Ties are
+    broken by the hand-off time of the AI lambda, then by the time the
+    result was queued.
+
+    Args:
+        event: Result event from the AI lambda
+        sent_at: SentTimestamp of the queue message (optional)
+
+    Returns:
+        Tuple to sort by
+    """
+    seq = get_event_seq(event)
+    times = []
+    for value in (event.get("handoffAt"), sent_at):
+        try:
+            times.append(int(value or 0))
+        except (TypeError, ValueError):
+            times.append(0)
+    return (seq is not None, seq or 0, *times)
+
+
+def is_superseded(seq, last_seq):
+    """
+    Check whether a command is not newer than the last one for its device.
+
+    Args:
+        seq: Sequence number of the command or None
+        last_seq: Sequence number stored for the device or None
+
+    Returns:
+        True if the command should be dropped
+    """
+    return seq is not None and last_seq is not None and seq <= last_seq
+
+
+async def get_device_state(device_id):
+    """
+    Get the last known state of a device from DynamoDB.
+
+    Args:
+        device_id: Device identifier
+
+    Returns:
+        Tuple of ({"power": bool, "rgb": [r, g, b] or None, "dynamic": bool}
+        or None if the state is unknown, sequence number of the newest
+        command or None)
+    """
+    table = dynamodb.Table("DeviceStateTable")
+
+    try:
+        response = await run_io(table.get_item, Key={'deviceId': device_id})
+        item = response.get("Item")
+        return parse_device_state_item(item), parse_last_seq(item)
+    except Exception as e:
+        logger.error(f"Failed to retrieve device state: {str(e)}")
+        return None, None
+
+
+async def claim_sequence(device_id, seq):
+    """
+    Record a command as the newest one for its device.
+
+    Args:
+        device_id: Device identifier
+        seq: Sequence number of the command
+
+    Returns:
+        False if a newer command was already recorded, True otherwise
+    """
+    table = dynamodb.Table("DeviceStateTable")
+
+    try:
+        await run_io(
+            table.update_item,
+            Key={'deviceId': device_id},
+            UpdateExpression="SET lastSeq = :seq",
+            ConditionExpression="attribute_not_exists(lastSeq) OR lastSeq < :seq",
+            ExpressionAttributeValues={":seq": seq}
+        )
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        logger.error(f"Failed to claim sequence {seq}: {str(e)}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to claim sequence {seq}: {str(e)}")
+        return True
+
+
+async def coalesce_command(device_id, seq, deadline):
+    """
+    Wait for newer commands to the same device and drop this one if any came.
+
+    The command is recorded as the newest one, then COALESCE_WINDOW_MS later
+    the device row is read again. A command that arrived in the meantime has
+    replaced the sequence number and is delivered instead.
+
+    Args:
+        device_id: Device identifier
+        seq: Sequence number of the command
+        deadline: Deadline of the invocation
+
+    Returns:
+        True if the command is still the newest one and should be sent
+    """
+    if not await claim_sequence(device_id, seq):
+        return False
+
+    await asyncio.sleep(min(COALESCE_WINDOW_MS / 1000, deadline.remaining() / 2))
+
+    table = dynamodb.Table("DeviceStateTable")
+    try:
+        response = await run_io(
+            table.get_item, Key={'deviceId': device_id},
+            ProjectionExpression="lastSeq", ConsistentRead=True)
+    except Exception as e:
+        logger.error(f"Failed to re-read sequence of {device_id}: {str(e)}")
+        return True
+    last_seq = parse_last_seq(response.get("Item"))
+    return last_seq is None or last_seq <= seq
+
+
+def build_device_state_item(device_id, state, seq=None):
+    """
+    Build the DeviceStateTable item of a device state.
+
+    Args:
+        device_id: Device identifier
+        state: {"power": bool, "rgb": [r, g, b] or None, "dynamic": bool}
+        seq: Sequence number of the command that produced the state
+
+    Returns:
+        DeviceStateTable item
+    """
+    item = {
+        'deviceId': device_id,
+        'power': state["power"],
+        'rgb': state["rgb"],
+        'dynamic': state["dynamic"],
+        'updatedAt': Decimal(str(round(time.time(), 3))),
+    }
+    if seq is not None:
+        item['lastSeq'] = seq
+    return item
+
+
+async def save_device_state(device_id, state, seq=None):
+    """
+    Store the state a device was commanded into.
+
+    With a sequence number the write only succeeds if no newer command was
+    stored in the meantime, so a slow execution cannot overwrite the state
+    left by a faster, newer one.
+
+    Args:
+        device_id: Device identifier
+        state: {"power": bool, "rgb": [r, g, b] or None, "dynamic": bool}
+        seq: Sequence number of the command that produced the state
+
+    Returns:
+        None
+    """
+    table = dynamodb.Table("DeviceStateTable")
+    condition = {}
+    if seq is not None:
+        condition = {
+            "ConditionExpression": "attribute_not_exists(lastSeq) OR lastSeq <= :seq",
+            "ExpressionAttributeValues": {":seq": seq},
+        }
+
+    try:
+        await run_io(table.put_item, Item=build_device_state_item(device_id, state, seq),
+                     **condition)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            logger.info(f"Newer command already stored for {device_id}, keeping its state")
+        else:
+            logger.error(f"Failed to store device state: {str(e)}")
+    except Exception as e:
+        logger.error(f"Failed to store device state: {str(e)}")
+
+
+def apply_transition_plan(message, light_setting, device_state, profile):
+    """
+    Add the cheapest IR transition plan to a device message.
+
+    Args:
+        message: Message dict from configure_light_settings
+        light_setting: lightSetting from the AI response
+        device_state: Last known device state or None
+        profile: Capability profile of the device type
+
+    Returns:
+        The state the device will be in after executing the message
+    """
+    # Dynamic modes are a single IR code; the firmware powers on if needed
+    if not isinstance(message.get("rgbCode"), list):
+        state = resulting_state(device_state, [])
+        state.update(power=True, dynamic=True)
+        return state
+
+    target_state = {
+        "power": light_setting.get("power", True),
+        "rgb": message["rgbCode"],
+    }
+    steps, estimated_ms = plan_transition(
+        device_state, target_state, profile["presets"],
+        pulse_gap_ms=profile["minGapMs"], steps=profile["steps"])
+    message["plan"] = steps
+    logger.info(
+        f"Transition plan from {device_state} to {target_state}: {steps} (~{estimated_ms} ms)")
+    return resulting_state(device_state, steps)
+
+
+def get_endpoint_url(websocket_url):
+    """
+    Build the API Gateway Management endpoint URL from the WebSocket URL.
+
+    Args:
+        websocket_url: WebSocket URL (with or without scheme and stage)
+
+    Returns:
+        HTTPS endpoint URL for the apigatewaymanagementapi client
+    """
+    # Fix WebSocket URL format for the API Gateway client
+    # Extract the domain part without the stage
+    if websocket_url.startswith('wss://'):
+        # Remove wss:// and any path including stage
+        domain = websocket_url[6:].split('/', 1)[0]
+    elif websocket_url.startswith('https://'):
+        # Remove https:// and any path including stage
+        domain = websocket_url[8:].split('/', 1)[0]
+    else:
+        # Just extract the domain without any path/stage
+        domain = websocket_url.split('/', 1)[0]
+    return f'https://{domain}/develop'
+
+
+def get_apigateway_client(endpoint_url):
+    """
+    Get a cached API Gateway Management client for an endpoint.
+
+    Clients keep their connection pool alive between invocations of a warm
+    container, so only the first send pays for endpoint resolution and the
+    TLS handshake.
+
+    Args:
+        endpoint_url: HTTPS endpoint URL of the WebSocket stage
+
+    Returns:
+        boto3 apigatewaymanagementapi client
+    """
+    apigateway_client = apigateway_clients.get(endpoint_url)
+    if apigateway_client is None:
+        logger.info(f"Creating API Gateway client for: {endpoint_url}")
+        apigateway_client = boto_session.client(
+            'apigatewaymanagementapi', endpoint_url=endpoint_url,
+            config=websocket_config)
+        apigateway_clients[endpoint_url] = apigateway_client
+    return apigateway_client
+
+
+def preconnect_websocket_endpoint():
+    """
+    Open the pooled connection to the WebSocket endpoint ahead of time.
+
+    Issues a cheap get_connection for a placeholder id; the expected error
+    is ignored, the point is the established keep-alive connection.
+
+    Returns:
+        None
+    """
+    websocket_url = os.environ.get('WEBSOCKET_URL')
+    if not websocket_url:
+        return
+
+    try:
+        apigateway_client = get_apigateway_client(
+            get_endpoint_url(websocket_url))
+        apigateway_client.get_connection(ConnectionId='preconnect')
+    except Exception as e:
+        logger.info(f"WebSocket endpoint pre-connected: {str(e)}")
+
+
+def render_message(message, frame_format):
+    """
+    Serialize a device message in the format the connection negotiated.
+
+    Args:
+        message: Message dict
+        frame_format: "binary" for the compact frame, otherwise JSON
+
+    Returns:
+        Frame bytes or JSON string
+    """
+    if frame_format == "binary":
+        try:
+            return encode_frame(message)
+        except (ValueError, KeyError, struct.error) as e:
+            # The firmware accepts JSON on every connection
+            logger.warning(f"Falling back to JSON, cannot encode frame: {str(e)}")
+    return json.dumps(message)
+
+
+async def send_data_to_arduino(connection_id, response):
+    """
+    Send response data to Arduino via WebSocket.
+
+    Args:
+        connection_id: WebSocket connection ID
+        response: JSON string or binary frame
+
+    Returns:
+        API Gateway response
+
+    Raises:
+        ValueError: If required params missing
+        Exception: If sending fails
+    """
+    websocket_url = os.environ.get('WEBSOCKET_URL')
+    if not websocket_url:
+        raise ValueError("WEBSOCKET_URL environment variable not set")
+
+    if not connection_id:
+        raise ValueError("Connection ID cannot be empty")
+
+    try:
+        # Log the response being sent to Arduino
+        if isinstance(response, bytes):
+            logger.info(
+                f"Sending {len(response)} byte frame to Arduino: {response.hex()}")
+            data = response
+        else:
+            logger.info(f"Sending response to Arduino: {response}")
+            data = response.encode('utf-8')
+
+        apigateway_client = get_apigateway_client(
+            get_endpoint_url(websocket_url))
+        api_response = await run_io(
+            apigateway_client.post_to_connection,
+            ConnectionId=connection_id,
+            Data=data
+        )
+        return api_response
+    except Exception as e:
+        logger.error(f"Failed to send data to Arduino: {str(e)}")
+        raise
+
+
+async def deliver_result(event, message, code_table, connection, device_state,
+                         confirmed=False):
+    """
+    Plan, render and send one result to its device.
+
+    A device that confirmed through its own report that it is already in
+    the target state, and needs no code set, is not sent anything.
+
+    Args:
+        event: Result event from the AI lambda
+        message: Message dict from configure_light_settings
+        code_table: Code table from configure_light_settings
+        connection: Connection dict from get_connections
+        device_state: Last known device state or None
+        confirmed: Whether device_state comes from the device's own report
+
+    Returns:
+        Tuple of (device state after the message, code set version sent or None)
+
+    Raises:
+        Exception: If sending fails
+    """
+    # The device ignores commands older than the last one it applied
+    seq = get_event_seq(event)
+    if seq is not None:
+        message["seq"] = seq
+    # The device echoes the trace id in its next state report
+    if event.get("traceId"):
+        message["trace"] = event["traceId"]
+
+    # Replace the bare rgbCode walk with the cheapest transition plan
+    new_state = apply_transition_plan(
+        message, event["lightSetting"], device_state, code_table["profile"])
+    sent_version = apply_code_sync(
+        message, code_table, connection["codeVersion"])
+    if confirmed and message.get("plan") == [] and sent_version is None:
+        logger.info(
+            f"Device {connection['deviceId']} already in the target state, nothing to send")
+        return new_state, None
+    await send_data_to_arduino(
+        connection["connectionId"],
+        render_message(message, connection["frameFormat"]))
+    return new_state, sent_version
+
+
+async def deliver_to_device(event, message, code_table, uuid, connection, states,
+                            deadline=None):
+    """
+    Deliver a result to one device of a user unless a newer command won.
+
+    Args:
+        event: Result event from the AI lambda
+        message: Message dict from configure_light_settings (not modified)
+        code_table: Code table from configure_light_settings
+        uuid: User identifier
+        connection: Connection dict of the device
+        states: {state key: (device state, last seq)} of the user's devices
+        deadline: Deadline of the invocation; enables COALESCE_WINDOW_MS
+
+    Returns:
+        Tuple of (device state after the message, code set version sent or
+        None), or None if the command was dropped
+
+    Raises:
+        Exception: If sending fails
+    """
+    state_key = device_state_key(uuid, connection["deviceId"])
+    device_state, last_seq = states.get(state_key, (None, None))
+    seq = get_event_seq(event)
+
+    if is_superseded(seq, last_seq):
+        logger.info(f"Dropping command {seq} for {state_key}: not newer than {last_seq}")
+        return None
+    if (deadline is not None and COALESCE_WINDOW_MS > 0 and seq is not None and
+            not await coalesce_command(state_key, seq, deadline)):
+        logger.info(f"Dropping command {seq} for {state_key}: replaced by a newer command")
+        return None
+
+    # Plan from what the device reported if that reflects the newest command
+    reported_state = confirmed_state(connection, last_seq)
+    if reported_state:
+        device_state = reported_state
+
+    # Every device gets its own plan and code sync
+    return await deliver_result(
+        event, copy.deepcopy(message), code_table, connection, device_state,
+        confirmed=reported_state is not None)
+
+
+async def fan_out_result(event, message, code_table, uuid, connections, states,
+                         deadline=None):
+    """
+    Deliver a result to all devices of a user concurrently.
+
+    At most FANOUT_CONCURRENCY sends run at once and a failing device does
+    not affect the others. Failures are logged with their classification
+    from classify_delivery_error.
+
+    Args:
+        event: Result event from the AI lambda
+        message: Message dict from configure_light_settings
+        code_table: Code table from configure_light_settings
+        uuid: User identifier
+        connections: Live connection dicts of the user
+        states: {state key: (device state, last seq)} of the user's devices
+        deadline: Deadline of the invocation; enables COALESCE_WINDOW_MS
+
+    Returns:
+        List aligned with connections of deliver_to_device results, or the
+        exception a device failed with
+    """
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def deliver_one(connection):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return await deliver_to_device(
+                    event, message, code_table, uuid, connection, states, deadline)
+            finally:
+                metrics = current_metrics.get()
+                if metrics is not None:
+                    # A span per device, but no metric per device
+                    metrics.add_span(f"deliver:{connection['deviceId']}", started,
+                                     time.perf_counter(), metric=False)
+
+    results = await asyncio.gather(
+        *[deliver_one(connection) for connection in connections],
+        return_exceptions=True)
+    for connection, result in zip(connections, results):
+        if isinstance(result, Exception):
+            logger.error(
+                f"Failed to send data to device {connection['deviceId']} of UUID {uuid} "
+                f"({classify_delivery_error(result)}): {str(result)}")
+    return results
+
+
+def save_fan_out(uuid, connections, results, seq):
+    """
+    Build the writes that record what a fan-out sent.
+
+    Connections that turned out to be gone are removed, so later results
+    do not post to them again.
+
+    Args:
+        uuid: User identifier
+        connections: Connection dicts passed to fan_out_result
+        results: Results returned by fan_out_result
+        seq: Sequence number of the result or None
+
+    Returns:
+        List of coroutines storing device states and code set versions and
+        removing gone connections
+    """
+    writes = []
+    for connection, result in zip(connections, results):
+        if isinstance(result, Exception):
+            if classify_delivery_error(result) == DELIVERY_GONE:
+                writes.append(purge_connection(uuid, connection))
+            continue
+        if not result:
+            continue
+        new_state, sent_version = result
+        writes.append(save_device_state(
+            device_state_key(uuid, connection["deviceId"]), new_state, seq))
+        if sent_version is not None:
+            writes.append(save_code_version(
+                uuid, connection["deviceId"], connection["connectionId"], sent_version))
+    return writes
+
+
+def batch_get_items(table_name, key_name, keys):
+    """
+    Read items by their hash key with batch_get_item.
+
+    Args:
+        table_name: DynamoDB table name
+        key_name: Name of the hash key attribute
+        keys: Hash key values (duplicates are ignored)
+
+    Returns:
+        Dictionary of key value to item for the items found
+    """
+    items = {}
+    pending = [{key_name: key} for key in dict.fromkeys(keys)]
+    # batch_get_item reads at most 100 keys; retry what DynamoDB left unprocessed
+    for attempt in range(3):
+        unprocessed = []
+        for start in range(0, len(pending), 100):
+            response = dynamodb.batch_get_item(
+                RequestItems={table_name: {"Keys": pending[start:start + 100]}})
+            for item in response.get("Responses", {}).get(table_name, []):
+                items[item[key_name]] = item
+            unprocessed.extend(response.get("UnprocessedKeys", {}).get(
+                table_name, {}).get("Keys", []))
+        if not unprocessed:
+            break
+        pending = unprocessed
+        time.sleep(0.05 * (2 ** attempt))
+    else:
+        logger.error(f"{len(pending)} keys left unprocessed in {table_name}")
+    return items
+
+
+def write_items(table_name, items):
+    """
+    Write items with the table's batch_writer.
+
+    Args:
+        table_name: DynamoDB table name
+        items: Items to put
+
+    Returns:
+        None
+    """
+    with dynamodb.Table(table_name).batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+
+async def claim_request(request_id):
+    """
+    Claim a request in the idempotency store.
+
+    The store failing must not stop results from being delivered, so errors
+    count as a successful claim.
+
+    Args:
+        request_id: Request identifier
+
+    Returns:
+        False if the request was already processed, True otherwise
+    """
+    try:
+        return await run_io(idempotency_store.claim, request_id)
+    except Exception as e:
+        logger.error(f"Failed to claim request {request_id}: {str(e)}")
+        return True
+
+
+async def finish_request(request_id, failed):
+    """
+    Complete the claim of a processed request or release a failed one.
+
+    Args:
+        request_id: Request identifier
+        failed: Whether processing failed and a retry should run again
+
+    Returns:
+        None
+    """
+    try:
+        if failed:
+            await run_io(idempotency_store.release, request_id)
+        else:
+            await run_io(idempotency_store.complete, request_id)
+    except Exception as e:
+        logger.error(f"Failed to update claim of request {request_id}: {str(e)}")
+
+
+async def process_batch(records):
+    """
+    Process a batch of queued results.
+
+    The batch shares its lookups: the IR code table is loaded once per
+    deviceType, connections are queried per user, device states are read
+    with batch_get_item, and ResponseTable rows are written with
+    batch_writer. Results for different users are delivered concurrently,
+    each fanned out to all devices of its user. Of the results for the same
+    user only the newest one (see result_order) is sent; older ones
+    and results not newer than the last command stored for a device are
+    stored but not sent. Results whose requestId was already processed are
+    dropped without being stored or sent again.
+
+    Args:
+        records: SQS records whose body is a result event
+
+    Returns:
+        List of messageIds to retry
+    """
+    timings = {}
+    started = time.perf_counter()
+    metrics = StageMetrics("result_save_send")
+    current_metrics.set(metrics)
+
+    entries = []
+    sent_at = {}
+    for record in records:
+        try:
+            event = json.loads(record["body"])
+        except (KeyError, TypeError, json.JSONDecodeError):
+            logger.error(f"Dropping malformed queue message: {record.get('messageId')}")
+            continue
+        uuid = event.get("uuid")
+        request_id = event.get("request_id") or event.get("requestId")
+        if not uuid or not request_id or "lightSetting" not in event:
+            logger.error(
+                f"Dropping queue message without uuid, requestId or lightSetting: {record['messageId']}")
+            continue
+        entries.append((record["messageId"], event, uuid, request_id))
+        sent_at[record["messageId"]] = record.get("attributes", {}).get("SentTimestamp")
+
+    # Redelivered results, including repeats within this batch, lose the claim
+    claims = await asyncio.gather(
+        *[claim_request(request_id) for _, _, _, request_id in entries])
+    for (message_id, _, _, request_id), claimed in zip(entries, claims):
+        if not claimed:
+            logger.info(f"Skipping already processed request {request_id} ({message_id})")
+    entries = [entry for entry, claimed in zip(entries, claims) if claimed]
+    if not entries:
+        return []
+
+    # The batch record lists the traces of all its results
+    now_ms = epoch_ms()
+    metrics.set_property("traceIds", [event.get("traceId") or request_id
+                                      for _, event, _, request_id in entries])
+    for _, event, _, _ in entries:
+        if event.get("handoffAt"):
+            metrics.add_epoch_span("handoff_wait", event["handoffAt"], now_ms)
+
+    failures = set()
+
+    # Storage does not block delivery. Fallback results are delivered but not
+    # stored, so they never become history the model learns from.
+    stored = [entry for entry in entries if not entry[1].get("fallback")]
+    try:
+        response_items = [build_response_item(event, uuid, request_id)
+                          for _, event, uuid, request_id in stored]
+    except (KeyError, TypeError) as e:
+        logger.error(f"Failed to build ResponseTable items: {str(e)}")
+        response_items = []
+    storage_task = asyncio.create_task(timed(
+        "write_responses",
+        run_io(write_items, "ResponseTable", response_items,
+               timeout=IO_CALL_TIMEOUT * 3), timings))
+    archive_tasks = [asyncio.create_task(archive_response(event, uuid, request_id))
+                     for _, event, uuid, request_id in stored]
+
+    # One IR code table lookup per deviceType and one connection query per
+    # user, then one read for the states of all their devices
+    device_types = {event.get("deviceType", "light") for _, event, _, _ in entries}
+    uuids = list(dict.fromkeys(uuid for _, _, uuid, _ in entries))
+    lookups = await asyncio.gather(
+        timed("load_code_tables", asyncio.gather(
+            *[run_io(load_code_table, device_type) for device_type in device_types]), timings),
+        timed("get_connections", asyncio.gather(
+            *[run_io(query_connections, uuid) for uuid in uuids],
+            return_exceptions=True), timings),
+        return_exceptions=True)
+    connections_by_user = {}
+    if isinstance(lookups[0], Exception):
+        logger.error(f"Batch lookup failed: {str(lookups[0])}")
+        failures.update(message_id for message_id, _, _, _ in entries)
+    else:
+        for uuid, items in zip(uuids, lookups[1]):
+            if isinstance(items, Exception):
+                # Only this user's results are retried
+                logger.error(f"Failed to query connections of UUID {uuid}: {str(items)}")
+                failures.update(message_id for message_id, _, entry_uuid, _ in entries
+                                if entry_uuid == uuid)
+                continue
+            connections_by_user[uuid] = live_connections(uuid, items)
+
+    state_keys = [device_state_key(uuid, connection["deviceId"])
+                  for uuid, connections in connections_by_user.items()
+                  for connection in connections]
+    states = {}
+    if state_keys:
+        try:
+            state_items = await timed("get_device_states", run_io(
+                batch_get_items, "DeviceStateTable", "deviceId", state_keys), timings)
+            states = {key: (parse_device_state_item(state_items.get(key)),
+                            parse_last_seq(state_items.get(key)))
+                      for key in state_keys}
+        except Exception as e:
+            logger.error(f"Batch lookup failed: {str(e)}")
+            failures.update(message_id for message_id, _, _, _ in entries)
+            connections_by_user = {}
+
+    # Code tables are cached now, so this does no I/O
+    configs = await asyncio.gather(
+        *[configure_light_settings(event) for _, event, _, _ in entries],
+        return_exceptions=True)
+
+    by_user = {}
+    for entry, config in zip(entries, configs):
+        if isinstance(config, Exception):
+            logger.error(f"Failed to configure {entry[0]}: {str(config)}")
+            continue
+        if entry[2] in connections_by_user:
+            by_user.setdefault(entry[2], []).append((entry, config))
+
+    async def deliver_user(uuid, user_entries):
+        connections = connections_by_user[uuid]
+        if not connections:
+            logger.error(f"No connection ID found for UUID: {uuid}")
+            return []
+
+        # Latest wins: the newest result replaces the others of the batch
+        (message_id, event, _, _), (message, code_table) = sorted(
+            user_entries,
+            key=lambda pair: result_order(pair[0][1], sent_at[pair[0][0]]))[-1]
+        if len(user_entries) > 1:
+            logger.info(
+                f"Collapsed {len(user_entries)} results for UUID {uuid} into {message_id}")
+        results = await fan_out_result(
+            event, message, code_table, uuid, connections, states)
+        if needs_retry(results):
+            failures.add(message_id)
+        return save_fan_out(uuid, connections, results, get_event_seq(event))
+
+    if by_user:
+        writes = await timed("deliver", asyncio.gather(
+            *[deliver_user(uuid, user_entries) for uuid, user_entries in by_user.items()]),
+            timings)
+        timings["delivery_total"] = round((time.perf_counter() - started) * 1000, 1)
+
+        # State writes are conditional on seq, so they cannot be batched
+        try:
+            await timed("save_device_states", asyncio.gather(
+                *[write for user_writes in writes for write in user_writes]), timings)
+        except Exception as e:
+            logger.error(f"Failed to store device states: {str(e)}")
+
+    # A result is only done once its ResponseTable row is written
+    try:
+        await storage_task
+    except Exception as e:
+        logger.error(f"Failed to store responses in DynamoDB: {str(e)}")
+        failures.update(message_id for message_id, _, _, _ in entries)
+    await asyncio.gather(*archive_tasks, return_exceptions=True)
+
+    # Failed results are released so their redelivery is processed again
+    await asyncio.gather(*[finish_request(request_id, message_id in failures)
+                           for message_id, _, _, request_id in entries])
+
+    timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(
+        f"Processed batch of {len(entries)} results, {len(failures)} failed. "
+        f"Task timings (ms): {json.dumps(timings)}")
+    metrics.put_timings(timings)
+    metrics.count("batch_size", len(entries))
+    metrics.count("failed_results", len(failures))
+    metrics.flush()
+    return sorted(failures)
+
+
+async def main(event, context):
+    """
+    Orchestrate response processing workflow.
+
+    Configures light settings, retrieves connection ID,
+    stores response, and sends to device. Storage runs concurrently with
+    delivery, so the device is reached as soon as the settings and the
+    connection ID are ready. A request that was already processed, e.g. by
+    an earlier delivery of the same async invocation, is skipped, and a
+    command that is older than the last one for the device, or replaced by
+    a newer one within COALESCE_WINDOW_MS, is stored but not sent.
+
+    Args:
+        event: Lambda event with UUID, request ID and AI response
+        context: Lambda context
+
+    Returns:
+        None
+
+    Raises:
+        ResultDeliveryError: If the result failed; its claim is released
+            first, so the async-invoke retry processes it again
+    """
+    # Extract identifiers from the event
+    uuid = event.get("uuid")
+    request_id = event.get("request_id") or event.get(
+        "requestId")  # Check both formats
+
+    if not uuid or not request_id:
+        logger.error("Missing required fields: uuid or requestId")
+        return
+
+    if not await claim_request(request_id):
+        logger.info(f"Skipping already processed request {request_id}")
+        return
+
+    # Per-task durations in milliseconds
+    timings = {}
+    started = time.perf_counter()
+
+    # One trace id follows the request from the API call to the device
+    metrics = StageMetrics("result_save_send")
+    metrics.set_property("requestId", request_id)
+    metrics.set_property("traceId", event.get("traceId") or request_id)
+    current_metrics.set(metrics)
+    if event.get("handoffAt"):
+        # Time in the async invoke queue, as far as the clocks agree
+        metrics.add_epoch_span("handoff_wait", event["handoffAt"], epoch_ms())
+
+    # Bound all tasks by the Lambda's remaining time to avoid its timeout
+    deadline = Deadline.from_context(
+        context, reserve_ms=DEADLINE_RESERVE_MS, budget_ms=RESULT_BUDGET_MS)
+
+    storage_tasks = []
+    failed = False
+    try:
+        # Create tasks for concurrent execution
+        config_task = asyncio.create_task(timed(
+            "configure_light_settings", configure_light_settings(event), timings))
+        connection_task = asyncio.create_task(timed(
+            "get_connections", get_connections(uuid), timings))
+        # Most users drive a single device, so its state is read right away;
+        # other devices are read once their connections are known
+        default_key = device_state_key(uuid, DEFAULT_DEVICE_ID)
+        state_task = asyncio.create_task(timed(
+            "get_device_state", get_device_state(default_key), timings))
+
+        # Only upload to S3 and DynamoDB if we have a complete response;
+        # fallback results are not history the model should learn from
+        if event and not event.get("fallback"):
+            try:
+                storage_tasks.append(asyncio.create_task(timed(
+                    "archive_response",
+                    archive_response(event, uuid, request_id), timings)))
+                storage_tasks.append(asyncio.create_task(timed(
+                    "upload_response_dynamo",
+                    upload_response_dynamo(event, uuid, request_id), timings)))
+            except Exception as e:
+                logger.error(f"Error setting up storage tasks: {str(e)}")
+
+        # Delivery only depends on the settings, the connections and the
+        # last known device states
+        done, pending = await asyncio.wait(
+            [config_task, connection_task, state_task], timeout=deadline.remaining(),
+            return_when=asyncio.ALL_COMPLETED)
+
+        # Cancel any pending tasks
+        for task in pending:
+            task.cancel()
+
+        # Check if all tasks completed
+        if pending:
+            raise TimeoutError("Some tasks didn't complete in time")
+
+        # Get results, handling exceptions
+        message, code_table = config_task.result()
+        connections = connection_task.result()
+        states = {default_key: state_task.result()}
+        other_keys = [device_state_key(uuid, connection["deviceId"])
+                      for connection in connections
+                      if connection["deviceId"] != DEFAULT_DEVICE_ID]
+        if other_keys:
+            items = await timed("get_device_states", run_io(
+                batch_get_items, "DeviceStateTable", "deviceId", other_keys), timings)
+            for key in other_keys:
+                states[key] = (parse_device_state_item(items.get(key)),
+                               parse_last_seq(items.get(key)))
+
+        # Validate connections and send data
+        if connections and deadline.expired():
+            logger.error("No time left to send data to Arduino")
+            failed = True
+        elif connections:
+            results = await timed(
+                "send_data_to_arduino",
+                fan_out_result(event, message, code_table, uuid, connections, states,
+                               deadline),
+                timings)
+            timings["delivery_total"] = round(
+                (time.perf_counter() - started) * 1000, 1)
+            failed = needs_retry(results)
+            sent = [result for result in results
+                    if result and not isinstance(result, Exception)]
+            logger.info(f"Sent data to {len(sent)} of {len(connections)} devices")
+            writes = save_fan_out(uuid, connections, results, get_event_seq(event))
+            if writes:
+                storage_tasks.append(asyncio.create_task(timed(
+                    "save_device_state", asyncio.gather(*writes), timings)))
+        else:
+            logger.error("No connection ID found for the device")
+
+    except TimeoutError as e:
+        logger.error(f"Operation timed out: {str(e)}")
+        failed = True
+
+    except Exception as e:
+        logger.error(f"Error in processing: {str(e)}")
+        failed = True
+
+    # Let storage finish within what is left of the deadline
+    if storage_tasks:
+        done, pending = await asyncio.wait(
+            storage_tasks, timeout=deadline.remaining())
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception():
+                logger.error(
+                    f"Failed to save response: {str(task.exception())}")
+                failed = True
+        if pending:
+            logger.error("Storage tasks didn't complete in time")
+            failed = True
+
+    await finish_request(request_id, failed)
+
+    timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Task timings (ms): {json.dumps(timings)}")
+    metrics.put_timings(timings)
+    metrics.count("failed_results", int(failed))
+    metrics.flush()
+
+    if failed:
+        raise ResultDeliveryError(f"Failed to process request {request_id}")
+    return None
+
+
+# Scheduled warm-ups open the delivery connection (the "websocket" step of
+# warmup_steps). Opening it during init as well is opt-in: an unreachable
+# endpoint would add its connect timeout to every cold start.
+if os.environ.get('PRECONNECT_WEBSOCKET', 'false').lower() == 'true':
+    preconnect_websocket_endpoint()
+
+
+def warmup_steps():
+    """
+    Steps that prime a new container for its first result.
+
+    Returns:
+        List of (name, callable) for warm_up
+    """
+    steps = [(f"ir_codes:{device_type}", functools.partial(load_code_table, device_type))
+             for device_type in WARMUP_DEVICE_TYPES]
+    steps.extend([
+        ("connections", lambda: query_connections(WARMUP_ID)),
+        ("device_states", lambda: dynamodb.Table("DeviceStateTable").get_item(
+            Key={'deviceId': WARMUP_ID})),
+        ("websocket", preconnect_websocket_endpoint),
+    ])
+    bucket_name = os.environ.get('BUCKET_NAME')
+    if bucket_name:
+        steps.append(("s3", lambda: s3_client.head_object(
+            Bucket=bucket_name, Key=WARMUP_ID)))
+    return steps
+
+
+def sqs_handler(event, context):
+    """
+    Consume a batch of results from the result queue.
+
+    Args:
+        event: SQS event with up to the configured batch size of records
+        context: Lambda context
+
+    Returns:
+        Partial batch response listing the messages to retry
+    """
+    records = event.get("Records", [])
+    deadline = Deadline.from_context(context, reserve_ms=DEADLINE_RESERVE_MS)
+
+    loop = asyncio.get_event_loop()
+    try:
+        failures = loop.run_until_complete(asyncio.wait_for(
+            process_batch(records), timeout=deadline.remaining()))
+    except asyncio.TimeoutError:
+        # Nothing is known about the unfinished records; let SQS retry all
+        logger.error(f"Batch of {len(records)} records did not finish in time")
+        failures = sorted(record["messageId"] for record in records)
+    return {
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]
+    }
+
+
+@profiled("result_save_send")
+def lambda_handler(event, context):
+    """
+    Process incoming events and orchestrate response workflow.
+
+    Parses event, runs async workflow, and returns API response. Batches
+    from the result queue are handed to sqs_handler.
+
+    Args:
+        event: Lambda event with response data
+        context: Lambda context
+
+    Returns:
+        API Gateway response
+
+    Raises:
+        ResultDeliveryError: If a directly invoked result failed, so the
+            async invocation is retried
+    """
+    # Scheduled warm-ups prime the container instead of processing a result
+    if is_warmup(event):
+        return warm_up("result_save_send", warmup_steps())
+
+    records = event.get("Records")
+    if records and records[0].get("eventSource") == "aws:sqs":
+        return sqs_handler(event, context)
+
     # Process the event if it's coming from API Gateway
     if 'body' in event:
         try:
@@ -483,9 +2070,10 @@ def lambda_handler(event, context):
                 'body': json.dumps("Invalid request body format")
             }
 
-    # Create an event loop
+    # Create an event loop; a failed result raises out of the handler so
+    # the async invocation is retried
     loop = asyncio.get_event_loop()
-    result = loop.run_until_complete(main(event, context))
+    loop.run_until_complete(main(event, context))
 
     # Return a formatted response for API Gateway
     return {
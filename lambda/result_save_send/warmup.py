@@ -0,0 +1,67 @@
+"""
+Warm-up invocations.
+
+A scheduled EventBridge rule invokes the functions with {"warmup": true}.
+Handlers answer it with warm_up() before any request parsing. Each step
+primes something the first request of a new container would otherwise pay
+for: a DynamoDB, Lambda, S3 or Gemini connection, the botocore model of an
+operation, a cached IR code table or model config.
+
+    if is_warmup(event):
+        return warm_up("audio_to_ai", [
+            ("model_config", get_model_config),
+            ("auth_table", lambda: auth_table.get_item(Key=...)),
+        ])
+
+Lookups use placeholder keys. Their errors are logged and ignored: a
+rejected or empty lookup still leaves the keep-alive connection open.
+"""
+import json
+import logging
+import time
+
+logger = logging.getLogger()
+
+WARMUP_KEY = 'warmup'
+# Key of the placeholder items warm-up lookups ask for
+WARMUP_ID = '__warmup__'
+
+
+def is_warmup(event):
+    """
+    Check whether an event is a warm-up.
+
+    Args:
+        event: Lambda event
+
+    Returns:
+        True for {"warmup": true}
+    """
+    return isinstance(event, dict) and event.get(WARMUP_KEY) is True
+
+
+def warm_up(function, steps):
+    """
+    Run the warm-up steps of a function and time each of them.
+
+    Args:
+        function: Function name for the log
+        steps: List of (name, callable without arguments)
+
+    Returns:
+        Response with the duration of each step in milliseconds
+    """
+    timings = {}
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.info(f"Warm-up step {name} of {function}: {str(e)}")
+        timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    logger.info(f"Warm-up of {function} timings (ms): {json.dumps(timings)}")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'warmup': True, 'timings': timings})
+    }
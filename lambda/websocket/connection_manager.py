@@ -1,7 +1,13 @@
 from boto3.session import Session
+from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
 import logging
 import json
 import os
+import time
+from metrics import StageMetrics, NO_METRICS
+from profiling import profiled
+from warmup import is_warmup, warm_up, WARMUP_ID
 
 # Initialize AWS resources with explicit region
 # Default to us-east-1 if not specified
@@ -9,23 +15,96 @@ region = os.environ.get('AWS_REGION', 'us-east-1')
 session = Session(region_name=region)
 dynamodb = session.resource('dynamodb')
 table = dynamodb.Table(os.environ.get('CONNECTION_TABLE', 'ConnectionIdTable'))
+# GSI keyed by connectionId, so a disconnect finds its uuid without a scan
+CONNECTION_INDEX = os.environ.get('CONNECTION_INDEX', 'connectionId-index')
+# Heartbeats refresh lastSeen; rows of devices that stopped sending them are
+# removed by the expiresAt TTL this many seconds after the last one
+CONNECTION_TTL = int(os.environ.get('CONNECTION_TTL', '3600'))
+# The scheduled sweep deletes rows without a heartbeat for this many seconds,
+# the same limit after which result_save_send stops posting to them
+PRESENCE_TIMEOUT = int(os.environ.get('PRESENCE_TIMEOUT', '90'))
+# BatchExecuteStatement takes at most 25 statements
+SWEEP_BATCH_SIZE = 25
+# Stage metric of each route
+ROUTE_STAGES = {
+    '$connect': 'connect',
+    '$disconnect': 'disconnect',
+    '$default': 'message',
+    'MESSAGE': 'message',
+}
+# Each device of a user has its own row, keyed by its MAC address; devices
+# that connect without one share this id
+DEFAULT_DEVICE_ID = 'default'
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+def get_device_id(params):
+    """Device id from the mac parameter of the connect URL or a device message"""
+    device_id = (params.get('mac') or '').strip().upper()
+    return device_id or DEFAULT_DEVICE_ID
+
+
+def parse_report(body, now):
+    """Device state reported in a message, or None if it carries none"""
+    state = body.get('state')
+    rgb = body.get('rgb')
+    if state not in ('on', 'off') or not isinstance(rgb, list) or len(rgb) != 3:
+        return None
+    try:
+        report = {
+            'power': state == 'on',
+            'rgb': [min(max(int(value), 0), 255) for value in rgb],
+            'dynamic': bool(body.get('dynamic', False)),
+            'at': now,
+        }
+        # Low 32 bits of the seq of the last command the device applied
+        if body.get('seq') is not None:
+            report['seq'] = int(body['seq'])
+    except (TypeError, ValueError):
+        raise ValueError("state report has invalid values")
+    return report
+
+
 def on_connect(event, context):
     """Handle $connect WebSocket event"""
     try:
         connection_id = event['requestContext']['connectionId']
 
         # Get UUID from query parameters
-        uuid = event.get('queryStringParameters', {}).get('uuid')
+        query_params = event.get('queryStringParameters') or {}
+        uuid = query_params.get('uuid')
         if not uuid:
             raise ValueError("uuid is missing")
 
+        now = int(time.time())
+        item = {
+            'uuid': uuid,
+            'deviceId': get_device_id(query_params),
+            'connectionId': connection_id,
+            'lastSeen': now,
+            'expiresAt': now + CONNECTION_TTL,
+        }
+
+        # Firmware that keeps the IR code set reports its version so only
+        # stale devices are sent the full set
+        code_version = query_params.get('codeVersion')
+        if code_version is not None:
+            try:
+                item['codeVersion'] = int(code_version)
+            except ValueError:
+                raise ValueError("codeVersion must be an integer")
+
+        # Firmware that parses the compact binary frame opts in with frame=binary
+        frame_format = query_params.get('frame', 'json')
+        if frame_format not in ('json', 'binary'):
+            raise ValueError("frame must be 'json' or 'binary'")
+        if frame_format == 'binary':
+            item['frameFormat'] = frame_format
+
         # Store connection mapping in DynamoDB
-        table.put_item(Item={'uuid': uuid, 'connectionId': connection_id})
+        table.put_item(Item=item)
 
         return {
             'statusCode': 200,
@@ -54,17 +133,24 @@ def on_disconnect(event, context):
     try:
         connection_id = event['requestContext']['connectionId']
 
-        # Query to find the item with this connection_id
-        response = table.scan(
-            FilterExpression="connectionId = :conn_id",
-            ExpressionAttributeValues={":conn_id": connection_id}
+        # Look up the uuid of this connection in the reverse index
+        response = table.query(
+            IndexName=CONNECTION_INDEX,
+            KeyConditionExpression=Key('connectionId').eq(connection_id)
         )
 
-        items = response.get('Items', [])
-        if items:
-            # Delete the item using its primary key (uuid)
-            for item in items:
-                table.delete_item(Key={'uuid': item['uuid']})
+        for item in response.get('Items', []):
+            # Only delete the mapping if the device has not reconnected since
+            try:
+                table.delete_item(
+                    Key={'uuid': item['uuid'], 'deviceId': item['deviceId']},
+                    ConditionExpression="connectionId = :conn_id",
+                    ExpressionAttributeValues={":conn_id": connection_id}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                logger.info(f"Connection of {item['uuid']} was replaced, keeping it")
 
         return {
             'statusCode': 200,
@@ -80,14 +166,186 @@ def on_disconnect(event, context):
         }
 
 
+def on_message(event, context, metrics=NO_METRICS):
+    """
+    Handle device messages on $default.
+
+    Every message counts as a heartbeat. State reports are stored on the
+    connection row as the device shadow ('reported'), in the same write.
+    The first report after a command echoes its trace id, which ends the
+    command's trace.
+    """
+    try:
+        connection_id = event['requestContext']['connectionId']
+
+        body = json.loads(event.get('body') or '{}')
+        if not isinstance(body, dict):
+            raise ValueError("message must be a JSON object")
+        uuid = body.get('uuid')
+        if not uuid:
+            raise ValueError("uuid is missing")
+        trace = body.get('trace')
+        if isinstance(trace, str) and trace:
+            metrics.set_property('traceId', trace[:32])
+
+        now = int(time.time())
+        update = "SET lastSeen = :now, expiresAt = :expires"
+        values = {
+            ":now": now,
+            ":expires": now + CONNECTION_TTL,
+            ":conn_id": connection_id,
+        }
+        report = parse_report(body, now)
+        if report:
+            update += ", reported = :reported"
+            values[":reported"] = report
+
+        # Only the device's current connection may refresh its presence
+        table.update_item(
+            Key={'uuid': uuid, 'deviceId': get_device_id(body)},
+            UpdateExpression=update,
+            ConditionExpression="connectionId = :conn_id",
+            ExpressionAttributeValues=values
+        )
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'message': 'heartbeat received'})
+        }
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'wrong input',
+                'message': str(e)
+            })
+        }
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return {
+                'statusCode': 410,
+                'body': json.dumps({'message': 'connection is not registered'})
+            }
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                'error': 'failed to update in dynamodb',
+                'message': str(e)
+            })
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                'error': 'failed to update in dynamodb',
+                'message': str(e)
+            })
+        }
+
+
+def delete_stale_rows(rows, cutoff):
+    """
+    Delete connection rows in one batch, each only if still stale.
+
+    BatchWriteItem cannot carry conditions, so the deletes are PartiQL
+    statements whose WHERE clause repeats the lastSeen check; a device that
+    sent a heartbeat or reconnected since the scan keeps its row.
+
+    Returns:
+        Number of deleted rows
+    """
+    statement = (f'DELETE FROM "{table.name}" '
+                 'WHERE "uuid" = ? AND "deviceId" = ? AND "lastSeen" < ?')
+    response = dynamodb.meta.client.batch_execute_statement(Statements=[
+        {
+            'Statement': statement,
+            'Parameters': [
+                {'S': row['uuid']},
+                {'S': row['deviceId']},
+                {'N': str(cutoff)},
+            ],
+        }
+        for row in rows
+    ])
+
+    deleted = 0
+    for row, result in zip(rows, response.get('Responses', [])):
+        error = result.get('Error')
+        if not error:
+            deleted += 1
+        elif error.get('Code') != 'ConditionalCheckFailed':
+            # Left for the next sweep
+            logger.error(f"Failed to delete connection of {row['uuid']}: {error.get('Message')}")
+    return deleted
+
+
+def sweep_connections(event, context):
+    """Handle the scheduled sweep: delete rows whose heartbeats expired"""
+    cutoff = int(time.time()) - PRESENCE_TIMEOUT
+    scan = {
+        'FilterExpression': Attr('lastSeen').lt(cutoff),
+        'ProjectionExpression': '#uuid, deviceId',
+        'ExpressionAttributeNames': {'#uuid': 'uuid'},
+    }
+
+    stale = 0
+    deleted = 0
+    while True:
+        response = table.scan(**scan)
+        rows = response.get('Items', [])
+        stale += len(rows)
+        for start in range(0, len(rows), SWEEP_BATCH_SIZE):
+            deleted += delete_stale_rows(rows[start:start + SWEEP_BATCH_SIZE], cutoff)
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    logger.info(f"Swept {deleted} of {stale} stale connections")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'message': 'connections swept', 'deleted': deleted})
+    }
+
+
+@profiled('ws_messenger')
 def lambda_handler(event, context):
-    """Main handler that routes to the appropriate function"""
+    """Main handler: routes the event and emits its latency as an EMF record"""
+    # Scheduled warm-ups prime the DynamoDB connection instead of routing
+    if is_warmup(event):
+        return warm_up('ws_messenger', [
+            ('connection_table', lambda: table.get_item(
+                Key={'uuid': WARMUP_ID, 'deviceId': DEFAULT_DEVICE_ID})),
+        ])
+
+    if event.get('source') == 'aws.events':
+        stage = 'sweep'
+    else:
+        stage = ROUTE_STAGES.get(event['requestContext'].get('routeKey'), 'unsupported')
+
+    metrics = StageMetrics('ws_messenger')
+    try:
+        with metrics.stage(stage):
+            response = route_event(event, context, metrics)
+        metrics.set_property('statusCode', response['statusCode'])
+        return response
+    finally:
+        metrics.flush()
+
+
+def route_event(event, context, metrics=NO_METRICS):
+    """Route an event to the appropriate function"""
+    # The EventBridge schedule has no requestContext
+    if event.get('source') == 'aws.events':
+        return sweep_connections(event, context)
+
     route_key = event['requestContext'].get('routeKey')
 
     if route_key == '$connect':
         return on_connect(event, context)
     elif route_key == '$disconnect':
         return on_disconnect(event, context)
+    elif route_key in ('$default', 'MESSAGE'):
+        return on_message(event, context, metrics)
     else:
         return {
             'statusCode': 400,
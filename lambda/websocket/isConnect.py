@@ -1,6 +1,12 @@
 import boto3.session
+from boto3.dynamodb.conditions import Key
 import logging
 import json
+import os
+import time
+from metrics import StageMetrics, NO_METRICS
+from profiling import profiled
+from warmup import is_warmup, warm_up, WARMUP_ID
 
 # Initialize just the DynamoDB resource with minimal imports
 session = boto3.session.Session()
@@ -10,8 +16,86 @@ table = dynamodb.Table('ConnectionIdTable')
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# A device counts as connected while its last heartbeat is at most
+# PRESENCE_TIMEOUT seconds old (the firmware sends one every 30 seconds)
+PRESENCE_TIMEOUT = int(os.environ.get('PRESENCE_TIMEOUT', '90'))
 
+# Lookups are cached per container for PRESENCE_CACHE_TTL seconds, so app
+# polls do not each read ConnectionIdTable
+PRESENCE_CACHE_TTL = float(os.environ.get('PRESENCE_CACHE_TTL', '10'))
+presence_cache = {}
+
+
+def get_presence(uuid, metrics=NO_METRICS):
+    """
+    Get the last heartbeats of a user's devices, from the cache if recent enough.
+
+    Args:
+        uuid: User UUID
+        metrics: StageMetrics recording presence_query and cache_hits (optional)
+
+    Returns:
+        List with the last heartbeat (epoch seconds or None) of every device
+        that has a connection row
+    """
+    now = time.time()
+    cached = presence_cache.get(uuid)
+    if cached and now - cached[0] < PRESENCE_CACHE_TTL:
+        metrics.count("cache_hits")
+        return cached[1]
+
+    with metrics.stage("presence_query"):
+        response = table.query(
+            KeyConditionExpression=Key('uuid').eq(uuid),
+            ProjectionExpression='connectionId, lastSeen'
+        )
+    last_seen = [int(item['lastSeen']) if item.get('lastSeen') is not None else None
+                 for item in response.get('Items', []) if 'connectionId' in item]
+    presence_cache[uuid] = (now, last_seen)
+    return last_seen
+
+
+def is_present(last_seen, now=None):
+    """
+    Decide whether a device is connected.
+
+    Rows written before heartbeats existed have no lastSeen and count as
+    connected, like before.
+
+    Args:
+        last_seen: Last heartbeat in epoch seconds or None
+        now: Epoch seconds (defaults to time.time())
+
+    Returns:
+        True if the device is connected
+    """
+    if last_seen is None:
+        return True
+    now = now if now is not None else time.time()
+    return now - last_seen <= PRESENCE_TIMEOUT
+
+
+@profiled("isConnect")
 def lambda_handler(event, context):
+    """Answer a connection status request and emit its latency as an EMF record"""
+    # Scheduled warm-ups prime the DynamoDB connection instead of a lookup
+    if is_warmup(event):
+        return warm_up("isConnect", [
+            ("connection_table", lambda: table.query(
+                KeyConditionExpression=Key('uuid').eq(WARMUP_ID), Limit=1)),
+        ])
+
+    metrics = StageMetrics("isConnect")
+    try:
+        with metrics.stage("total"):
+            response = check_connection(event, metrics)
+        metrics.set_property("statusCode", response["statusCode"])
+        return response
+    finally:
+        metrics.flush()
+
+
+def check_connection(event, metrics):
     # Add CORS headers to all responses
     headers = {
         'Access-Control-Allow-Origin': '*',
@@ -53,16 +137,20 @@ def lambda_handler(event, context):
         }
 
     try:
-        # Correct way to query an item from DynamoDB
-        response = table.get_item(Key={'uuid': uuid})
+        devices = get_presence(uuid, metrics)
+        known = [seen for seen in devices if seen is not None]
+        last_seen = max(known) if known else None
 
-        # Check if the item exists and has a connectionId
-        if 'Item' in response and 'connectionId' in response['Item']:
+        # Connected if any device has a fresh connection row
+        present = sum(1 for seen in devices if is_present(seen))
+        if present:
             return {
                 'statusCode': 200,
                 'headers': headers,
                 'body': json.dumps({
                     'connected': True,
+                    'devices': present,
+                    'lastSeen': last_seen,
                     'message': 'Arduino is connected'
                 })
             }
@@ -72,6 +160,8 @@ def lambda_handler(event, context):
                 'headers': headers,
                 'body': json.dumps({
                     'connected': False,
+                    'devices': 0,
+                    'lastSeen': last_seen,
                     'message': 'Arduino is not connected'
                 })
             }
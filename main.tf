@@ -71,6 +71,7 @@ module "compute" {
   connection_table_name = module.database.connection_table_name
   lambda_layer_arn      = aws_lambda_layer_version.lambda_dependencies.arn
   lambda_layer_version  = aws_lambda_layer_version.lambda_dependencies.version
+  enable_result_queue   = var.ENABLE_RESULT_QUEUE
 }
 
 # 5. Networking Module - Creates REST API Gateway and integrations
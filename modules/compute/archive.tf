@@ -18,7 +18,8 @@ locals {
     },
     "isConnect" = {
       source_dir = "${local.base_dir}/lambda/websocket"
-      files_pattern = "isConnect.py"
+      # isConnect.py and the shared modules it imports
+      files_pattern = "{isConnect.py,metrics.py,profiling.py,warmup.py}"
       special_handling = true
     }
   }
@@ -71,7 +72,10 @@ resource "null_resource" "prepare_isConnect_dir" {
       mkdir -p ${path.module}/isConnect_tmp
       if [ -f "${local.base_dir}/lambda/websocket/isConnect.py" ]; then
         cp ${local.base_dir}/lambda/websocket/isConnect.py ${path.module}/isConnect_tmp/
-        echo "Copied isConnect.py to temporary directory"
+        cp ${local.base_dir}/lambda/websocket/metrics.py ${path.module}/isConnect_tmp/
+        cp ${local.base_dir}/lambda/websocket/profiling.py ${path.module}/isConnect_tmp/
+        cp ${local.base_dir}/lambda/websocket/warmup.py ${path.module}/isConnect_tmp/
+        echo "Copied isConnect.py and the shared modules to temporary directory"
       else
         echo "WARNING: isConnect.py not found at expected location"
         echo "# Placeholder file" > ${path.module}/isConnect_tmp/isConnect.py
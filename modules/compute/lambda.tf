@@ -97,4 +97,30 @@ resource "null_resource" "force_lambda_update" {
     layer_arn = var.lambda_layer_arn
     deployment_time = timestamp()
   }
-}
\ No newline at end of file
+}
+
+# Scheduled warm-ups: each function answers {"warmup": true} by priming its
+# connections and caches, so a container stays ready for its next request
+resource "aws_cloudwatch_event_rule" "warmup" {
+  name                = "lambda-warmup"
+  description         = "Invokes the functions with a warm-up event that primes connections and caches"
+  schedule_expression = var.warmup_schedule
+}
+
+resource "aws_cloudwatch_event_target" "warmup" {
+  for_each = aws_lambda_function.functions
+
+  rule  = aws_cloudwatch_event_rule.warmup.name
+  arn   = each.value.arn
+  input = jsonencode({ warmup = true })
+}
+
+resource "aws_lambda_permission" "warmup" {
+  for_each = aws_lambda_function.functions
+
+  statement_id  = "AllowExecutionFromWarmup"
+  action        = "lambda:InvokeFunction"
+  function_name = each.value.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.warmup.arn
+}
@@ -14,25 +14,31 @@ locals {
     isConnect       = "is-connect"
   }
 
+  # RESULT_QUEUE_URL for the AI functions when the result queue is enabled
+  result_queue_environment = {
+    for key, value in { RESULT_QUEUE_URL = try(aws_sqs_queue.result_queue[0].url, "") } :
+    key => value if var.enable_result_queue
+  }
+
   # Lambda function configurations
   lambda_functions = {
     audio_to_ai = {
       source_path = "${local.base_dir}/lambda/audio_to_ai/audio_to_ai.py"
       handler     = "audio_to_ai.lambda_handler"
-      environment = {
+      environment = merge({
         GOOGLE_GEMINI_API_KEY = var.google_gemini_api_key
         REGION_NAME           = var.aws_region
         RESULT_LAMBDA_NAME    = local.function_names.result_save_send
-      }
+      }, local.result_queue_environment)
     },
     pattern_to_ai = {
       source_path = "${local.base_dir}/lambda/pattern_to_ai/pattern_to_ai.py"
       handler     = "pattern_to_ai.lambda_handler"
-      environment = {
+      environment = merge({
         GOOGLE_GEMINI_API_KEY = var.google_gemini_api_key
         REGION_NAME           = var.aws_region
         RESULT_LAMBDA_NAME    = local.function_names.result_save_send
-      }
+      }, local.result_queue_environment)
     },
     result_save_send = {
       source_path = "${local.base_dir}/lambda/result_save_send/result_save_send.py"
@@ -66,6 +66,12 @@ output "isConnect_function_name" {
   description = "Name of the isConnect Lambda function"
 }
 
+# Result queue URL (empty when the queue is disabled)
+output "result_queue_url" {
+  value       = try(aws_sqs_queue.result_queue[0].url, "")
+  description = "URL of the result queue consumed by result-save-send"
+}
+
 # Complete access to all Lambda functions
 output "aws_lambda_function" {
   description = "All Lambda functions created by this module"
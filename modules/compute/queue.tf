@@ -0,0 +1,32 @@
+# Optional queue between the AI functions and result-save-send (disabled by default)
+resource "aws_sqs_queue" "result_queue_dlq" {
+  count = var.enable_result_queue ? 1 : 0
+
+  name                      = "result-queue-dlq"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue" "result_queue" {
+  count = var.enable_result_queue ? 1 : 0
+
+  name                       = "result-queue"
+  # At least six times the consumer timeout, as recommended for Lambda
+  visibility_timeout_seconds = local.default_timeout * 6
+  message_retention_seconds  = 3600
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.result_queue_dlq[0].arn
+    maxReceiveCount     = 3
+  })
+}
+
+# result-save-send consumes the queue in batches and reports partial failures
+resource "aws_lambda_event_source_mapping" "result_queue" {
+  count = var.enable_result_queue ? 1 : 0
+
+  event_source_arn                   = aws_sqs_queue.result_queue[0].arn
+  function_name                      = aws_lambda_function.functions["result_save_send"].arn
+  batch_size                         = var.result_queue_batch_size
+  maximum_batching_window_in_seconds = var.result_queue_batching_window
+  function_response_types            = ["ReportBatchItemFailures"]
+}
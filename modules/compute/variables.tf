@@ -52,9 +52,35 @@ variable "websocket_stage_name" {
   description = "Stage name for WebSocket API Gateway"
 }
 
+# Result queue variables
+variable "enable_result_queue" {
+  type        = bool
+  description = "Send AI results to result-save-send through an SQS queue instead of direct invocation"
+  default     = false
+}
+
+variable "result_queue_batch_size" {
+  type        = number
+  description = "Maximum number of queued results per result-save-send invocation"
+  default     = 10
+}
+
+variable "result_queue_batching_window" {
+  type        = number
+  description = "Seconds to wait for a fuller batch (0 delivers as soon as messages arrive)"
+  default     = 0
+}
+
 # REST API variables
 variable "rest_api_execution_arn" {
   type        = string
   description = "Execution ARN of the REST API Gateway"
   default     = ""
-}
\ No newline at end of file
+}
+
+# Warm-up variables
+variable "warmup_schedule" {
+  type        = string
+  description = "EventBridge schedule of the warm-up invocations that prime connections and caches"
+  default     = "rate(5 minutes)"
+}
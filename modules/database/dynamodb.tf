@@ -87,10 +87,14 @@ resource "aws_dynamodb_table" "response-table" {
 
 # ConnectionIdTable - Tracks WebSocket connections
 # Hash key: uuid (user identifier)
+# Range key: deviceId (device MAC address, "default" for devices without one)
+# GSI connectionId-index: connectionId -> uuid for disconnects
+# lastSeen is refreshed by device heartbeats, expiresAt is the TTL attribute
 resource "aws_dynamodb_table" "connection_table" {
     name           = "ConnectionIdTable"
     billing_mode   = "PROVISIONED"
-    hash_key       = "uuid"
+    hash_key       = "uuid"     # partition key
+    range_key      = "deviceId" # sort key
 
     read_capacity  = 5
     write_capacity = 5
@@ -100,9 +104,110 @@ resource "aws_dynamodb_table" "connection_table" {
         type = "S"
     }
 
+    attribute {
+        name = "deviceId"
+        type = "S"
+    }
+
+    attribute {
+        name = "connectionId"
+        type = "S"
+    }
+
+    global_secondary_index {
+        name            = "connectionId-index"
+        hash_key        = "connectionId"
+        projection_type = "KEYS_ONLY"
+        read_capacity   = 2
+        write_capacity  = 5
+    }
+
+    # Rows of devices that stopped sending heartbeats
+    ttl {
+        attribute_name = "expiresAt"
+        enabled        = true
+    }
+
     tags = {
         Name        = "WebSocket Connection Table"
         Environment = "dev"
         Type        = "HighlySensitive"
     }
-}
\ No newline at end of file
+}
+
+# DeviceStateTable - Last known state of each LED device
+# Hash key: deviceId (device identifier)
+resource "aws_dynamodb_table" "device_state_table" {
+    name           = "DeviceStateTable"
+    billing_mode   = "PROVISIONED"
+    hash_key       = "deviceId"
+
+    read_capacity  = 5
+    write_capacity = 5
+
+    attribute {
+        name = "deviceId"
+        type = "S"
+    }
+
+    tags = {
+        Name        = "DeviceStateTable"
+        Environment = "dev"
+        Type        = "NotSensitive"
+    }
+}
+
+# ProcessedRequestTable - Idempotency claims of processed results
+# Hash key: requestId (request identifier)
+# Items expire through the expiresAt TTL attribute
+resource "aws_dynamodb_table" "processed_request_table" {
+    name           = "ProcessedRequestTable"
+    billing_mode   = "PROVISIONED"
+    hash_key       = "requestId"
+
+    read_capacity  = 1
+    write_capacity = 5
+
+    attribute {
+        name = "requestId"
+        type = "S"
+    }
+
+    ttl {
+        attribute_name = "expiresAt"
+        enabled        = true
+    }
+
+    tags = {
+        Name        = "ProcessedRequestTable"
+        Environment = "dev"
+        Type        = "NotSensitive"
+    }
+}
+
+# RateLimitTable - Token buckets of the model admission control
+# Hash key: bucketKey ("user#<uuid>" or "global")
+# Every admitted model request writes its buckets, so the table is billed
+# per request instead of holding capacity for the global bucket's peaks
+resource "aws_dynamodb_table" "rate_limit_table" {
+    name           = "RateLimitTable"
+    billing_mode   = "PAY_PER_REQUEST"
+    hash_key       = "bucketKey"
+
+    attribute {
+        name = "bucketKey"
+        type = "S"
+    }
+
+    # Buckets of users that stopped sending requests
+    ttl {
+        attribute_name = "expiresAt"
+        enabled        = true
+    }
+
+    tags = {
+        Name        = "RateLimitTable"
+        Environment = "dev"
+        Type        = "NotSensitive"
+    }
+}
@@ -24,6 +24,16 @@ output "connection_table_name" {
   description = "Name of the WebSocket Connection DynamoDB table (ConnectionIdTable)"
 }
 
+output "device_state_table_arn" {
+  value       = aws_dynamodb_table.device_state_table.arn
+  description = "ARN of the Device State DynamoDB table (DeviceStateTable)"
+}
+
+output "processed_request_table_arn" {
+  value       = aws_dynamodb_table.processed_request_table.arn
+  description = "ARN of the idempotency DynamoDB table (ProcessedRequestTable)"
+}
+
 # S3 Bucket Output
 output "response_bucket_name" {
   value       = aws_s3_bucket.response-data.bucket
@@ -16,4 +16,16 @@ variable "api_gateway_role_arn" {
 variable "lambda_layer_arn" {
   description = "ARN of the Lambda layer containing shared Python dependencies"
   type        = string
-}
\ No newline at end of file
+}
+
+variable "connection_sweep_schedule" {
+  description = "EventBridge schedule of the sweep that deletes connections without heartbeats"
+  type        = string
+  default     = "rate(15 minutes)"
+}
+
+variable "warmup_schedule" {
+  description = "EventBridge schedule of the warm-up invocations of ws-messenger"
+  type        = string
+  default     = "rate(5 minutes)"
+}
@@ -90,3 +90,43 @@ resource "aws_cloudwatch_log_group" "ws_messenger_logs" {
     ignore_changes        = [tags]
   }
 }
+
+# Scheduled sweep of connection rows whose heartbeats expired
+resource "aws_cloudwatch_event_rule" "connection_sweep" {
+  name                = "connection-sweep"
+  description         = "Deletes ConnectionIdTable rows of devices that stopped sending heartbeats"
+  schedule_expression = var.connection_sweep_schedule
+}
+
+resource "aws_cloudwatch_event_target" "connection_sweep" {
+  rule = aws_cloudwatch_event_rule.connection_sweep.name
+  arn  = aws_lambda_function.ws_messenger_lambda.arn
+}
+
+resource "aws_lambda_permission" "connection_sweep" {
+  statement_id  = "AllowExecutionFromConnectionSweep"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.ws_messenger_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.connection_sweep.arn
+}
+
+resource "aws_cloudwatch_event_rule" "ws_warmup" {
+  name                = "ws-messenger-warmup"
+  description         = "Invokes ws-messenger with a warm-up event that primes its DynamoDB connection"
+  schedule_expression = var.warmup_schedule
+}
+
+resource "aws_cloudwatch_event_target" "ws_warmup" {
+  rule  = aws_cloudwatch_event_rule.ws_warmup.name
+  arn   = aws_lambda_function.ws_messenger_lambda.arn
+  input = jsonencode({ warmup = true })
+}
+
+resource "aws_lambda_permission" "ws_warmup" {
+  statement_id  = "AllowExecutionFromWarmup"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.ws_messenger_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.ws_warmup.arn
+}
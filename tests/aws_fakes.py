@@ -0,0 +1,325 @@
+"""
+In-memory stand-ins for the AWS services the lambdas call.
+
+FakeDynamoDB serves the subset of the boto3 DynamoDB resource the lambdas
+use. Condition and update expressions are evaluated, so conditional writes
+fail with ConditionalCheckFailedException like they do in DynamoDB.
+FakeApiGateway records post_to_connection calls.
+"""
+import copy
+import json
+import re
+
+from botocore.exceptions import ClientError
+
+# Key attributes of each table
+TABLE_KEYS = {
+    "ConnectionIdTable": ("uuid", "deviceId"),
+    "DeviceStateTable": ("deviceId",),
+    "IrCodeTable": ("deviceType", "id"),
+    "ProcessedRequestTable": ("requestId",),
+    "RateLimitTable": ("bucketKey",),
+    "ResponseTable": ("uuid", "requestId"),
+}
+
+TOKEN = re.compile(r"\s*(<=|>=|<>|[()=<>,]|:\w+|#\w+|\w+)")
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+def condition_failed(operation):
+    return client_error("ConditionalCheckFailedException", operation)
+
+
+def compare(left, operator, right):
+    if left is None or right is None:
+        return operator == "<>" and left != right
+    return {
+        "=": left == right,
+        "<>": left != right,
+        "<": left < right,
+        "<=": left <= right,
+        ">": left > right,
+        ">=": left >= right,
+    }[operator]
+
+
+class Expression:
+    """Condition expression string evaluated against an item."""
+
+    def __init__(self, text, names=None, values=None):
+        self.tokens = TOKEN.findall(text)
+        self.names = names or {}
+        self.values = values or {}
+        self.position = 0
+
+    def evaluate(self, item):
+        self.item = item or {}
+        self.position = 0
+        result = self.disjunction()
+        assert self.position == len(self.tokens), f"unparsed: {self.tokens[self.position:]}"
+        return result
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def disjunction(self):
+        result = self.conjunction()
+        while self.peek() == "OR":
+            self.next()
+            result = self.conjunction() or result
+        return result
+
+    def conjunction(self):
+        result = self.term()
+        while self.peek() == "AND":
+            self.next()
+            result = self.term() and result
+        return result
+
+    def term(self):
+        token = self.next()
+        if token == "(":
+            result = self.disjunction()
+            assert self.next() == ")"
+            return result
+        if token == "NOT":
+            return not self.term()
+        if token in ("attribute_exists", "attribute_not_exists"):
+            assert self.next() == "("
+            name = self.name(self.next())
+            assert self.next() == ")"
+            return (name in self.item) == (token == "attribute_exists")
+        left = self.operand(token)
+        operator = self.next()
+        return compare(left, operator, self.operand(self.next()))
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    def operand(self, token):
+        if token.startswith(":"):
+            return self.values[token]
+        return self.item.get(self.name(token))
+
+
+def matches(condition, item):
+    """Evaluate a boto3.dynamodb.conditions Key/Attr condition."""
+    expression = condition.get_expression()
+    operator = expression["operator"]
+    if operator in ("AND", "OR"):
+        results = [matches(value, item) for value in expression["values"]]
+        return all(results) if operator == "AND" else any(results)
+    attribute, *operands = expression["values"]
+    value = item.get(attribute.name)
+    if operator == "begins_with":
+        return isinstance(value, str) and value.startswith(operands[0])
+    if operator == "BETWEEN":
+        return value is not None and operands[0] <= value <= operands[1]
+    return compare(value, operator, operands[0])
+
+
+class FakeBatchWriter:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+
+class FakeTable:
+    """DynamoDB table resource keeping its items in a dict."""
+
+    def __init__(self, name, key_names=None):
+        self.name = name
+        self.key_names = key_names or TABLE_KEYS[name]
+        self.items = {}
+        self.calls = []
+
+    def key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def check(self, operation, item, condition, names, values):
+        if condition and not Expression(condition, names, values).evaluate(item):
+            raise condition_failed(operation)
+
+    def get_item(self, Key, **kwargs):
+        self.calls.append(("get_item", Key))
+        item = self.items.get(self.key(Key))
+        return {"Item": copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None):
+        self.calls.append(("put_item", Item))
+        key = self.key(Item)
+        self.check("PutItem", self.items.get(key), ConditionExpression,
+                   ExpressionAttributeNames, ExpressionAttributeValues)
+        self.items[key] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    **kwargs):
+        self.calls.append(("update_item", Key))
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        key = self.key(Key)
+        self.check("UpdateItem", self.items.get(key), ConditionExpression, names, values)
+
+        item = copy.deepcopy(self.items.get(key)) or dict(Key)
+        for action, clause in re.findall(r"(SET|REMOVE)\s+(.*?)(?=\s+(?:SET|REMOVE)\s|$)",
+                                         UpdateExpression):
+            for part in clause.split(","):
+                if action == "SET":
+                    name, value = (side.strip() for side in part.split("="))
+                    item[names.get(name, name)] = copy.deepcopy(values[value])
+                else:
+                    item.pop(names.get(part.strip(), part.strip()), None)
+        self.items[key] = item
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None):
+        self.calls.append(("delete_item", Key))
+        key = self.key(Key)
+        self.check("DeleteItem", self.items.get(key), ConditionExpression,
+                   ExpressionAttributeNames, ExpressionAttributeValues)
+        self.items.pop(key, None)
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, **kwargs):
+        self.calls.append(("query", IndexName))
+        items = [item for item in self.items.values()
+                 if matches(KeyConditionExpression, item)]
+        if kwargs.get("ScanIndexForward") is False:
+            items.reverse()
+        if kwargs.get("Limit"):
+            items = items[:kwargs["Limit"]]
+        return {"Items": copy.deepcopy(items)}
+
+    def scan(self, FilterExpression=None, **kwargs):
+        self.calls.append(("scan", None))
+        items = [item for item in self.items.values()
+                 if FilterExpression is None or matches(FilterExpression, item)]
+        return {"Items": copy.deepcopy(items)}
+
+    def batch_writer(self):
+        return FakeBatchWriter(self)
+
+
+class FakeClient:
+    """Low-level client of FakeDynamoDB, for PartiQL deletes."""
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def batch_execute_statement(self, Statements):
+        responses = []
+        for statement in Statements:
+            match = re.match(r'DELETE FROM "(\w+)" WHERE (.*)', statement["Statement"])
+            table = self.resource.Table(match.group(1))
+            conditions = re.findall(r'"(\w+)" (=|<) \?', match.group(2))
+            parameters = [next(iter(value.values())) for value in statement["Parameters"]]
+            key = {name: value for (name, _), value in zip(conditions, parameters)
+                   if name in table.key_names}
+            item = table.items.get(table.key(key))
+            if item is not None and all(
+                    compare(item.get(name), operator,
+                            type(item.get(name))(value) if item.get(name) is not None else value)
+                    for (name, operator), value in zip(conditions, parameters)):
+                del table.items[table.key(key)]
+                responses.append({})
+            else:
+                responses.append({"Error": {"Code": "ConditionalCheckFailed",
+                                            "Message": "The conditional request failed"}})
+        return {"Responses": responses}
+
+
+class FakeMeta:
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeDynamoDB:
+    """DynamoDB resource with a FakeTable per table name."""
+
+    def __init__(self):
+        self.tables = {}
+        self.meta = FakeMeta(FakeClient(self))
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = FakeTable(name)
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            responses[name] = [copy.deepcopy(table.items[table.key(key)])
+                               for key in request["Keys"]
+                               if table.key(key) in table.items]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+
+class FakeApiGateway:
+    """Records posts; connections listed in errors fail with that code."""
+
+    def __init__(self, errors=None):
+        self.errors = dict(errors or {})
+        self.posts = []
+        self.lookups = []
+
+    def post_to_connection(self, ConnectionId, Data):
+        self.posts.append((ConnectionId, Data))
+        if ConnectionId in self.errors:
+            raise client_error(self.errors[ConnectionId], "PostToConnection")
+        return {}
+
+    def get_connection(self, ConnectionId):
+        self.lookups.append(ConnectionId)
+        raise client_error("GoneException", "GetConnection")
+
+    def sent(self, connection_id):
+        """JSON messages posted to a connection"""
+        return [json.loads(data) for posted_id, data in self.posts
+                if posted_id == connection_id]
+
+
+def install_result_save_send(module, monkeypatch, errors=None):
+    """
+    Point result_save_send at a FakeDynamoDB and a FakeApiGateway.
+
+    Returns:
+        (FakeDynamoDB, FakeApiGateway)
+    """
+    dynamodb = FakeDynamoDB()
+    apigateway = FakeApiGateway(errors)
+    endpoint = module.get_endpoint_url(module.os.environ["WEBSOCKET_URL"])
+    monkeypatch.setattr(module, "dynamodb", dynamodb)
+    monkeypatch.setattr(module, "idempotency_store", module.IdempotencyStore(
+        dynamodb.Table("ProcessedRequestTable")))
+    monkeypatch.setattr(module, "apigateway_clients", {endpoint: apigateway})
+    monkeypatch.setattr(module, "code_tables", {})
+    monkeypatch.delenv("BUCKET_NAME", raising=False)
+    return dynamodb, apigateway
+
+
+def add_connection(dynamodb, uuid, connection_id, device_id="default", **fields):
+    """Store a ConnectionIdTable row."""
+    item = {"uuid": uuid, "deviceId": device_id, "connectionId": connection_id}
+    item.update(fields)
+    dynamodb.Table("ConnectionIdTable").put_item(Item=item)
@@ -0,0 +1,38 @@
+"""
+Loading of lambda modules whose names repeat across the lambda directories.
+
+Each Lambda imports its siblings by bare name (constants, fallback, ...),
+and some of those names have a different module in each directory. load()
+imports a module with its own directory's siblings and keeps them out of
+sys.modules, so tests of several lambdas can run in one process.
+"""
+import importlib.util
+import os
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), "..", "lambda")
+
+
+def load(function, name):
+    """
+    Import lambda/<function>/<name>.py under the name <function>.<name>.
+
+    Returns:
+        Module
+    """
+    directory = os.path.join(LAMBDA_DIR, function)
+    siblings = {entry[:-3] for entry in os.listdir(directory) if entry.endswith(".py")}
+    saved = {sibling: sys.modules.pop(sibling) for sibling in siblings
+             if sibling in sys.modules}
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            f"{function}.{name}", os.path.join(directory, f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        for sibling in siblings:
+            sys.modules.pop(sibling, None)
+        sys.modules.update(saved)
+    return module
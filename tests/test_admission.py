@@ -0,0 +1,118 @@
+"""
+Tests of the token-bucket admission control in lambda/audio_to_ai/admission.py.
+
+RateLimitTable is an in-memory table that evaluates the conditional updates
+the limiter makes and fails them like DynamoDB does.
+"""
+import os
+import sys
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "audio_to_ai"))
+
+from admission import RateLimiter  # noqa: E402
+
+NOW = 1700000000.0
+
+
+class FakeRateLimitTable:
+    """RateLimitTable rows by bucketKey, with the limiter's conditions."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression,
+                    ExpressionAttributeValues, ReturnValuesOnConditionCheckFailure=None):
+        row = self.rows.get(Key["bucketKey"])
+        full_at = row["fullAt"] if row else None
+        values = ExpressionAttributeValues
+
+        if ConditionExpression == "fullAt > :now AND fullAt <= :limit":
+            allowed = full_at is not None and values[":now"] < full_at <= values[":limit"]
+        elif ConditionExpression == "attribute_not_exists(fullAt) OR fullAt <= :now":
+            allowed = full_at is None or full_at <= values[":now"]
+        elif ConditionExpression == "fullAt > :now":
+            allowed = full_at is not None and full_at > values[":now"]
+        else:
+            raise AssertionError(f"unexpected condition {ConditionExpression}")
+
+        if not allowed:
+            response = {"Error": {"Code": "ConditionalCheckFailedException",
+                                  "Message": "The conditional request failed"}}
+            if ReturnValuesOnConditionCheckFailure == "ALL_OLD" and row:
+                response["Item"] = {"fullAt": {"N": str(full_at)}}
+            raise ClientError(response, "UpdateItem")
+
+        if UpdateExpression.startswith("SET fullAt = fullAt + :interval"):
+            full_at += values[":interval"]
+        elif UpdateExpression.startswith("SET fullAt = fullAt - :interval"):
+            full_at -= values[":interval"]
+        else:
+            full_at = values[":next"]
+        self.rows[Key["bucketKey"]] = {"fullAt": full_at}
+        return {}
+
+
+def limiter(table=None, **limits):
+    # 60 per minute: one token per second
+    settings = dict(user_per_minute=60, user_burst=2, global_per_minute=60, global_burst=3)
+    settings.update(limits)
+    return RateLimiter(table, **settings)
+
+
+def test_user_burst_then_denied_until_refill():
+    rate_limiter = limiter(FakeRateLimitTable())
+
+    assert rate_limiter.admit("a", NOW) == 0
+    assert rate_limiter.admit("a", NOW) == 0
+    assert rate_limiter.admit("a", NOW) == pytest.approx(1.0)
+    assert rate_limiter.admit("a", NOW + 1) == 0
+
+
+def test_global_denial_does_not_charge_the_local_user_bucket():
+    rate_limiter = limiter(None, global_burst=1)
+
+    assert rate_limiter.admit("a", NOW) == 0
+    # The global bucket is empty; b's token comes back
+    assert rate_limiter.admit("b", NOW) > 0
+    assert rate_limiter.local_buckets["user#b"].tokens == 2
+
+
+def test_global_denial_does_not_charge_the_shared_user_bucket():
+    table = FakeRateLimitTable()
+    rate_limiter = limiter(table, global_burst=1)
+    assert rate_limiter.admit("a", NOW) == 0
+
+    # Another container with its own in-process buckets
+    other = limiter(table, global_burst=1)
+    assert other.admit("b", NOW) == pytest.approx(1.0)
+    # b was not admitted, so its shared bucket is back to full
+    assert table.rows["user#b"]["fullAt"] <= NOW * 1000
+
+    # Once the global bucket refills, b still has its whole burst
+    assert other.admit("b", NOW + 1) == 0
+    assert table.rows["user#b"]["fullAt"] == int((NOW + 1) * 1000) + 1000
+
+
+def test_user_denial_does_not_take_a_global_token():
+    table = FakeRateLimitTable()
+    rate_limiter = limiter(table, user_burst=1)
+
+    assert rate_limiter.admit("a", NOW) == 0
+    global_full_at = table.rows["global"]["fullAt"]
+    assert rate_limiter.admit("a", NOW) > 0
+    assert table.rows["global"]["fullAt"] == global_full_at
+
+
+def test_table_errors_admit_under_local_limits():
+    class BrokenTable:
+        def update_item(self, **kwargs):
+            raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException",
+                                         "Message": "slow down"}}, "UpdateItem")
+
+    rate_limiter = limiter(BrokenTable())
+    assert rate_limiter.admit("a", NOW) == 0
+    assert rate_limiter.admit("a", NOW) == 0
+    assert rate_limiter.admit("a", NOW) > 0
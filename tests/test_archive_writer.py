@@ -0,0 +1,90 @@
+"""
+Tests of the buffered response archive in lambda/result_save_send/archive_writer.py.
+"""
+import gzip
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+from archive_writer import ArchiveWriter, build_archive_record  # noqa: E402
+
+# 2025-01-31 14:59:58 UTC
+NOW = 1738335598.0
+
+
+def records(body):
+    return [json.loads(line) for line in gzip.decompress(body).decode("utf-8").splitlines()]
+
+
+def test_record_drops_fields_stored_in_response_table():
+    event = {"uuid": "u", "request_id": "r", "lightSetting": {}, "context": "c",
+             "emotion": {"main": "Positive", "subcategories": ["Joy"]}, "seq": 3}
+
+    record = build_archive_record(event, "u", "r", now=NOW)
+
+    assert record == {"uuid": "u", "requestId": "r", "archivedAt": NOW,
+                      "emotion": {"subcategories": ["Joy"]}, "seq": 3}
+
+
+def test_batch_is_split_at_the_hour_boundary():
+    writer = ArchiveWriter(prefix="archive/")
+    assert writer.add({"n": 1}, now=NOW) is None
+    assert writer.add({"n": 2}, now=NOW + 1) is None
+
+    # The next record falls in hour 15, so the hour 14 batch is handed back
+    key, body, _ = writer.add({"n": 3}, now=NOW + 2)
+
+    assert key.startswith("archive/dt=2025-01-31/hour=14/20250131T145958Z-")
+    assert [record["n"] for record in records(body)] == [1, 2]
+    key, body, _ = writer.take()
+    assert key.startswith("archive/dt=2025-01-31/hour=15/")
+    assert [record["n"] for record in records(body)] == [3]
+
+
+def test_batch_is_due_on_size_or_age():
+    writer = ArchiveWriter(max_bytes=100, max_age=60)
+    assert not writer.should_flush(now=NOW)
+
+    writer.add({"n": 1}, now=NOW)
+    assert not writer.should_flush(now=NOW + 59)
+    assert writer.should_flush(now=NOW + 60)
+
+    writer.add({"pad": "x" * 100}, now=NOW + 1)
+    assert writer.should_flush(now=NOW + 1)
+
+
+def test_restore_puts_failed_lines_in_front():
+    writer = ArchiveWriter()
+    writer.add({"n": 1}, now=NOW - 10)
+    _, _, taken = writer.take()
+    writer.add({"n": 2}, now=NOW - 5)
+
+    assert writer.restore(taken) == 0
+    _, body, _ = writer.take()
+    assert [record["n"] for record in records(body)] == [1, 2]
+
+
+def test_restore_caps_the_backlog():
+    # Each line is 10 bytes, so the backlog holds at most 4 * 25 = 100 bytes
+    writer = ArchiveWriter(max_bytes=25)
+    for n in "abcdefghijklmno":
+        writer.add({"n": n}, now=NOW - 10)
+    _, _, taken = writer.take()
+
+    assert writer.restore(taken) == 5
+    assert writer.size <= 100
+    _, body, _ = writer.take()
+    assert "".join(record["n"] for record in records(body)) == "fghijklmno"
+
+
+def test_restore_never_merges_two_hours():
+    writer = ArchiveWriter()
+    writer.add({"n": 1}, now=NOW)
+    _, _, taken = writer.take()
+    writer.add({"n": 2}, now=NOW + 2)
+
+    assert writer.restore(taken) == 1
+    _, body, _ = writer.take()
+    assert [record["n"] for record in records(body)] == [2]
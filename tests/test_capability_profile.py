@@ -0,0 +1,56 @@
+"""
+Tests of the capability profiles in lambda/result_save_send/capability_profile.py.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+from capability_profile import parse_capability_profile, quantize_rgb  # noqa: E402
+from constants import DEFAULT_CAPABILITY_PROFILE  # noqa: E402
+
+
+def test_quantize_snaps_to_the_nearest_level():
+    # 16 steps: levels are multiples of 255 / 16 = 15.9
+    assert quantize_rgb([128, 7, 9], [16, 16, 16]) == [128, 0, 16]
+
+
+def test_quantize_clamps_out_of_range_values():
+    assert quantize_rgb([300, -5, 255], [16, 16, 16]) == [255, 0, 255]
+
+
+def test_quantize_keeps_full_resolution_channels():
+    assert quantize_rgb([100, 100, 100], [255, 4, 1]) == [100, 128, 0]
+
+
+def test_quantize_is_idempotent():
+    once = quantize_rgb([37, 142, 201], [8, 12, 16])
+    assert quantize_rgb(once, [8, 12, 16]) == once
+
+
+def test_missing_profile_uses_the_default():
+    profile = parse_capability_profile(None)
+
+    assert profile["steps"] == DEFAULT_CAPABILITY_PROFILE["steps"]
+    assert profile["minGapMs"] == DEFAULT_CAPABILITY_PROFILE["minGapMs"]
+    assert profile["presets"] == []
+    assert profile["codeVersion"] == DEFAULT_CAPABILITY_PROFILE["codeVersion"]
+
+
+def test_profile_clamps_steps_and_quantizes_presets():
+    profile = parse_capability_profile({
+        "steps": [0, 500, 8],
+        "minGapMs": 90,
+        "codeVersion": 4,
+        "presets": [
+            {"code": "FF1AE5", "rgb": [250, 10, 0], "adjustable": True},
+            {"code": "", "rgb": [1, 2, 3]},
+        ],
+    })
+
+    assert profile["steps"] == [1, 255, 8]
+    assert profile["minGapMs"] == 90
+    assert profile["codeVersion"] == 4
+    # Presets without a code are skipped; colors snap to the profile's steps
+    assert profile["presets"] == [
+        {"code": "FF1AE5", "rgb": [255, 10, 0], "adjustable": True}]
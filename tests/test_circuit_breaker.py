@@ -0,0 +1,126 @@
+"""
+Tests of the model-call circuit breaker in lambda/audio_to_ai/circuit_breaker.py.
+
+The shared state lives in the in-memory RateLimitTable of aws_fakes.py.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "audio_to_ai"))
+
+from aws_fakes import FakeTable, client_error  # noqa: E402
+from circuit_breaker import (STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN,  # noqa: E402
+                             CircuitBreaker)
+
+NOW = 1700000000.0
+
+
+def breaker(table=None, **settings):
+    options = dict(failure_threshold=3, open_seconds=30, slow_seconds=10)
+    options.update(settings)
+    return CircuitBreaker("gemini", table=table, **options)
+
+
+def fail(circuit_breaker, times, now=NOW):
+    for _ in range(times):
+        assert circuit_breaker.allow(now)
+        circuit_breaker.record(False, 0.1, now)
+
+
+def test_opens_after_failures_in_a_row():
+    circuit_breaker = breaker()
+    fail(circuit_breaker, 2)
+    assert circuit_breaker.state == STATE_CLOSED
+
+    fail(circuit_breaker, 1)
+
+    assert circuit_breaker.is_open()
+    assert not circuit_breaker.allow(NOW + 29)
+    assert circuit_breaker.retry_after(NOW + 10) == 20
+
+
+def test_success_resets_the_failure_count():
+    circuit_breaker = breaker()
+    fail(circuit_breaker, 2)
+    circuit_breaker.record(True, 0.1, NOW)
+    fail(circuit_breaker, 2)
+
+    assert circuit_breaker.state == STATE_CLOSED
+
+
+def test_slow_calls_count_as_failures():
+    circuit_breaker = breaker(failure_threshold=1)
+    circuit_breaker.record(True, 11, NOW)
+
+    assert circuit_breaker.is_open()
+
+
+def test_half_open_trial_success_closes():
+    circuit_breaker = breaker()
+    fail(circuit_breaker, 3)
+
+    assert circuit_breaker.allow(NOW + 30)
+    assert circuit_breaker.state == STATE_HALF_OPEN
+    assert circuit_breaker.retry_after(NOW + 30) == 0
+
+    circuit_breaker.record(True, 0.1, NOW + 31)
+    assert circuit_breaker.state == STATE_CLOSED
+    assert circuit_breaker.allow(NOW + 31)
+
+
+def test_half_open_trial_failure_opens_again():
+    circuit_breaker = breaker()
+    fail(circuit_breaker, 3)
+    assert circuit_breaker.allow(NOW + 30)
+
+    # A single failed trial is enough, whatever the threshold
+    circuit_breaker.record(False, 0.1, NOW + 31)
+
+    assert circuit_breaker.state == STATE_OPEN
+    assert not circuit_breaker.allow(NOW + 60)
+    assert circuit_breaker.allow(NOW + 61)
+
+
+def test_opening_is_shared_with_other_containers():
+    table = FakeTable("RateLimitTable")
+    circuit_breaker = breaker(table)
+    fail(circuit_breaker, 3)
+
+    row = table.items[("breaker#gemini",)]
+    assert row["openUntil"] == int((NOW + 30) * 1000)
+    assert row["expiresAt"] > NOW + 30
+
+    other = breaker(table)
+    assert not other.allow(NOW + 1)
+    assert other.is_open()
+    # The other container runs its own trial once the opening ends
+    assert other.allow(NOW + 30)
+
+
+def test_closed_breaker_reads_the_shared_state_every_sync_seconds():
+    table = FakeTable("RateLimitTable")
+    circuit_breaker = breaker(table, sync_seconds=5)
+    assert circuit_breaker.allow(NOW)
+
+    # Another container opens the breaker
+    breaker(table).trip(NOW + 1)
+
+    assert circuit_breaker.allow(NOW + 4)
+    assert not circuit_breaker.allow(NOW + 5)
+    reads = [call for call in table.calls if call[0] == "get_item"]
+    assert len(reads) == 2
+
+
+def test_table_errors_keep_the_breaker_local():
+    class BrokenTable:
+        def get_item(self, **kwargs):
+            raise client_error("ProvisionedThroughputExceededException", "GetItem")
+
+        def put_item(self, **kwargs):
+            raise client_error("ProvisionedThroughputExceededException", "PutItem")
+
+    circuit_breaker = breaker(BrokenTable())
+    fail(circuit_breaker, 3)
+
+    assert circuit_breaker.is_open()
+    assert circuit_breaker.allow(NOW + 30)
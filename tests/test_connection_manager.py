@@ -0,0 +1,194 @@
+"""
+Tests of the WebSocket routes in lambda/websocket/connection_manager.py.
+
+ConnectionIdTable is replaced by the in-memory fake of aws_fakes.py, so no
+AWS call is made.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "websocket"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import connection_manager  # noqa: E402
+from aws_fakes import FakeDynamoDB, add_connection  # noqa: E402
+
+NOW = 1700000000
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    dynamodb = FakeDynamoDB()
+    monkeypatch.setattr(connection_manager, "dynamodb", dynamodb)
+    monkeypatch.setattr(connection_manager, "table", dynamodb.Table("ConnectionIdTable"))
+    monkeypatch.setattr(connection_manager.time, "time", lambda: NOW)
+    return dynamodb
+
+
+def route(route_key, connection_id, **fields):
+    event = {"requestContext": {"routeKey": route_key, "connectionId": connection_id}}
+    event.update(fields)
+    return connection_manager.route_event(event, None)
+
+
+def connections(dynamodb):
+    return dynamodb.Table("ConnectionIdTable").items
+
+
+def test_disconnect_deletes_the_row_found_in_the_index(dynamodb):
+    add_connection(dynamodb, "user", "conn-1")
+    add_connection(dynamodb, "user", "conn-2", device_id="AA:BB")
+
+    response = route("$disconnect", "conn-1")
+
+    assert response["statusCode"] == 200
+    assert ("user", "default") not in connections(dynamodb)
+    assert ("user", "AA:BB") in connections(dynamodb)
+    assert ("query", connection_manager.CONNECTION_INDEX) in dynamodb.Table(
+        "ConnectionIdTable").calls
+    assert ("scan", None) not in dynamodb.Table("ConnectionIdTable").calls
+
+
+def test_late_disconnect_keeps_the_row_of_a_reconnect(dynamodb, monkeypatch):
+    add_connection(dynamodb, "user", "conn-1")
+
+    class StaleIndexTable(type(connection_manager.table)):
+        # The index still maps the old connection while the row has the new one
+        def query(self, **kwargs):
+            return {"Items": [{"uuid": "user", "deviceId": "default",
+                               "connectionId": "conn-0"}]}
+
+    table = StaleIndexTable("ConnectionIdTable")
+    table.items = connections(dynamodb)
+    monkeypatch.setattr(connection_manager, "table", table)
+
+    response = route("$disconnect", "conn-0")
+
+    assert response["statusCode"] == 200
+    assert connections(dynamodb)[("user", "default")]["connectionId"] == "conn-1"
+
+
+def test_disconnect_of_an_unknown_connection_succeeds(dynamodb):
+    assert route("$disconnect", "conn-unknown")["statusCode"] == 200
+
+
+def test_connect_stores_presence_with_its_ttl(dynamodb):
+    response = route("$connect", "conn-1", queryStringParameters={"uuid": "user"})
+
+    assert response["statusCode"] == 200
+    row = connections(dynamodb)[("user", "default")]
+    assert row["lastSeen"] == NOW
+    assert row["expiresAt"] == NOW + connection_manager.CONNECTION_TTL
+
+
+def test_heartbeat_refreshes_presence_and_ttl(dynamodb):
+    add_connection(dynamodb, "user", "conn-1", lastSeen=NOW - 60, expiresAt=NOW + 100)
+
+    response = route("$default", "conn-1", body='{"uuid": "user"}')
+
+    assert response["statusCode"] == 200
+    row = connections(dynamodb)[("user", "default")]
+    assert row["lastSeen"] == NOW
+    assert row["expiresAt"] == NOW + connection_manager.CONNECTION_TTL
+    assert "reported" not in row
+
+
+def test_heartbeat_of_a_replaced_connection_is_refused(dynamodb):
+    add_connection(dynamodb, "user", "conn-2", lastSeen=NOW - 60)
+
+    response = route("$default", "conn-1", body='{"uuid": "user"}')
+
+    assert response["statusCode"] == 410
+    assert connections(dynamodb)[("user", "default")]["lastSeen"] == NOW - 60
+
+
+def test_heartbeat_without_uuid_is_rejected(dynamodb):
+    assert route("$default", "conn-1", body='{}')["statusCode"] == 400
+    assert route("$default", "conn-1", body='[]')["statusCode"] == 400
+
+
+def sweep_event():
+    return {"source": "aws.events", "detail-type": "Scheduled Event"}
+
+
+def test_sweep_deletes_rows_without_recent_heartbeats(dynamodb):
+    timeout = connection_manager.PRESENCE_TIMEOUT
+    add_connection(dynamodb, "stale", "conn-1", lastSeen=NOW - timeout - 1)
+    add_connection(dynamodb, "fresh", "conn-2", lastSeen=NOW - timeout)
+
+    response = connection_manager.route_event(sweep_event(), None)
+
+    assert json.loads(response["body"])["deleted"] == 1
+    assert list(connections(dynamodb)) == [("fresh", "default")]
+
+
+def test_sweep_keeps_rows_refreshed_after_the_scan(dynamodb, monkeypatch):
+    add_connection(dynamodb, "user", "conn-1", lastSeen=NOW - 600)
+    table = connection_manager.table
+    scan = table.scan
+
+    def scan_then_heartbeat(**kwargs):
+        response = scan(**kwargs)
+        table.items[("user", "default")]["lastSeen"] = NOW
+        return response
+
+    monkeypatch.setattr(table, "scan", scan_then_heartbeat)
+
+    response = connection_manager.route_event(sweep_event(), None)
+
+    assert json.loads(response["body"])["deleted"] == 0
+    assert ("user", "default") in connections(dynamodb)
+
+
+def test_sweep_deletes_in_batches(dynamodb, monkeypatch):
+    for index in range(30):
+        add_connection(dynamodb, f"user-{index}", f"conn-{index}", lastSeen=NOW - 600)
+    batches = []
+    execute = dynamodb.meta.client.batch_execute_statement
+
+    def record_batch(Statements):
+        batches.append(len(Statements))
+        return execute(Statements=Statements)
+
+    monkeypatch.setattr(dynamodb.meta.client, "batch_execute_statement", record_batch)
+
+    connection_manager.route_event(sweep_event(), None)
+
+    assert batches == [25, 5]
+    assert connections(dynamodb) == {}
+
+
+def test_state_report_is_stored_as_the_shadow(dynamodb):
+    add_connection(dynamodb, "user", "conn-1", device_id="AA:BB")
+    body = {"uuid": "user", "mac": "aa:bb", "state": "on", "rgb": [300, 10, -1], "seq": 7}
+
+    response = route("$default", "conn-1", body=json.dumps(body))
+
+    assert response["statusCode"] == 200
+    assert connections(dynamodb)[("user", "AA:BB")]["reported"] == {
+        "power": True, "rgb": [255, 10, 0], "dynamic": False, "at": NOW, "seq": 7}
+
+
+def test_state_report_with_invalid_values_is_rejected(dynamodb):
+    add_connection(dynamodb, "user", "conn-1")
+    body = {"uuid": "user", "state": "on", "rgb": ["red", 0, 0]}
+
+    assert route("$default", "conn-1", body=json.dumps(body))["statusCode"] == 400
+    assert "reported" not in connections(dynamodb)[("user", "default")]
+
+
+def test_state_report_ends_the_trace_of_its_command(dynamodb, capsys):
+    add_connection(dynamodb, "user", "conn-1")
+    body = {"uuid": "user", "state": "on", "rgb": [1, 2, 3], "trace": "trace-1"}
+    event = {"requestContext": {"routeKey": "$default", "connectionId": "conn-1"},
+             "body": json.dumps(body)}
+
+    connection_manager.lambda_handler(event, None)
+
+    record = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert record["traceId"] == "trace-1"
+    assert [span[0] for span in record["spans"]] == ["message"]
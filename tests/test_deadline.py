@@ -0,0 +1,75 @@
+"""
+Tests of the request deadline in lambda/result_save_send/deadline.py.
+
+The module is copied into every lambda; test_shared_modules.py keeps the
+copies identical. time.monotonic is replaced by a clock the tests advance.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+import deadline  # noqa: E402
+from deadline import DEFAULT_REMAINING_MS, Deadline, DeadlineExceeded  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Context:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(deadline.time, "monotonic", clock)
+    return clock
+
+
+def test_from_context_keeps_the_reserve_back(clock):
+    assert Deadline.from_context(Context(3000), reserve_ms=500).remaining_ms() == 2500
+
+
+def test_from_context_is_capped_by_the_budget(clock):
+    assert Deadline.from_context(Context(30000), budget_ms=8000).remaining_ms() == 8000
+
+
+def test_from_context_without_a_context_uses_the_default(clock):
+    assert Deadline.from_context(None).remaining_ms() == DEFAULT_REMAINING_MS
+
+
+def test_remaining_counts_down_and_never_goes_negative(clock):
+    request_deadline = Deadline(2000)
+    clock.now += 0.5
+    assert request_deadline.remaining() == pytest.approx(1.5)
+    assert not request_deadline.expired()
+
+    clock.now += 2
+    assert request_deadline.remaining() == 0.0
+    assert request_deadline.expired()
+
+
+def test_timeout_is_capped_by_the_remaining_time(clock):
+    request_deadline = Deadline(2000)
+    assert request_deadline.timeout(0.5) == 0.5
+    assert request_deadline.timeout(5) == pytest.approx(2.0)
+
+
+def test_check_raises_when_the_stage_cannot_finish(clock):
+    request_deadline = Deadline(1000)
+    request_deadline.check("upload", needed=0.5)
+
+    with pytest.raises(DeadlineExceeded, match="upload"):
+        request_deadline.check("upload", needed=1.0)
@@ -0,0 +1,91 @@
+"""
+Tests of the fallback recommendations in lambda/*/fallback.py.
+
+Every fallback has to pass the answer validation of the function that
+serves it (model_response.verify_and_parse_json), so result_save_send and
+the clients can handle it like a model answer.
+"""
+import json
+from datetime import datetime
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+from lambda_modules import load
+
+AI_FUNCTIONS = ("audio_to_ai", "pattern_to_ai")
+
+fallback = load("audio_to_ai", "fallback")
+
+
+def as_model_answer(result):
+    """Wrap a result like a Gemini response that finished normally"""
+    return SimpleNamespace(text=json.dumps(result), candidates=[
+        SimpleNamespace(finish_reason="STOP")])
+
+
+HISTORIES = {
+    "none": [],
+    "color": [
+        {"lightSetting": {"power": True, "color": [Decimal(10), Decimal(20), Decimal(30)]},
+         "emotionTag": "Positive", "context": "Reading"},
+    ],
+    "dynamic": [{"lightSetting": {"power": True, "dynamic": "FADE7"}}],
+    "off": [{"lightSetting": {"power": False}, "emotionTag": "Calm"}],
+    "invalid": [{"lightSetting": {"power": True, "color": [300, 0, 0]}}],
+}
+
+
+@pytest.mark.parametrize("function", AI_FUNCTIONS)
+@pytest.mark.parametrize("history", sorted(HISTORIES))
+@pytest.mark.parametrize("hour", [3, 7, 13, 21])
+def test_fallback_passes_the_answer_validation(function, history, hour):
+    module = load(function, "fallback")
+    model_response = load(function, "model_response")
+    result = module.fallback_recommendation(
+        HISTORIES[history], timestamp={"time": f"{hour:02d}:30:00"})
+
+    assert model_response.verify_and_parse_json(as_model_answer(result)) == result
+
+
+def test_usual_setting_is_the_most_used_one():
+    history = [
+        {"lightSetting": {"power": True, "color": [1, 2, 3]}, "context": "newest"},
+        {"lightSetting": {"power": True, "color": [9, 9, 9]}},
+        {"lightSetting": {"power": True, "color": [1, 2, 3]}, "context": "older"},
+    ]
+
+    result = fallback.fallback_recommendation(history)
+
+    assert result["lightSetting"] == {"power": True, "color": [1, 2, 3]}
+    assert result["context"] == "newest"
+    assert result["emotion"] == {"main": "Neutral", "subcategories": []}
+
+
+def test_invalid_history_falls_back_to_the_time_of_day():
+    result = fallback.fallback_recommendation(
+        HISTORIES["invalid"], now=datetime(2025, 1, 31, 21, 0))
+
+    assert result["lightSetting"] == {"power": True, "color": [180, 100, 50]}
+
+
+def test_client_time_is_preferred_over_the_server_time():
+    now = datetime(2025, 1, 31, 13, 0)
+    assert fallback.current_hour({"time": "06:15:00"}, now) == 6
+    assert fallback.current_hour({"time": "25:00:00"}, now) == 13
+    assert fallback.current_hour(None, now) == 13
+
+
+def test_hours_before_the_first_palette_entry_use_the_last():
+    assert fallback.palette_setting(2) == fallback.palette_setting(23)
+
+
+@pytest.mark.parametrize("function", AI_FUNCTIONS)
+def test_truncated_answers_are_rejected(function):
+    model_response = load(function, "model_response")
+    answer = as_model_answer(fallback.fallback_recommendation([]))
+    answer.candidates[0].finish_reason = "MAX_TOKENS"
+
+    assert model_response.is_truncated(answer)
+    assert model_response.verify_and_parse_json(answer) is None
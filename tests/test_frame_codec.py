@@ -0,0 +1,59 @@
+"""
+Tests of the binary device frames in lambda/result_save_send/frame_codec.py.
+"""
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+from frame_codec import (FRAME_MAGIC, FRAME_VERSION, decode_frame,  # noqa: E402
+                         encode_frame)
+
+
+def test_plan_message_round_trips():
+    message = {
+        "codes": {"power": "FF02FD", "rup": "FF28D7"},
+        "codeVersion": 3,
+        "trace": "abc123",
+        "seq": 7,
+        "steps": [16, 16, 16],
+        "irGap": 70,
+        "plan": [["power", 1], ["preset", "FF1AE5", 255, 0, 0], ["adjust", 175, 96, 48]],
+    }
+
+    assert decode_frame(encode_frame(message)) == message
+
+
+def test_legacy_inline_codes_are_sent_as_the_code_set():
+    frame = encode_frame({"power": "ff02fd", "rgbCode": [1, 2, 3]})
+
+    assert decode_frame(frame) == {"codes": {"power": "FF02FD"}, "rgbCode": [1, 2, 3]}
+
+
+def test_dynamic_mode_round_trips():
+    assert decode_frame(encode_frame({"mode": "FADE7"})) == {"mode": "fade7"}
+
+
+def test_seq_is_sent_modulo_2_32():
+    assert decode_frame(encode_frame({"seq": 2 ** 32 + 5}))["seq"] == 5
+
+
+def test_unknown_records_are_skipped():
+    frame = encode_frame({"seq": 9, "rgbCode": [10, 20, 30]})
+    unknown = struct.pack(">BB", 0x7F, 3) + b"\x01\x02\x03"
+    # Insert the unknown record between the header and the known records
+    frame = frame[:2] + unknown + frame[2:]
+
+    assert decode_frame(frame) == {"seq": 9, "rgbCode": [10, 20, 30]}
+
+
+def test_malformed_frames_are_rejected():
+    with pytest.raises(ValueError):
+        decode_frame(b'{"seq": 1}')
+    with pytest.raises(ValueError):
+        decode_frame(bytes([FRAME_MAGIC, FRAME_VERSION + 1]))
+    with pytest.raises(ValueError):
+        decode_frame(encode_frame({"seq": 1})[:-1])
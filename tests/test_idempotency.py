@@ -0,0 +1,77 @@
+"""
+Tests of the requestId claims in lambda/result_save_send/idempotency.py.
+
+ProcessedRequestTable is a FakeTable that evaluates the conditional writes.
+"""
+import os
+import sys
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+from aws_fakes import FakeTable  # noqa: E402
+from idempotency import STATUS_DONE, STATUS_IN_PROGRESS, IdempotencyStore  # noqa: E402
+
+NOW = 1700000000
+
+
+def store():
+    return IdempotencyStore(FakeTable("ProcessedRequestTable"), ttl_seconds=86400,
+                            lease_seconds=60)
+
+
+def test_first_claim_wins():
+    idempotency_store = store()
+
+    assert idempotency_store.claim("r1", now=NOW)
+    item = idempotency_store.table.items[("r1",)]
+    assert item["status"] == STATUS_IN_PROGRESS
+    assert item["leaseUntil"] == NOW + 60
+    assert item["expiresAt"] == NOW + 86400
+
+
+def test_concurrent_claim_inside_the_lease_is_refused():
+    idempotency_store = store()
+
+    assert idempotency_store.claim("r1", now=NOW)
+    assert not idempotency_store.claim("r1", now=NOW + 59)
+
+
+def test_claim_after_the_lease_expired_takes_over():
+    idempotency_store = store()
+
+    assert idempotency_store.claim("r1", now=NOW)
+    assert idempotency_store.claim("r1", now=NOW + 61)
+    assert idempotency_store.table.items[("r1",)]["leaseUntil"] == NOW + 121
+
+
+def test_completed_request_is_never_claimed_again():
+    idempotency_store = store()
+
+    assert idempotency_store.claim("r1", now=NOW)
+    idempotency_store.complete("r1")
+    item = idempotency_store.table.items[("r1",)]
+    assert item["status"] == STATUS_DONE
+    assert "leaseUntil" not in item
+    assert not idempotency_store.claim("r1", now=NOW + 3600)
+
+
+def test_release_makes_the_request_claimable_again():
+    idempotency_store = store()
+
+    assert idempotency_store.claim("r1", now=NOW)
+    idempotency_store.release("r1")
+    assert ("r1",) not in idempotency_store.table.items
+    assert idempotency_store.claim("r1", now=NOW + 1)
+
+
+def test_release_keeps_a_completed_claim():
+    idempotency_store = store()
+    idempotency_store.claim("r1", now=NOW)
+    idempotency_store.complete("r1")
+
+    with pytest.raises(ClientError):
+        idempotency_store.release("r1")
+    assert idempotency_store.table.items[("r1",)]["status"] == STATUS_DONE
@@ -0,0 +1,158 @@
+"""
+Tests of the IR transition planner in lambda/result_save_send/ir_planner.py.
+
+Estimates are in milliseconds of the hardware.ino timing model:
+a power toggle is one frame plus its send delay (158 ms), switching on adds
+a 150 ms settle, and every up/down pulse costs a frame plus a 70 ms gap.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+from ir_planner import (  # noqa: E402
+    DIY_ENTRY_MS,
+    IR_FRAME_MS,
+    PULSE_GAP_MS,
+    SEND_DELAY_MS,
+    estimate_adjust_ms,
+    plan_transition,
+    resulting_state,
+)
+
+POWER_OFF_MS = IR_FRAME_MS + SEND_DELAY_MS
+POWER_ON_MS = POWER_OFF_MS + 150
+PULSE_MS = IR_FRAME_MS + PULSE_GAP_MS
+# 255 pulses: 25 batch pauses of 70 ms
+FULL_SWEEP_MS = 255 * PULSE_MS + 25 * 70
+
+WHITE = [255, 255, 255]
+
+
+def test_already_at_target_is_a_no_op():
+    current = {"power": True, "rgb": [200, 100, 50], "dynamic": False}
+
+    steps, estimate = plan_transition(current, {"power": True, "rgb": [200, 100, 50]})
+
+    assert steps == []
+    assert estimate == 0
+    assert resulting_state(current, steps) == current
+
+
+def test_power_off_when_already_off_is_a_no_op():
+    current = {"power": False, "rgb": [10, 10, 10], "dynamic": False}
+
+    assert plan_transition(current, {"power": False}) == ([], 0)
+
+
+def test_black_target_is_one_power_pulse():
+    current = {"power": True, "rgb": WHITE, "dynamic": False}
+
+    steps, estimate = plan_transition(current, {"power": True, "rgb": [0, 0, 0]})
+
+    assert steps == [["power", 0]]
+    assert estimate == POWER_OFF_MS == 158
+    assert resulting_state(current, steps) == {
+        "power": False, "rgb": WHITE, "dynamic": False}
+
+
+def test_black_target_from_dynamic_mode_only_switches_off():
+    # Intended: the strip goes dark with one pulse and the controller keeps
+    # its mode, so the state stays dynamic and the next color request
+    # re-enters DIY mode instead of trusting a stale rgb
+    current = {"power": True, "rgb": [40, 80, 120], "dynamic": True}
+
+    steps, estimate = plan_transition(current, {"power": True, "rgb": [0, 0, 0]})
+
+    assert steps == [["power", 0]]
+    assert estimate == 158
+    state = resulting_state(current, steps)
+    assert state == {"power": False, "rgb": [40, 80, 120], "dynamic": True}
+
+    steps, _ = plan_transition(state, {"power": True, "rgb": [40, 80, 120]})
+    assert steps == [["power", 1], ["adjust", 40, 80, 120]]
+
+
+def test_unknown_state_powers_on_and_adjusts_from_worst_case():
+    steps, estimate = plan_transition(None, {"power": True, "rgb": WHITE})
+
+    assert steps == [["power", 1], ["adjust", 255, 255, 255]]
+    # Worst case start is black: three full sweeps after entering DIY mode
+    assert estimate == POWER_ON_MS + DIY_ENTRY_MS + 3 * FULL_SWEEP_MS + 2 * 100
+    assert estimate == 142594
+    assert resulting_state(None, steps) == {
+        "power": True, "rgb": WHITE, "dynamic": False}
+
+
+def test_off_state_powers_on_and_adjusts_from_last_color():
+    current = {"power": False, "rgb": [250, 255, 255], "dynamic": False}
+
+    steps, estimate = plan_transition(current, {"power": True, "rgb": WHITE})
+
+    assert steps == [["power", 1], ["adjust", 255, 255, 255]]
+    assert estimate == POWER_ON_MS + DIY_ENTRY_MS + 5 * PULSE_MS == 1864
+    assert resulting_state(current, steps) == {
+        "power": True, "rgb": WHITE, "dynamic": False}
+
+
+def test_off_state_at_target_color_only_powers_on():
+    current = {"power": False, "rgb": [120, 60, 30], "dynamic": False}
+
+    steps, estimate = plan_transition(current, {"power": True, "rgb": [120, 60, 30]})
+
+    assert steps == [["power", 1]]
+    assert estimate == POWER_ON_MS == 308
+    assert resulting_state(current, steps)["power"] is True
+
+
+def test_adjustable_preset_beats_a_long_walk():
+    current = {"power": True, "rgb": [0, 0, 255], "dynamic": False}
+    presets = [{"code": "0xF7E01F", "rgb": [255, 0, 0], "adjustable": True}]
+
+    walk_ms = estimate_adjust_ms([0, 0, 255], [250, 0, 0])
+    steps, estimate = plan_transition(current, {"power": True, "rgb": [250, 0, 0]}, presets)
+
+    assert steps == [["preset", "0xF7E01F", 255, 0, 0], ["adjust", 250, 0, 0]]
+    assert estimate == POWER_OFF_MS + 5 * PULSE_MS == 1048
+    assert estimate < walk_ms
+    assert resulting_state(current, steps) == {
+        "power": True, "rgb": [250, 0, 0], "dynamic": False}
+
+
+def test_non_adjustable_preset_is_used_on_exact_match():
+    current = {"power": True, "rgb": [0, 0, 255], "dynamic": False}
+    presets = [{"code": "0xF7E01F", "rgb": [255, 0, 0], "adjustable": False}]
+
+    steps, estimate = plan_transition(current, {"power": True, "rgb": [255, 0, 0]}, presets)
+
+    assert steps == [["preset", "0xF7E01F", 255, 0, 0]]
+    assert estimate == POWER_OFF_MS
+    assert resulting_state(current, steps) == {
+        "power": True, "rgb": [255, 0, 0], "dynamic": False}
+
+
+def test_non_adjustable_preset_is_not_used_near_a_match():
+    current = {"power": True, "rgb": [0, 0, 255], "dynamic": False}
+    presets = [{"code": "0xF7E01F", "rgb": [255, 0, 0], "adjustable": False}]
+
+    steps, estimate = plan_transition(current, {"power": True, "rgb": [250, 0, 0]}, presets)
+
+    assert steps == [["adjust", 250, 0, 0]]
+    assert estimate == estimate_adjust_ms([0, 0, 255], [250, 0, 0])
+
+
+def test_dynamic_mode_re_enters_diy_without_a_color_change():
+    current = {"power": True, "rgb": [10, 20, 30], "dynamic": True}
+
+    steps, estimate = plan_transition(current, {"power": True, "rgb": [10, 20, 30]})
+
+    assert steps == [["adjust", 10, 20, 30]]
+    assert estimate == DIY_ENTRY_MS
+    assert resulting_state(current, steps)["dynamic"] is False
+
+
+def test_capability_steps_scale_the_estimate():
+    # A controller with 32 levels per channel needs 8 pulses for a 64 change
+    estimate = estimate_adjust_ms([0, 0, 0], [64, 0, 0], steps=[32, 32, 32])
+
+    assert estimate == DIY_ENTRY_MS + 8 * PULSE_MS
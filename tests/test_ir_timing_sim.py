@@ -0,0 +1,35 @@
+"""
+Tests of the planner benchmark in tools/ir_timing_sim.py.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tools"))
+
+from ir_timing_sim import benchmark, legacy_message, simulate  # noqa: E402
+
+
+def test_estimates_match_the_simulator():
+    for row in benchmark():
+        assert row["plannedReached"], row["scenario"]
+        # The planner leaves out the serial echo of the message, a few ms
+        assert 0 <= row["plannedMs"] - row["estimateMs"] < 20, row["scenario"]
+
+
+def test_legacy_runs_that_miss_the_target_have_no_time():
+    rows = {row["scenario"]: row for row in benchmark()}
+
+    for name in ("off -> warm white", "off -> warm white, 16 steps",
+                 "dynamic -> same color"):
+        assert rows[name]["legacyReached"] is False
+        assert rows[name]["legacyMs"] is None
+    assert rows["red -> blue"]["legacyReached"] is True
+    assert rows["on -> black"]["legacyMs"] > rows["on -> black"]["plannedMs"]
+
+
+def test_legacy_message_leaves_an_off_device_off():
+    result = simulate(legacy_message([255, 180, 100]), power=False,
+                      supports_plan=False)
+
+    assert result["state"]["power"] is False
+    assert result["irFrames"] == 0
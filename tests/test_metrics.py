@@ -0,0 +1,112 @@
+"""
+Tests of the EMF stage metrics in lambda/result_save_send/metrics.py.
+
+The module is copied into every lambda; test_shared_modules.py keeps the
+copies identical.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+from metrics import MAX_VALUES, METRICS_NAMESPACE, StageMetrics, get_trace_id  # noqa: E402
+
+NOW = 1700000000.0
+
+
+def test_record_has_the_emf_shape():
+    metrics = StageMetrics("audio_to_ai", model="gemini-2.0-flash", enabled=True)
+    metrics.put("auth", 12.345)
+    metrics.put("model_call", 100)
+    metrics.put("model_call", 200)
+    metrics.count("retries", 1)
+    metrics.set_property("requestId", "r1")
+
+    record = metrics.render(now=NOW)
+
+    assert record["_aws"] == {
+        "Timestamp": int(NOW * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": METRICS_NAMESPACE,
+            "Dimensions": [["Function", "Model"]],
+            "Metrics": [
+                {"Name": "auth", "Unit": "Milliseconds"},
+                {"Name": "model_call", "Unit": "Milliseconds"},
+                {"Name": "retries", "Unit": "Count"},
+            ],
+        }],
+    }
+    assert record["Function"] == "audio_to_ai"
+    assert record["Model"] == "gemini-2.0-flash"
+    assert record["auth"] == 12.35
+    assert record["model_call"] == [100, 200]
+    assert record["retries"] == 1
+    assert record["requestId"] == "r1"
+
+
+def test_record_without_a_model_has_only_the_function_dimension():
+    metrics = StageMetrics("ws_messenger", enabled=True)
+    metrics.put("connect", 5)
+
+    record = metrics.render(now=NOW)
+
+    assert record["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Function"]]
+    assert "Model" not in record
+
+
+def test_values_per_metric_are_capped():
+    metrics = StageMetrics("f", enabled=True)
+    for value in range(MAX_VALUES + 10):
+        metrics.put("stage", value)
+
+    assert len(metrics.render(now=NOW)["stage"]) == MAX_VALUES
+
+
+def test_stage_records_a_metric_and_a_span():
+    metrics = StageMetrics("f", enabled=True)
+    with metrics.stage("auth"):
+        pass
+    metrics.add_span("deliver:AA", 1.0, 1.5, metric=False)
+
+    record = metrics.render(now=NOW)
+
+    assert [span[0] for span in record["spans"]] == ["auth", "deliver:AA"]
+    assert record["spans"][1][2] == 500
+    assert "auth" in record and "deliver:AA" not in record
+
+
+def test_flush_prints_one_bare_json_line_and_starts_over(capsys):
+    metrics = StageMetrics("f", enabled=True)
+    metrics.put("stage", 1)
+
+    metrics.flush()
+    metrics.flush()
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])["stage"] == 1
+
+
+def test_disabled_metrics_collect_nothing(capsys):
+    metrics = StageMetrics("f", enabled=False)
+    with metrics.stage("auth"):
+        pass
+    metrics.put("stage", 1)
+    metrics.set_property("requestId", "r1")
+
+    assert metrics.render(now=NOW) is None
+    metrics.flush()
+    assert capsys.readouterr().out == ""
+
+
+def test_trace_id_comes_from_a_valid_header():
+    event = {"headers": {"X-Trace-Id": "client-trace_1"}}
+    assert get_trace_id(event, "request-id") == "client-trace_1"
+
+
+def test_invalid_or_missing_trace_header_falls_back_to_the_default():
+    assert get_trace_id({"headers": {"x-trace-id": "a" * 33}}, "r1") == "r1"
+    assert get_trace_id({"headers": {"x-trace-id": "bad id"}}, "r1") == "r1"
+    assert get_trace_id({"headers": None}, "r1") == "r1"
+    assert get_trace_id({}, "r1") == "r1"
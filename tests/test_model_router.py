@@ -0,0 +1,106 @@
+"""
+Tests of the model routing in lambda/audio_to_ai/model_router.py.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "audio_to_ai"))
+
+from model_router import ModelRouter, parse_tiers  # noqa: E402
+
+NOW = 1000.0
+LITE = "gemini-2.0-flash-lite"
+FLASH = "gemini-2.0-flash"
+PRO = "gemini-2.5-pro"
+
+
+def router(**settings):
+    options = dict(slo_seconds=4, percentile=0.9, min_validity=0.8, min_samples=5,
+                   window_seconds=300)
+    options.update(settings)
+    return ModelRouter([(LITE, 5), (FLASH, 20), (PRO, None)], **options)
+
+
+def record(model_router, model, seconds, valid=True, times=5, now=NOW):
+    for _ in range(times):
+        model_router.record(model, seconds, valid, now)
+
+
+def test_parse_tiers_makes_the_last_tier_take_any_size():
+    assert parse_tiers(f" {LITE}:5, {FLASH}:20 ,") == [(LITE, 5.0), (FLASH, None)]
+    with pytest.raises(ValueError):
+        parse_tiers(" , ")
+
+
+def test_lightest_fitting_tier_is_chosen():
+    model_router = router()
+
+    assert model_router.choose(3, now=NOW) == LITE
+    assert model_router.choose(10, now=NOW) == FLASH
+    assert model_router.choose(50, now=NOW) == PRO
+    # Without a size only the last tier is known to fit
+    assert model_router.choose(None, now=NOW) == PRO
+
+
+def test_tiers_with_too_few_samples_count_as_healthy():
+    model_router = router()
+    record(model_router, LITE, 30, valid=False, times=4)
+
+    assert model_router.choose(3, now=NOW) == LITE
+
+
+def test_slow_tier_is_skipped():
+    model_router = router()
+    record(model_router, LITE, 6)
+
+    assert model_router.choose(3, now=NOW) == FLASH
+
+
+def test_tier_with_invalid_answers_is_skipped():
+    model_router = router()
+    record(model_router, LITE, 1, valid=False, times=2)
+    record(model_router, LITE, 1, valid=True, times=3)
+
+    assert model_router.choose(3, now=NOW) == FLASH
+
+
+def test_budget_tightens_the_latency_target():
+    model_router = router()
+    record(model_router, LITE, 3)
+
+    assert model_router.choose(3, now=NOW) == LITE
+    assert model_router.choose(3, budget_seconds=2, now=NOW) == FLASH
+
+
+def test_excluded_tier_is_passed_over():
+    model_router = router()
+
+    assert model_router.choose(3, exclude=(LITE,), now=NOW) == FLASH
+
+
+def test_excluding_every_tier_keeps_the_lightest_fitting_one():
+    model_router = router()
+
+    assert model_router.choose(10, exclude=(LITE, FLASH, PRO), now=NOW) == FLASH
+
+
+def test_without_a_healthy_tier_the_fastest_valid_one_is_chosen():
+    model_router = router()
+    record(model_router, LITE, 5)
+    record(model_router, FLASH, 9)
+    record(model_router, PRO, 1, valid=False)
+
+    # Too big for the lite tier, but a late answer is worse
+    assert model_router.choose(50, now=NOW) == LITE
+    assert model_router.choose(50, exclude=(LITE,), now=NOW) == FLASH
+
+
+def test_samples_age_out_of_the_window():
+    model_router = router()
+    record(model_router, LITE, 30, valid=False)
+
+    assert model_router.choose(3, now=NOW + 100) == FLASH
+    assert model_router.choose(3, now=NOW + 301) == LITE
+    assert model_router.snapshot(now=NOW + 301)[LITE]["samples"] == 0
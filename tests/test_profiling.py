@@ -0,0 +1,84 @@
+"""
+Tests of the on-demand profiler in lambda/result_save_send/profiling.py.
+
+The module is copied into every lambda; test_shared_modules.py keeps the
+copies identical. Profiles are written to a temporary PROFILE_DIR.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+import profiling  # noqa: E402
+
+
+class Context:
+    aws_request_id = "req-1"
+
+
+def handler(event, context):
+    return {"statusCode": 200, "headers": {"Content-Type": "application/json"},
+            "body": str(sum(range(1000)))}
+
+
+@pytest.fixture
+def profile_mode(monkeypatch, tmp_path):
+    def set_mode(mode, token=""):
+        monkeypatch.setattr(profiling, "PROFILE_MODE", mode)
+        monkeypatch.setattr(profiling, "PROFILE_TOKEN", token)
+        monkeypatch.setattr(profiling, "PROFILE_ENABLED", mode == "all" or (
+            mode == "header" and bool(token)))
+    monkeypatch.setattr(profiling, "PROFILE_BUCKET", None)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "PROFILE_MEMORY", False)
+    monkeypatch.setattr(profiling, "_profiled_count", 0)
+    return set_mode
+
+
+def test_off_returns_the_handler_unchanged(profile_mode):
+    profile_mode("off")
+    assert profiling.profiled("f")(handler) is handler
+
+
+def test_header_mode_without_a_token_stays_off(profile_mode):
+    profile_mode("header")
+    assert profiling.profiled("f")(handler) is handler
+
+
+def test_header_mode_profiles_only_requests_with_the_token(profile_mode, tmp_path):
+    profile_mode("header", token="secret")
+    wrapped = profiling.profiled("f")(handler)
+
+    plain = wrapped({"headers": {"X-Profile": "wrong"}}, Context())
+    assert profiling.LOCATION_HEADER not in plain["headers"]
+    assert not list(tmp_path.iterdir())
+
+    response = wrapped({"headers": {"X-Profile": "secret"}}, Context())
+    location = response["headers"][profiling.LOCATION_HEADER]
+    assert location.startswith(os.path.join(str(tmp_path), "f"))
+    assert location.endswith("req-1")
+    for extension in (".collapsed", ".txt", ".pstats"):
+        assert os.path.exists(location + extension)
+    assert response["body"] == handler({}, None)["body"]
+
+
+def test_profiled_invocations_are_capped(profile_mode, monkeypatch):
+    profile_mode("all")
+    monkeypatch.setattr(profiling, "PROFILE_LIMIT", 1)
+    wrapped = profiling.profiled("f")(handler)
+
+    assert profiling.LOCATION_HEADER in wrapped({}, Context())["headers"]
+    assert profiling.LOCATION_HEADER not in wrapped({}, Context())["headers"]
+
+
+def test_collapsed_stacks_have_frames_and_microseconds(profile_mode):
+    profile_mode("all")
+    location = profiling.profiled("f")(handler)({}, Context())["headers"][
+        profiling.LOCATION_HEADER]
+
+    with open(location + ".collapsed") as f:
+        lines = f.read().splitlines()
+    assert any("handler (test_profiling.py:" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
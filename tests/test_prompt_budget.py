@@ -0,0 +1,89 @@
+"""
+Tests of the prompt token budget in lambda/pattern_to_ai/prompt_budget.py
+and of the truncation check in lambda/*/model_response.py.
+"""
+import json
+import os
+import sys
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "pattern_to_ai"))
+
+from lambda_modules import load  # noqa: E402
+from prompt_budget import (DecimalEncoder, budget_history, estimate_tokens,  # noqa: E402
+                           minutes_apart)
+
+
+def item(time_of_day, color=(1, 2, 3)):
+    return {"TIME#DAY": f"TIME#{time_of_day}#DAY#4",
+            "lightSetting": {"power": True, "color": [Decimal(c) for c in color]}}
+
+
+def cost(past_item):
+    # Tokens of an item plus its separator
+    return estimate_tokens(json.dumps(past_item, cls=DecimalEncoder)) + 1
+
+
+def test_estimate_rounds_up():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 2
+
+
+def test_minutes_apart_wraps_around_midnight():
+    assert minutes_apart("23:50:00", "00:10") == 20
+    assert minutes_apart("06:00", "18:00") == 720
+    assert minutes_apart("bad", "12:00") is None
+    assert minutes_apart(None, "12:00") is None
+
+
+def test_history_that_fits_is_kept_whole_and_in_order():
+    history = [item("08:00:00"), item("20:00:00", (4, 5, 6))]
+
+    text, dropped = budget_history(history, "12:00:00", 10 ** 6)
+
+    assert dropped == 0
+    assert json.loads(text) == [
+        {"TIME#DAY": "TIME#08:00:00#DAY#4", "lightSetting": {"power": True, "color": [1, 2, 3]}},
+        {"TIME#DAY": "TIME#20:00:00#DAY#4", "lightSetting": {"power": True, "color": [4, 5, 6]}},
+    ]
+
+
+def test_items_farthest_from_the_time_of_day_are_dropped_first():
+    history = [item("21:00:00"), item("12:30:00"), item("03:00:00"), item("11:00:00")]
+    # Room for two items besides the list brackets
+    budget = 1 + 2 * cost(history[0])
+
+    text, dropped = budget_history(history, "12:00:00", budget)
+
+    assert dropped == 2
+    assert [kept["TIME#DAY"] for kept in json.loads(text)] == [
+        "TIME#12:30:00#DAY#4", "TIME#11:00:00#DAY#4"]
+
+
+def test_items_without_a_time_are_dropped_first():
+    history = [{"lightSetting": {"power": False}}, item("12:00:00")]
+
+    text, dropped = budget_history(history, "00:00:00", 1 + cost(history[1]))
+
+    assert dropped == 1
+    assert json.loads(text)[0]["TIME#DAY"] == "TIME#12:00:00#DAY#4"
+
+
+def test_nothing_is_kept_when_no_item_fits():
+    assert budget_history([item("12:00:00")], "12:00:00", 5) == (None, 1)
+    assert budget_history([], "12:00:00", 1000) == (None, 0)
+
+
+@pytest.mark.parametrize("function", ["audio_to_ai", "pattern_to_ai"])
+@pytest.mark.parametrize("candidates, truncated", [
+    ([], False),
+    (None, False),
+    ([SimpleNamespace(finish_reason="STOP")], False),
+    ([SimpleNamespace(finish_reason="MAX_TOKENS")], True),
+])
+def test_is_truncated(function, candidates, truncated):
+    model_response = load(function, "model_response")
+    assert model_response.is_truncated(SimpleNamespace(candidates=candidates)) is truncated
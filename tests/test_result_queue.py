@@ -0,0 +1,98 @@
+"""
+Tests of the result queue hop: messages in tools/local_queue.py drained
+through result_save_send.sqs_handler.
+
+DynamoDB and the API Gateway Management client are replaced by the
+in-memory fakes of aws_fakes.py, so no AWS call is made.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(HERE, "..", "lambda", "result_save_send"))
+sys.path.insert(0, os.path.join(HERE, "..", "tools"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("WEBSOCKET_URL", "wss://example.execute-api.us-east-1.amazonaws.com/dev")
+os.environ.setdefault("PRECONNECT_WEBSOCKET", "false")
+
+import result_save_send  # noqa: E402
+from aws_fakes import add_connection, install_result_save_send  # noqa: E402
+from local_queue import InMemoryQueue  # noqa: E402
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    return install_result_save_send(result_save_send, monkeypatch, errors={
+        "conn-retry": "LimitExceededException",
+        "conn-gone": "GoneException",
+    })
+
+
+def result(uuid, request_id, seq, color):
+    return json.dumps({
+        "uuid": uuid,
+        "request_id": request_id,
+        "seq": seq,
+        "lightSetting": {"power": True, "color": color},
+        "emotion": {"main": "Positive", "subcategories": []},
+        "context": "test",
+    })
+
+
+def test_drain_retries_only_retryable_failures_and_drops_older_results(aws):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "retry-user", "conn-retry")
+    add_connection(dynamodb, "gone-user", "conn-gone")
+    add_connection(dynamodb, "busy-user", "conn-busy")
+
+    queue = InMemoryQueue(max_receives=3)
+    queue.send_message(QueueUrl=queue.url, MessageBody=result("retry-user", "r1", 1, [255, 0, 0]))
+    queue.send_message(QueueUrl=queue.url, MessageBody=result("gone-user", "g1", 1, [0, 255, 0]))
+    queue.send_message(QueueUrl=queue.url, MessageBody=result("busy-user", "b1", 1, [0, 0, 255]))
+    queue.send_message(QueueUrl=queue.url, MessageBody=result("busy-user", "b2", 2, [255, 255, 255]))
+
+    invocations = queue.drain(result_save_send.sqs_handler, batch_size=10)
+
+    # The throttled result is re-queued until the redrive policy gives up;
+    # its claim is released every time so the redelivery runs again
+    assert len(apigateway.sent("conn-retry")) == 3
+    assert invocations == 3
+    assert [json.loads(message["body"])["request_id"]
+            for message in queue.dead_letters] == ["r1"]
+
+    # The gone connection is posted to once and its row is removed
+    assert len(apigateway.sent("conn-gone")) == 1
+    connections = dynamodb.Table("ConnectionIdTable").items
+    assert ("gone-user", "default") not in connections
+    assert ("busy-user", "default") in connections
+
+    # Of the two results for the same device only the newer one is sent
+    busy_posts = apigateway.sent("conn-busy")
+    assert [data["seq"] for data in busy_posts] == [2]
+    assert busy_posts[0]["rgbCode"] == [255, 255, 255]
+    assert dynamodb.Table("DeviceStateTable").items[("busy-user",)]["lastSeq"] == 2
+
+    # Every result is stored, the dropped older one included
+    stored = sorted(request_id for _, request_id in dynamodb.Table("ResponseTable").items)
+    assert stored == ["b1", "b2", "g1", "r1"]
+
+
+def test_result_not_newer_than_the_stored_command_is_dropped(aws):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "busy-user", "conn-busy")
+    dynamodb.Table("DeviceStateTable").put_item(Item={
+        "deviceId": "busy-user", "power": True, "rgb": [255, 255, 255],
+        "dynamic": False, "lastSeq": 5})
+
+    queue = InMemoryQueue()
+    queue.send_message(QueueUrl=queue.url, MessageBody=result("busy-user", "b4", 4, [0, 0, 255]))
+    queue.drain(result_save_send.sqs_handler)
+
+    assert apigateway.posts == []
+    assert queue.dead_letters == []
+    assert not queue.messages
+    assert ("uuid#busy-user", "b4") in dynamodb.Table("ResponseTable").items
@@ -0,0 +1,337 @@
+"""
+Tests of result delivery in lambda/result_save_send/result_save_send.py.
+
+DynamoDB and the API Gateway Management client are replaced by the
+in-memory fakes of aws_fakes.py, so no AWS call is made.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+import pytest
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(HERE, "..", "lambda", "result_save_send"))
+sys.path.insert(0, os.path.join(HERE, "..", "tools"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("WEBSOCKET_URL", "wss://example.execute-api.us-east-1.amazonaws.com/dev")
+os.environ.setdefault("PRECONNECT_WEBSOCKET", "false")
+
+import result_save_send  # noqa: E402
+from aws_fakes import add_connection, install_result_save_send  # noqa: E402
+from frame_codec import decode_frame  # noqa: E402
+from idempotency import STATUS_DONE  # noqa: E402
+from trace_waterfall import collect_spans  # noqa: E402
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    return install_result_save_send(result_save_send, monkeypatch)
+
+
+def result_event(uuid="user", request_id="r1", seq=None, color=(255, 0, 0), **fields):
+    event = {
+        "uuid": uuid,
+        "request_id": request_id,
+        "lightSetting": {"power": True, "color": list(color)},
+        "emotion": {"main": "Positive", "subcategories": []},
+        "context": "test",
+    }
+    if seq is not None:
+        event["seq"] = seq
+    event.update(fields)
+    return event
+
+
+def test_failed_delivery_releases_the_claim_and_is_retried_once(aws):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1")
+    apigateway.errors["conn-1"] = "LimitExceededException"
+    event = result_event()
+
+    # The async invocation fails, so Lambda retries it
+    with pytest.raises(result_save_send.ResultDeliveryError):
+        result_save_send.lambda_handler(dict(event), None)
+    assert ("r1",) not in dynamodb.Table("ProcessedRequestTable").items
+
+    # The retry is processed and completes the claim
+    del apigateway.errors["conn-1"]
+    response = result_save_send.lambda_handler(dict(event), None)
+    assert response["statusCode"] == 200
+    assert dynamodb.Table("ProcessedRequestTable").items[("r1",)]["status"] == STATUS_DONE
+
+    # A further redelivery is skipped
+    result_save_send.lambda_handler(dict(event), None)
+    assert len(apigateway.sent("conn-1")) == 2
+    assert ("uuid#user", "r1") in dynamodb.Table("ResponseTable").items
+
+
+def batch(*events):
+    return {"Records": [{
+        "messageId": f"m{index}",
+        "body": json.dumps(event),
+        "eventSource": "aws:sqs",
+        "attributes": {"SentTimestamp": str(1700000000000 + index)},
+    } for index, event in enumerate(events)]}
+
+
+def test_batch_sends_the_highest_seq(aws):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1")
+
+    response = result_save_send.sqs_handler(batch(
+        result_event(request_id="r2", seq=2, color=(0, 0, 255)),
+        result_event(request_id="r1", seq=1, color=(255, 0, 0))), None)
+
+    assert response == {"batchItemFailures": []}
+    assert [message["seq"] for message in apigateway.sent("conn-1")] == [2]
+
+
+def test_unsequenced_result_never_replaces_a_sequenced_one(aws):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1")
+
+    result_save_send.sqs_handler(batch(
+        result_event(request_id="r1", seq=5, color=(255, 0, 0)),
+        result_event(request_id="r2", color=(0, 0, 255), handoffAt=1700000009000)), None)
+
+    sent = apigateway.sent("conn-1")
+    assert len(sent) == 1
+    assert sent[0]["seq"] == 5
+
+
+def test_unsequenced_results_collapse_to_the_latest_handoff(aws):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1")
+
+    # Queued out of order: the first message was handed off last
+    result_save_send.sqs_handler(batch(
+        result_event(request_id="r2", color=(0, 0, 255), handoffAt=1700000002000),
+        result_event(request_id="r1", color=(255, 0, 0), handoffAt=1700000001000)), None)
+
+    sent = apigateway.sent("conn-1")
+    assert len(sent) == 1
+    assert sent[0]["rgbCode"] == [0, 0, 255]
+
+
+def test_stale_seq_is_stored_but_not_sent(aws):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1")
+    dynamodb.Table("DeviceStateTable").put_item(Item={
+        "deviceId": "user", "power": True, "rgb": [0, 0, 255], "dynamic": False,
+        "lastSeq": 10})
+
+    result_save_send.lambda_handler(result_event(seq=9), None)
+
+    assert apigateway.posts == []
+    assert ("uuid#user", "r1") in dynamodb.Table("ResponseTable").items
+    assert dynamodb.Table("DeviceStateTable").items[("user",)]["lastSeq"] == 10
+    assert dynamodb.Table("ProcessedRequestTable").items[("r1",)]["status"] == STATUS_DONE
+
+
+def test_results_within_the_coalesce_window_collapse_to_the_newer(aws, monkeypatch):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1")
+    monkeypatch.setattr(result_save_send, "COALESCE_WINDOW_MS", 100)
+
+    async def both():
+        await asyncio.gather(
+            result_save_send.main(result_event(request_id="r1", seq=1), None),
+            result_save_send.main(
+                result_event(request_id="r2", seq=2, color=(0, 0, 255)), None))
+
+    asyncio.get_event_loop().run_until_complete(both())
+
+    sent = apigateway.sent("conn-1")
+    assert [message["seq"] for message in sent] == [2]
+    assert sent[0]["rgbCode"] == [0, 0, 255]
+    assert dynamodb.Table("DeviceStateTable").items[("user",)]["lastSeq"] == 2
+
+
+def code_table(version=3):
+    return {"codes": {12: "FF00AA", 18: "FF00FF"},
+            "profile": {"codeVersion": version}}
+
+
+def legacy_message():
+    return {"power": "FF00FF", "rup": "FF00AA", "rgbCode": [255, 0, 0], "mode": "plan"}
+
+
+def test_code_sync_keeps_inline_codes_for_unversioned_devices():
+    message = legacy_message()
+
+    assert result_save_send.apply_code_sync(message, code_table(), None) is None
+    assert message == {"power": "FF00FF", "rup": "FF00AA", "rgbCode": [255, 0, 0]}
+
+
+def test_code_sync_skips_the_code_set_when_the_device_is_current():
+    message = legacy_message()
+
+    assert result_save_send.apply_code_sync(message, code_table(), 3) is None
+    assert message == {"mode": "plan"}
+
+
+def test_code_sync_resends_the_code_set_when_the_device_is_stale():
+    message = legacy_message()
+
+    assert result_save_send.apply_code_sync(message, code_table(), 2) == 3
+    assert message["codeVersion"] == 3
+    assert message["codes"]["rup"] == "FF00AA"
+    assert message["codes"]["power"] == "FF00FF"
+    assert "rup" not in message
+
+
+def test_stale_device_is_sent_the_code_set_once(aws):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1", codeVersion=2)
+    dynamodb.Table("IrCodeTable").put_item(Item={
+        "deviceType": "light", "id": result_save_send.CAPABILITY_PROFILE_ID,
+        "codeVersion": 3})
+
+    result_save_send.lambda_handler(result_event(request_id="r1", seq=1), None)
+    result_save_send.lambda_handler(
+        result_event(request_id="r2", seq=2, color=(0, 0, 255)), None)
+
+    first, second = apigateway.sent("conn-1")
+    assert first["codeVersion"] == 3 and "codes" in first
+    assert "codes" not in second and "codeVersion" not in second
+    connection = dynamodb.Table("ConnectionIdTable").items[("user", "default")]
+    assert connection["codeVersion"] == 3
+
+
+def test_connection_that_missed_its_heartbeats_is_skipped(aws):
+    dynamodb, apigateway = aws
+    now = int(time.time())
+    add_connection(dynamodb, "user", "conn-old", device_id="AA",
+                   lastSeen=now - result_save_send.PRESENCE_TIMEOUT - 1)
+    add_connection(dynamodb, "user", "conn-live", device_id="BB", lastSeen=now)
+    # Rows stored before heartbeats existed are never stale
+    add_connection(dynamodb, "user", "conn-legacy", device_id="CC")
+
+    result_save_send.lambda_handler(result_event(), None)
+
+    assert apigateway.sent("conn-old") == []
+    assert len(apigateway.sent("conn-live")) == 1
+    assert len(apigateway.sent("conn-legacy")) == 1
+
+
+def test_gone_connection_is_purged_unless_the_device_reconnected(aws, monkeypatch):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1", device_id="AA")
+    add_connection(dynamodb, "user", "conn-2", device_id="BB")
+    apigateway.errors.update({"conn-1": "GoneException", "conn-2": "GoneException"})
+    post = apigateway.post_to_connection
+
+    def post_then_reconnect(ConnectionId, Data):
+        # Device BB reconnects while its old connection is being posted to
+        if ConnectionId == "conn-2":
+            add_connection(dynamodb, "user", "conn-3", device_id="BB")
+        return post(ConnectionId=ConnectionId, Data=Data)
+
+    monkeypatch.setattr(apigateway, "post_to_connection", post_then_reconnect)
+
+    result_save_send.lambda_handler(result_event(), None)
+
+    rows = dynamodb.Table("ConnectionIdTable").items
+    assert ("user", "AA") not in rows
+    assert rows[("user", "BB")]["connectionId"] == "conn-3"
+
+
+def test_fan_out_failure_on_one_device_only_retries_that_device(aws):
+    dynamodb, apigateway = aws
+    for device_id in ("AA", "BB", "CC"):
+        add_connection(dynamodb, "user", f"conn-{device_id}", device_id=device_id)
+    apigateway.errors["conn-AA"] = "LimitExceededException"
+    event = result_event(seq=4)
+
+    with pytest.raises(result_save_send.ResultDeliveryError):
+        result_save_send.lambda_handler(dict(event), None)
+
+    # The other devices got the result and their state was stored
+    states = dynamodb.Table("DeviceStateTable").items
+    assert len(apigateway.sent("conn-BB")) == 1
+    assert len(apigateway.sent("conn-CC")) == 1
+    assert states[("user#BB",)]["lastSeq"] == 4
+    assert ("user#AA",) not in states
+
+    # The retry reaches the failed device without resending to the others
+    del apigateway.errors["conn-AA"]
+    result_save_send.lambda_handler(dict(event), None)
+
+    assert len(apigateway.sent("conn-AA")) == 2
+    assert len(apigateway.sent("conn-BB")) == 1
+    assert len(apigateway.sent("conn-CC")) == 1
+    assert states[("user#AA",)]["lastSeq"] == 4
+
+
+def add_reporting_connection(dynamodb, rgb, seq, at):
+    code_version = result_save_send.parse_capability_profile(None)["codeVersion"]
+    add_connection(dynamodb, "user", "conn-1", codeVersion=code_version, reported={
+        "power": True, "rgb": rgb, "dynamic": False, "seq": seq, "at": at})
+    dynamodb.Table("DeviceStateTable").put_item(Item={
+        "deviceId": "user", "power": True, "rgb": [0, 0, 255], "dynamic": False,
+        "lastSeq": 3})
+
+
+def test_device_that_reports_the_target_state_is_not_sent_anything(aws):
+    dynamodb, apigateway = aws
+    add_reporting_connection(dynamodb, [255, 0, 0], seq=3, at=int(time.time()))
+
+    result_save_send.lambda_handler(result_event(seq=4, color=(255, 0, 0)), None)
+
+    assert apigateway.posts == []
+    state = dynamodb.Table("DeviceStateTable").items[("user",)]
+    assert state["lastSeq"] == 4
+    assert state["rgb"] == [255, 0, 0]
+
+
+def test_report_behind_the_last_command_is_not_trusted(aws):
+    dynamodb, apigateway = aws
+    # The device has not applied command 3 yet, so its report may be outdated
+    add_reporting_connection(dynamodb, [255, 0, 0], seq=2, at=int(time.time()))
+
+    result_save_send.lambda_handler(result_event(seq=4, color=(255, 0, 0)), None)
+
+    assert len(apigateway.sent("conn-1")) == 1
+
+
+def test_old_report_is_not_trusted(aws):
+    dynamodb, apigateway = aws
+    add_reporting_connection(
+        dynamodb, [255, 0, 0], seq=3,
+        at=int(time.time()) - result_save_send.PRESENCE_TIMEOUT - 1)
+
+    result_save_send.lambda_handler(result_event(seq=4, color=(255, 0, 0)), None)
+
+    assert len(apigateway.sent("conn-1")) == 1
+
+
+def test_trace_id_is_passed_to_the_devices_and_the_metric_record(aws, capsys):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-json", device_id="AA")
+    add_connection(dynamodb, "user", "conn-binary", device_id="BB", frameFormat="binary")
+
+    result_save_send.lambda_handler(result_event(traceId="trace-1"), None)
+
+    assert apigateway.sent("conn-json")[0]["trace"] == "trace-1"
+    frame = dict(apigateway.posts)["conn-binary"]
+    assert decode_frame(frame)["trace"] == "trace-1"
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record["traceId"] for record in records] == ["trace-1"]
+    spans = collect_spans([json.dumps(record) for record in records], "trace-1")
+    assert {name for _, _, _, name in spans} >= {"deliver:AA", "deliver:BB"}
+
+
+def test_request_id_is_the_trace_id_without_one(aws, capsys):
+    dynamodb, apigateway = aws
+    add_connection(dynamodb, "user", "conn-1")
+
+    result_save_send.lambda_handler(result_event(request_id="r9"), None)
+
+    assert "trace" not in apigateway.sent("conn-1")[0]
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records[0]["traceId"] == "r9"
@@ -0,0 +1,68 @@
+"""
+Checks that the modules shared between the lambdas stay in sync.
+
+Every Lambda is packaged from its own directory, and ws-messenger ignores
+layer updates, so shared modules are copied into each directory that
+imports them. The copies must be byte-identical.
+"""
+import os
+from collections import defaultdict
+
+import pytest
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), "..", "lambda")
+
+ALL_FUNCTIONS = ("audio_to_ai", "pattern_to_ai", "result_save_send", "websocket")
+AI_FUNCTIONS = ("audio_to_ai", "pattern_to_ai")
+DEADLINE_FUNCTIONS = ("audio_to_ai", "pattern_to_ai", "result_save_send")
+
+# Module -> directories that carry a copy
+SHARED_MODULES = {
+    "metrics.py": ALL_FUNCTIONS,
+    "profiling.py": ALL_FUNCTIONS,
+    "warmup.py": ALL_FUNCTIONS,
+    "deadline.py": DEADLINE_FUNCTIONS,
+    "admission.py": AI_FUNCTIONS,
+    "circuit_breaker.py": AI_FUNCTIONS,
+    "model_router.py": AI_FUNCTIONS,
+    "fallback.py": AI_FUNCTIONS,
+    "constants.py": AI_FUNCTIONS,
+}
+
+# Modules with the same name that are meant to differ, with their owner
+DISTINCT_MODULES = {
+    "constants.py": ("result_save_send",),
+    "model_response.py": AI_FUNCTIONS,
+    "requirements.txt": ALL_FUNCTIONS,
+}
+
+
+def read(directory, name):
+    with open(os.path.join(LAMBDA_DIR, directory, name), "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("name", sorted(SHARED_MODULES))
+def test_copies_are_identical(name):
+    directories = SHARED_MODULES[name]
+    reference = read(directories[0], name)
+    differing = [directory for directory in directories[1:]
+                 if read(directory, name) != reference]
+    assert not differing, (
+        f"lambda/{directories[0]}/{name} differs from the copies in {differing}")
+
+
+def test_every_copied_module_is_listed():
+    owners = defaultdict(set)
+    for directory in sorted(os.listdir(LAMBDA_DIR)):
+        path = os.path.join(LAMBDA_DIR, directory)
+        if not os.path.isdir(path):
+            continue
+        for name in os.listdir(path):
+            if name.endswith((".py", ".txt")):
+                owners[name].add(directory)
+
+    for name, directories in owners.items():
+        listed = set(SHARED_MODULES.get(name, ())) | set(DISTINCT_MODULES.get(name, ()))
+        if len(directories) > 1:
+            assert directories <= listed, f"{name} is copied into {sorted(directories)}"
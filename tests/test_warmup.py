@@ -0,0 +1,73 @@
+"""
+Tests of the warm-up invocations in lambda/result_save_send/warmup.py and
+the warm-up steps of result_save_send.
+
+DynamoDB and the API Gateway Management client are replaced by the
+in-memory fakes of aws_fakes.py, so no AWS call is made.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "result_save_send"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("WEBSOCKET_URL", "wss://example.execute-api.us-east-1.amazonaws.com/dev")
+os.environ.setdefault("PRECONNECT_WEBSOCKET", "false")
+
+import result_save_send  # noqa: E402
+from aws_fakes import install_result_save_send  # noqa: E402
+from warmup import WARMUP_ID, is_warmup, warm_up  # noqa: E402
+
+
+def test_only_the_warmup_flag_is_a_warmup():
+    assert is_warmup({"warmup": True})
+    assert not is_warmup({"warmup": "true"})
+    assert not is_warmup({"body": '{"warmup": true}'})
+    assert not is_warmup(None)
+
+
+def test_warm_up_times_every_step_and_ignores_errors():
+    calls = []
+
+    def failing():
+        calls.append("failing")
+        raise RuntimeError("placeholder item not found")
+
+    response = warm_up("f", [("failing", failing), ("ok", lambda: calls.append("ok"))])
+
+    assert response["statusCode"] == 200
+    body = json.loads(response["body"])
+    assert body["warmup"] is True
+    assert set(body["timings"]) == {"failing", "ok"}
+    assert calls == ["failing", "ok"]
+
+
+def test_result_save_send_warm_up_primes_its_caches(monkeypatch):
+    dynamodb, apigateway = install_result_save_send(result_save_send, monkeypatch)
+    monkeypatch.setattr(result_save_send, "WARMUP_DEVICE_TYPES", ["light"])
+
+    response = result_save_send.lambda_handler({"warmup": True}, None)
+
+    timings = json.loads(response["body"])["timings"]
+    assert set(timings) == {"ir_codes:light", "connections", "device_states", "websocket"}
+    assert "light" in result_save_send.code_tables
+    assert apigateway.lookups == ["preconnect"]
+    assert ("get_item", {"deviceId": WARMUP_ID}) in dynamodb.Table("DeviceStateTable").calls
+    # Nothing is claimed or sent
+    assert dynamodb.Table("ProcessedRequestTable").items == {}
+    assert apigateway.posts == []
+
+
+@pytest.mark.parametrize("bucket", [None, "archive-bucket"])
+def test_s3_is_only_warmed_with_a_bucket(monkeypatch, bucket):
+    if bucket:
+        monkeypatch.setenv("BUCKET_NAME", bucket)
+    else:
+        monkeypatch.delenv("BUCKET_NAME", raising=False)
+
+    names = [name for name, _ in result_save_send.warmup_steps()]
+
+    assert ("s3" in names) == bool(bucket)
@@ -0,0 +1,451 @@
+"""
+Offline timing simulator for hardware.ino.
+
+Replays a device message through a model of the firmware's command handling
+(processJsonMessage, executePlan, adjustRGB, sendIRCode, sendUpDownSequence)
+and reports how long the device takes to reach the target, without an
+ESP8266. Only blocking time is modelled:
+
+- irsend.sendNEC pads every frame to 108 ms
+- sendIRCode(code, true) waits another 50 ms
+- sendUpDownSequence waits irGap (70 ms) after every pulse, plus 70 ms after
+  every 10th pulse of a run longer than 10
+- adjustRGB enters DIY mode with two codes and 150/200 ms waits, and waits
+  100 ms between channels
+- switching on waits 150 ms before the next command
+- echoing a JSON message to the 115200 baud serial port blocks once the
+  UART FIFO is full
+
+JSON parsing and WiFi latency are not modelled.
+
+Usage:
+    python tools/ir_timing_sim.py message.json [--rgb 0,0,0] [--off] [--dynamic]
+        [--steps 255,255,255] [--no-plan]
+    python tools/ir_timing_sim.py --benchmark
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "lambda", "result_save_send"))
+
+from frame_codec import FRAME_MAGIC, decode_frame  # noqa: E402
+from ir_planner import plan_transition  # noqa: E402
+
+# Timing constants from hardware.ino (milliseconds)
+NEC_FRAME_MS = 108
+SEND_DELAY_MS = 50
+POWER_ON_SETTLE_MS = 150
+DIY_FIRST_WAIT_MS = 150
+DIY_SECOND_WAIT_MS = 200
+CHANNEL_GAP_MS = 100
+BATCH_PAUSE_MS = 70
+BATCH_SIZE = 10
+DEFAULT_IR_GAP_MS = 70
+
+# Serial echo of received JSON (raw payload plus re-serialized document)
+SERIAL_BYTES_PER_MS = 115200 / 10 / 1000
+UART_FIFO_BYTES = 128
+
+# irCommands in hardware.ino with their built-in codes
+DEFAULT_CODES = {
+    "enterDiy": 0xFF30CF, "power": 0xFF02FD,
+    "rup": 0xFF28D7, "rdown": 0xFF08F7, "gup": 0xFFA857, "gdown": 0xFF8877,
+    "bup": 0xFF6897, "bdown": 0xFF48B7,
+    "auto": 0xFFC837, "slow": 0xFFC837, "quick": 0xFFF00F, "flash": 0xFFD02F,
+    "fade7": 0xFFE01F, "fade3": 0xFF609F, "jump7": 0xFFA05F, "jump3": 0xFF20DF,
+    "music1": 0xFF12ED, "music2": 0xFF32CD, "music3": 0xFFF807, "music4": 0xFFD827,
+}
+
+# Trailing legacy single-code commands, in processJsonMessage order
+LEGACY_MODE_KEYS = [
+    "music1", "music2", "music3", "music4", "auto", "flash",
+    "fade7", "fade3", "jump7", "jump3", "quick", "slow"
+]
+
+
+def parse_ir_code(value):
+    """Parse a hex IR code string like parseIrCode in hardware.ino."""
+    if not value:
+        return 0
+    try:
+        return int(value, 16) & 0xFFFFFFFF
+    except ValueError:
+        return 0
+
+
+class DeviceSimulator:
+    """
+    Model of the firmware state and its blocking delays.
+
+    Args:
+        power: Initial power state
+        rgb: Initial [r, g, b]
+        dynamic: Whether a dynamic mode is running
+        steps: Pulses for a full 0-255 sweep per channel
+        supports_plan: False to model firmware that ignores "plan"
+    """
+
+    def __init__(self, power=False, rgb=None, dynamic=False, steps=None,
+                 supports_plan=True):
+        self.power_on = power
+        self.rgb = list(rgb or [0, 0, 0])
+        self.dynamic_active = dynamic
+        self.channel_steps = list(steps or [255, 255, 255])
+        self.ir_gap = DEFAULT_IR_GAP_MS
+        self.codes = dict(DEFAULT_CODES)
+        self.code_version = 0
+        self.supports_plan = supports_plan
+        self.clock_ms = 0
+        self.ir_frames = 0
+        self.events = []
+
+    # ---- primitives ----
+
+    def delay(self, ms):
+        self.clock_ms += ms
+
+    def log(self, label):
+        self.events.append((self.clock_ms, label))
+
+    def send_ir_code(self, code, with_delay=False):
+        if code == 0:
+            self.log("IR code 0 rejected")
+            return False
+        self.delay(NEC_FRAME_MS)
+        self.ir_frames += 1
+        if with_delay:
+            self.delay(SEND_DELAY_MS)
+        return True
+
+    def send_up_down_sequence(self, code, count):
+        if code == 0:
+            return
+        for i in range(count):
+            self.send_ir_code(code, False)
+            self.delay(self.ir_gap)
+            if count > BATCH_SIZE and i % BATCH_SIZE == BATCH_SIZE - 1:
+                self.delay(BATCH_PAUSE_MS)
+
+    # ---- firmware functions ----
+
+    def adjust_rgb(self, target, enter_diy=True):
+        if list(target) == self.rgb and not self.dynamic_active:
+            return
+        diffs = [t - c for t, c in zip(target, self.rgb)]
+        if any(self.codes[key] == 0 for key in
+               ("enterDiy", "rup", "rdown", "gup", "gdown", "bup", "bdown")):
+            self.log("adjust skipped: invalid IR code")
+            return
+
+        if enter_diy:
+            self.send_ir_code(self.codes["enterDiy"], True)
+            self.delay(DIY_FIRST_WAIT_MS)
+            self.send_ir_code(self.codes["enterDiy"], True)
+            self.delay(DIY_SECOND_WAIT_MS)
+            self.log("DIY mode")
+        self.dynamic_active = False
+
+        # Stable bubble sort by absolute difference, largest first
+        channels = [(abs(diffs[idx]), idx) for idx in range(3)]
+        for i in range(2):
+            for j in range(2 - i):
+                if channels[j][0] < channels[j + 1][0]:
+                    channels[j], channels[j + 1] = channels[j + 1], channels[j]
+
+        names = (("rup", "rdown"), ("gup", "gdown"), ("bup", "bdown"))
+        for i, (_, idx) in enumerate(channels):
+            diff = diffs[idx]
+            if diff == 0:
+                continue
+            code = self.codes[names[idx][0] if diff > 0 else names[idx][1]]
+            count = (abs(diff) * self.channel_steps[idx] + 127) // 255
+            if i > 0:
+                self.delay(CHANNEL_GAP_MS)
+            self.send_up_down_sequence(code, count)
+            self.rgb[idx] = target[idx]
+            self.log(f"channel {'rgb'[idx]} -> {target[idx]} ({count} pulses)")
+
+    def start_dynamic_mode(self, code):
+        if not self.power_on:
+            self.send_ir_code(self.codes["power"], True)
+            self.power_on = True
+            self.delay(POWER_ON_SETTLE_MS)
+        if self.send_ir_code(code, True):
+            self.dynamic_active = True
+        self.log("dynamic mode")
+
+    def apply_plan_power(self, on):
+        if on != self.power_on:
+            self.send_ir_code(self.codes["power"], True)
+            self.power_on = on
+            if on:
+                self.delay(POWER_ON_SETTLE_MS)
+            self.log(f"power {'on' if on else 'off'}")
+
+    def apply_plan_preset(self, code, rgb):
+        if not self.send_ir_code(code, True):
+            return False
+        self.rgb = [min(max(int(v), 0), 255) for v in rgb]
+        self.dynamic_active = False
+        self.log(f"preset -> {self.rgb}")
+        return True
+
+    def execute_plan(self, plan):
+        preset_active = False
+        for step in plan:
+            if step[0] == "power":
+                self.apply_plan_power(bool(step[1]))
+            elif step[0] == "preset":
+                if self.apply_plan_preset(parse_ir_code(step[1]), step[2:5]):
+                    preset_active = True
+            elif step[0] == "adjust":
+                self.adjust_rgb([min(max(int(v), 0), 255) for v in step[1:4]],
+                                not preset_active)
+
+    def update_ir_codes(self, codes):
+        for key in DEFAULT_CODES:
+            value = codes.get(key)
+            if isinstance(value, str) and value:
+                self.codes[key] = parse_ir_code(value)
+
+    def process_json_message(self, doc):
+        if "codes" in doc:
+            self.update_ir_codes(doc["codes"] or {})
+            if "codeVersion" in doc:
+                self.code_version = int(doc["codeVersion"])
+
+        if "mode" in doc:
+            for key in DEFAULT_CODES:
+                if doc["mode"] and key.lower() == str(doc["mode"]).lower():
+                    self.start_dynamic_mode(self.codes[key])
+                    break
+            return
+
+        if doc.get("dynamicIr"):
+            self.start_dynamic_mode(parse_ir_code(doc["dynamicIr"]))
+            return
+
+        self.update_ir_codes(doc)
+
+        if isinstance(doc.get("steps"), list) and len(doc["steps"]) == 3:
+            self.channel_steps = [min(max(int(v), 1), 255) for v in doc["steps"]]
+        if "irGap" in doc:
+            self.ir_gap = min(max(int(doc["irGap"]), 20), 500)
+
+        if "plan" in doc and self.supports_plan:
+            self.execute_plan(doc["plan"])
+            return
+
+        rgb_code = doc.get("rgbCode")
+        rgb_valid = isinstance(rgb_code, list) and len(rgb_code) == 3
+        target = [min(max(int(v), 0), 255) for v in rgb_code] if rgb_valid else None
+
+        if "powerOn" in doc:
+            new_power = bool(doc["powerOn"])
+            if new_power != self.power_on:
+                self.send_ir_code(self.codes["power"], True)
+                self.power_on = new_power
+                if self.power_on and "rgbCode" in doc:
+                    self.delay(POWER_ON_SETTLE_MS)
+                    if target and target != self.rgb:
+                        self.adjust_rgb(target)
+                    return
+
+        if self.power_on and "rgbCode" in doc:
+            if target and target != self.rgb:
+                self.adjust_rgb(target)
+            return
+        for key in LEGACY_MODE_KEYS:
+            if key in doc:
+                self.send_ir_code(self.codes[key], True)
+                return
+
+    def receive(self, message):
+        """
+        Deliver a message as the WebSocket handler would.
+
+        Args:
+            message: Message dict, JSON string or binary frame bytes
+
+        Returns:
+            Elapsed milliseconds for this message
+        """
+        start = self.clock_ms
+        if isinstance(message, (bytes, bytearray)) and message[:1] == bytes([FRAME_MAGIC]):
+            # Binary frames are applied record by record in the same order as
+            # the JSON path; there is no serial echo
+            self.process_json_message(decode_frame(bytes(message)))
+        else:
+            text = message if isinstance(message, str) else (
+                message.decode("utf-8") if isinstance(message, (bytes, bytearray))
+                else json.dumps(message))
+            doc = json.loads(text)
+            compact = json.dumps(doc, separators=(",", ":"))
+            echoed = len(text) + len(compact)
+            self.delay(max(echoed - UART_FIFO_BYTES, 0) / SERIAL_BYTES_PER_MS)
+            self.process_json_message(doc)
+        return self.clock_ms - start
+
+    def state(self):
+        return {"power": self.power_on, "rgb": list(self.rgb),
+                "dynamic": self.dynamic_active}
+
+
+def simulate(message, **device):
+    """
+    Simulate one message on a fresh device.
+
+    Args:
+        message: Message dict, JSON string or binary frame bytes
+        **device: DeviceSimulator arguments for the initial state
+
+    Returns:
+        {"ms", "irFrames", "state", "events"}
+    """
+    sim = DeviceSimulator(**device)
+    elapsed = sim.receive(message)
+    return {
+        "ms": round(elapsed, 1),
+        "irFrames": sim.ir_frames,
+        "state": sim.state(),
+        "events": [(round(t, 1), label) for t, label in sim.events],
+    }
+
+
+def reached_target(state, target):
+    """
+    Check whether a device state shows the target color.
+
+    Args:
+        state: Final state from simulate()
+        target: Target [r, g, b]; black is reached by switching off too
+
+    Returns:
+        True if the device shows the target
+    """
+    if not any(target) and not state["power"]:
+        return True
+    return state["power"] and not state["dynamic"] and state["rgb"] == list(target)
+
+
+def legacy_message(target):
+    """
+    Build a message the way result_save_send did before planning.
+
+    The old message carried the target in rgbCode and the IR codes inline,
+    but no powerOn, steps, irGap or plan.
+
+    Args:
+        target: Target [r, g, b]
+
+    Returns:
+        Message dict
+    """
+    message = {"rgbCode": list(target), "dynamicIr": ""}
+    for key in ("enterDiy", "power", "rup", "rdown", "gup", "gdown", "bup", "bdown"):
+        message[key] = f"{DEFAULT_CODES[key]:X}"
+    return message
+
+
+def benchmark():
+    """
+    Time planned and legacy (rgbCode walk) messages over fixed scenarios.
+
+    Planner and simulator start from the same device state, so the
+    estimate column checks the planner's cost model against the simulator.
+
+    Returns:
+        List of {"scenario", "plannedMs", "estimateMs", "legacyMs",
+        "plannedReached", "legacyReached"}; a time is None when its run
+        does not reach the target
+    """
+    off = {"power": False, "rgb": [0, 0, 0], "dynamic": False}
+    scenarios = [
+        ("off -> warm white", off, [255, 180, 100], [255, 255, 255]),
+        ("off -> warm white, 16 steps", off, [255, 176, 96], [16, 16, 16]),
+        ("red -> blue", {"power": True, "rgb": [255, 0, 0], "dynamic": False},
+         [0, 0, 255], [255, 255, 255]),
+        ("small change", {"power": True, "rgb": [120, 80, 40], "dynamic": False},
+         [128, 80, 32], [255, 255, 255]),
+        ("dynamic -> same color", {"power": True, "rgb": [0, 255, 0], "dynamic": True},
+         [0, 255, 0], [255, 255, 255]),
+        ("on -> black", {"power": True, "rgb": [200, 200, 200], "dynamic": False},
+         [0, 0, 0], [255, 255, 255]),
+    ]
+    results = []
+    for name, current, target, steps in scenarios:
+        plan, estimate = plan_transition(
+            current, {"power": True, "rgb": target}, steps=steps)
+        message = {"rgbCode": target, "steps": steps, "irGap": DEFAULT_IR_GAP_MS,
+                   "plan": plan}
+        device = {"power": current["power"], "rgb": current["rgb"],
+                  "dynamic": current["dynamic"], "steps": [255, 255, 255]}
+        planned = simulate(message, **device)
+        legacy = simulate(legacy_message(target), supports_plan=False, **device)
+        planned_reached = reached_target(planned["state"], target)
+        legacy_reached = reached_target(legacy["state"], target)
+        results.append({
+            "scenario": name,
+            "plannedMs": planned["ms"] if planned_reached else None,
+            "estimateMs": estimate,
+            "legacyMs": legacy["ms"] if legacy_reached else None,
+            "plannedReached": planned_reached,
+            "legacyReached": legacy_reached,
+        })
+    return results
+
+
+def _parse_rgb(value):
+    parts = [int(part) for part in value.split(",")]
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError("expected r,g,b")
+    return parts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("message", nargs="?",
+                        help="JSON message file or binary frame (default: stdin)")
+    parser.add_argument("--rgb", type=_parse_rgb, default=[0, 0, 0],
+                        help="initial color r,g,b")
+    parser.add_argument("--off", action="store_true", help="device starts off")
+    parser.add_argument("--dynamic", action="store_true",
+                        help="a dynamic mode is running")
+    parser.add_argument("--steps", type=_parse_rgb, default=[255, 255, 255],
+                        help="initial pulses per full sweep r,g,b")
+    parser.add_argument("--no-plan", action="store_true",
+                        help="model firmware without plan support")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="run the fixed planning scenarios")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        # Runs that never reach the target have no time to report
+        print(f"{'scenario':<30}{'planned ms':>12}{'estimate ms':>13}{'legacy ms':>11}")
+        for row in benchmark():
+            planned = row["plannedMs"] if row["plannedReached"] else "missed"
+            legacy = row["legacyMs"] if row["legacyReached"] else "missed"
+            print(f"{row['scenario']:<30}{planned:>12}"
+                  f"{row['estimateMs']:>13}{legacy:>11}")
+        return
+
+    if args.message:
+        with open(args.message, "rb") as f:
+            message = f.read()
+    else:
+        message = sys.stdin.buffer.read()
+
+    result = simulate(message, power=not args.off, rgb=args.rgb,
+                      dynamic=args.dynamic, steps=args.steps,
+                      supports_plan=not args.no_plan)
+    for t, label in result["events"]:
+        print(f"{t:>10.1f} ms  {label}")
+    print(f"Reached {result['state']} in {result['ms']} ms "
+          f"({result['irFrames']} IR frames)")
+
+
+if __name__ == "__main__":
+    main()
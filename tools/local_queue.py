@@ -0,0 +1,97 @@
+"""
+In-memory stand-in for the result queue.
+
+Lets the queue hop between the AI lambdas and result_save_send run locally
+without SQS. InMemoryQueue accepts send_message calls like the boto3 SQS
+client, so it can replace sqs_client in audio_to_ai / pattern_to_ai, and
+drain() feeds the messages to a handler as SQS events, re-queueing the
+messages the handler reports in batchItemFailures.
+
+Example:
+    queue = InMemoryQueue()
+    audio_to_ai.RESULT_QUEUE_URL = queue.url
+    audio_to_ai.sqs_client = queue
+    ...
+    queue.drain(result_save_send.lambda_handler, batch_size=10)
+"""
+import itertools
+from collections import deque
+
+
+class InMemoryQueue:
+    """
+    FIFO queue with the subset of the SQS API used by the AI lambdas.
+
+    Args:
+        url: Queue URL reported in send_message responses
+        max_receives: Deliveries after which a failing message is dropped,
+            like a redrive policy to a dead-letter queue
+    """
+
+    def __init__(self, url="local://result-queue", max_receives=3):
+        self.url = url
+        self.max_receives = max_receives
+        self.messages = deque()
+        self.dead_letters = []
+        self._ids = itertools.count(1)
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        """Queue a message (boto3 SQS client signature)."""
+        message_id = f"local-{next(self._ids)}"
+        self.messages.append({"messageId": message_id, "body": MessageBody,
+                              "receiveCount": 0})
+        return {"MessageId": message_id}
+
+    def receive_event(self, batch_size=10):
+        """
+        Take up to batch_size messages as a Lambda SQS event.
+
+        Args:
+            batch_size: Maximum records in the event
+
+        Returns:
+            {"Records": [...]} with the in-flight messages
+        """
+        records = []
+        while self.messages and len(records) < batch_size:
+            message = self.messages.popleft()
+            message["receiveCount"] += 1
+            records.append({
+                "messageId": message["messageId"],
+                "body": message["body"],
+                "eventSource": "aws:sqs",
+                "eventSourceARN": self.url,
+                "attributes": {"ApproximateReceiveCount": str(message["receiveCount"])},
+                "_message": message,
+            })
+        return {"Records": records}
+
+    def drain(self, handler, batch_size=10, context=None):
+        """
+        Feed all queued messages to a handler in batches.
+
+        Args:
+            handler: Lambda handler taking (event, context)
+            batch_size: Maximum records per invocation
+            context: Lambda context passed to the handler
+
+        Returns:
+            Number of handler invocations
+        """
+        invocations = 0
+        while self.messages:
+            event = self.receive_event(batch_size)
+            response = handler(event, context) or {}
+            invocations += 1
+
+            failed = {failure["itemIdentifier"]
+                      for failure in response.get("batchItemFailures", [])}
+            for record in event["Records"]:
+                if record["messageId"] not in failed:
+                    continue
+                message = record["_message"]
+                if message["receiveCount"] >= self.max_receives:
+                    self.dead_letters.append(message)
+                else:
+                    self.messages.append(message)
+        return invocations
@@ -0,0 +1,106 @@
+"""
+Overhead benchmark for the stage metrics in lambda/*/metrics.py.
+
+Times what instrumentation adds to an invocation, without AWS:
+
+- an empty block, bare and inside metrics.stage() (enabled and disabled)
+- metrics.put() of a value
+- flush() of a typical record (ten stages, three model attempts, a count
+  and two properties), written to an in-memory stream instead of stdout
+
+Usage:
+    python tools/metrics_overhead.py [--iterations 200000]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "lambda", "result_save_send"))
+
+from metrics import StageMetrics  # noqa: E402
+
+STAGES = ("auth", "base64_decode", "history_query", "prompt_build", "validation",
+          "handoff", "get_connections", "configure_light_settings",
+          "upload_response_dynamo", "send_data_to_arduino")
+
+
+def per_call_ns(func, iterations):
+    """Average wall time of func() in nanoseconds."""
+    started = time.perf_counter_ns()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter_ns() - started) / iterations
+
+
+def fill(metrics):
+    """Record what a typical invocation records."""
+    for name in STAGES:
+        metrics.put(name, 12.5)
+    for _ in range(3):
+        metrics.put("model", 850.0)
+    metrics.count("retries", 2)
+    metrics.set_property("requestId", "X7dGm2kQp9")
+    metrics.set_property("statusCode", 200)
+
+
+def benchmark(iterations):
+    """
+    Time the instrumentation primitives.
+
+    Args:
+        iterations: Calls per measurement
+
+    Returns:
+        List of (case, ns per call)
+    """
+    enabled = StageMetrics("benchmark", model="gemini-2.0-flash", enabled=True)
+    disabled = StageMetrics("benchmark", enabled=False)
+
+    def bare():
+        pass
+
+    def staged(metrics):
+        def run():
+            with metrics.stage("stage"):
+                pass
+        return run
+
+    def put():
+        enabled.put("value", 1.0)
+
+    def flush():
+        fill(enabled)
+        enabled.flush()
+
+    results = [
+        ("empty block", per_call_ns(bare, iterations)),
+        ("stage(), enabled", per_call_ns(staged(enabled), iterations)),
+        ("stage(), disabled", per_call_ns(staged(disabled), iterations)),
+        ("put()", per_call_ns(put, iterations)),
+    ]
+    with redirect_stdout(io.StringIO()):
+        # Drop the values put() collected so every flush() sees one record
+        enabled.flush()
+        results.append(("fill + flush() of a record",
+                        per_call_ns(flush, max(iterations // 100, 1))))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=200000,
+                        help="calls per measurement")
+    args = parser.parse_args()
+
+    results = benchmark(args.iterations)
+    print(f"{'case':<30}{'us per call':>12}")
+    for case, ns in results:
+        print(f"{case:<30}{ns / 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
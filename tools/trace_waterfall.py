@@ -0,0 +1,140 @@
+"""
+Waterfall of one request, rebuilt from the functions' metric records.
+
+Every function prints one embedded-metric-format record per invocation
+(lambda/*/metrics.py) with its spans and the trace id of the request
+(traceId, or traceIds for a result_save_send queue batch). This tool reads
+log lines, keeps the records of one trace and prints their spans on a
+common time axis, from the API Gateway arrival to the device's state
+report:
+
+    offset ms   duration  function          span
+          0.0      182.0  audio_to_ai       api_gateway       ###
+        182.4       41.3  audio_to_ai       auth               #
+        ...
+
+Log lines may carry any prefix (CloudWatch export, `aws logs tail`); the
+first JSON object of a line is parsed. Spans of different functions are
+aligned by their epoch timestamps, so clock skew between containers
+shows up as small overlaps or gaps.
+
+Usage:
+    aws logs tail /aws/lambda/audio-to-ai --since 1h > logs.txt
+    aws logs tail /aws/lambda/result-save-send --since 1h >> logs.txt
+    aws logs tail /aws/lambda/ws-messenger --since 1h >> logs.txt
+    python tools/trace_waterfall.py TRACE_ID logs.txt [--width 50]
+"""
+import argparse
+import json
+import sys
+
+_decoder = json.JSONDecoder()
+
+
+def parse_record(line):
+    """
+    Parse the first JSON object of a log line.
+
+    Args:
+        line: Log line
+
+    Returns:
+        Dict, or None if the line holds no JSON object
+    """
+    start = line.find("{")
+    while start != -1:
+        try:
+            value, _ = _decoder.raw_decode(line, start)
+            if isinstance(value, dict):
+                return value
+        except json.JSONDecodeError:
+            pass
+        start = line.find("{", start + 1)
+    return None
+
+
+def belongs_to(record, trace_id):
+    """True if a metric record belongs to the trace."""
+    return record.get("traceId") == trace_id or trace_id in (record.get("traceIds") or [])
+
+
+def collect_spans(lines, trace_id):
+    """
+    Collect the spans of a trace from log lines.
+
+    Args:
+        lines: Iterable of log lines
+        trace_id: Trace id to look for
+
+    Returns:
+        List of (start epoch ms, duration ms, function, span name), sorted
+        by start
+    """
+    spans = []
+    for line in lines:
+        if trace_id not in line:
+            continue
+        record = parse_record(line)
+        if not record or not belongs_to(record, trace_id):
+            continue
+        function = record.get("Function", "?")
+        for name, start, duration in record.get("spans", []):
+            spans.append((start, duration, function, name))
+    spans.sort(key=lambda span: (span[0], -span[1]))
+    return spans
+
+
+def render_waterfall(spans, width=50):
+    """
+    Render spans as text rows with bars on a common time axis.
+
+    Args:
+        spans: Spans from collect_spans
+        width: Width of the bar column in characters
+
+    Returns:
+        List of lines
+    """
+    if not spans:
+        return []
+    origin = spans[0][0]
+    end = max(start + duration for start, duration, _, _ in spans)
+    total = max(end - origin, 1)
+
+    lines = [f"{'offset ms':>10}{'duration':>10}  {'function':<18}{'span':<26}"]
+    for start, duration, function, name in spans:
+        offset = start - origin
+        column = int(offset / total * width)
+        length = max(int(round(duration / total * width)), 1)
+        bar = " " * column + "#" * min(length, width - column)
+        lines.append(f"{offset:>10.1f}{duration:>10.1f}  {function:<18}{name:<26}{bar}")
+    lines.append(f"Total {total:.1f} ms over {len(spans)} spans")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("trace_id", help="trace id (X-Trace-Id or the request_id)")
+    parser.add_argument("logs", nargs="*", help="log files (default: stdin)")
+    parser.add_argument("--width", type=int, default=50,
+                        help="width of the bar column")
+    args = parser.parse_args()
+
+    spans = []
+    if args.logs:
+        for path in args.logs:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                spans.extend(collect_spans(f, args.trace_id))
+        spans.sort(key=lambda span: (span[0], -span[1]))
+    else:
+        spans = collect_spans(sys.stdin, args.trace_id)
+
+    if not spans:
+        print(f"No spans found for trace {args.trace_id}", file=sys.stderr)
+        sys.exit(1)
+    for line in render_waterfall(spans, args.width):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
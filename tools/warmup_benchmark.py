@@ -0,0 +1,163 @@
+"""
+Benchmark of the warm-up event against a deployed function.
+
+Compares the first request of a new container with and without a warm-up
+before it, and with the steady state:
+
+- cold: new container, the request is its first invocation
+- warmed: new container, {"warmup": true} first, then the request
+- steady: the request again in the warmed container
+
+A new container is forced by changing the WARMUP_BENCHMARK_RUN environment
+variable of the function, which makes Lambda replace its containers; the
+variable is removed again at the end. Durations are the handler durations
+from the REPORT line of each invocation's log tail, so client network time
+is left out and the init phase (Init Duration) is listed on its own.
+
+The request runs for real: use an event whose side effects are acceptable,
+e.g. a test user's uuid and pin.
+
+Usage:
+    python tools/warmup_benchmark.py audio-to-ai request.json [--rounds 5]
+"""
+import argparse
+import base64
+import json
+import re
+import statistics
+import sys
+import time
+
+from boto3.session import Session
+
+MARKER_VARIABLE = "WARMUP_BENCHMARK_RUN"
+WARMUP_EVENT = {"warmup": True}
+
+_REPORT_FIELDS = {
+    "duration": re.compile(r"\tDuration: ([\d.]+) ms"),
+    "init": re.compile(r"\tInit Duration: ([\d.]+) ms"),
+}
+
+
+def parse_report(log_tail):
+    """
+    Read the durations of the REPORT line of an invocation log.
+
+    Args:
+        log_tail: Decoded LogResult of an invoke with LogType=Tail
+
+    Returns:
+        {"duration": ms, "init": ms or None}
+    """
+    report = next((line for line in log_tail.splitlines()
+                   if line.startswith("REPORT")), "")
+    result = {}
+    for name, pattern in _REPORT_FIELDS.items():
+        match = pattern.search(report)
+        result[name] = float(match.group(1)) if match else None
+    return result
+
+
+def set_marker(lambda_client, function_name, value):
+    """
+    Set or remove the marker variable and wait for the update to finish.
+
+    Args:
+        lambda_client: boto3 Lambda client
+        function_name: Function name
+        value: Marker value, or None to remove it
+
+    Returns:
+        None
+    """
+    config = lambda_client.get_function_configuration(FunctionName=function_name)
+    variables = dict(config.get("Environment", {}).get("Variables", {}))
+    if value is None:
+        if MARKER_VARIABLE not in variables:
+            return
+        variables.pop(MARKER_VARIABLE)
+    else:
+        variables[MARKER_VARIABLE] = value
+    lambda_client.update_function_configuration(
+        FunctionName=function_name, Environment={"Variables": variables})
+    lambda_client.get_waiter("function_updated").wait(FunctionName=function_name)
+
+
+def invoke(lambda_client, function_name, event):
+    """
+    Invoke a function synchronously and read its durations.
+
+    Args:
+        lambda_client: boto3 Lambda client
+        function_name: Function name
+        event: Event to send
+
+    Returns:
+        {"duration": ms, "init": ms or None}
+
+    Raises:
+        RuntimeError: If the function failed
+    """
+    response = lambda_client.invoke(
+        FunctionName=function_name, Payload=json.dumps(event).encode("utf-8"),
+        LogType="Tail")
+    if response.get("FunctionError"):
+        raise RuntimeError(f"{function_name} failed: {response['Payload'].read()!r}")
+    return parse_report(base64.b64decode(response["LogResult"]).decode("utf-8", "replace"))
+
+
+def benchmark(lambda_client, function_name, event, rounds):
+    """
+    Run the cold, warmed and steady cases.
+
+    Args:
+        lambda_client: boto3 Lambda client
+        function_name: Function name
+        event: Event of a real request
+        rounds: Rounds per case
+
+    Returns:
+        {case: list of durations}, with the init and warm-up durations too
+    """
+    results = {"cold": [], "cold init": [], "warm-up": [], "warmed": [], "steady": []}
+    try:
+        for round_number in range(rounds):
+            set_marker(lambda_client, function_name, f"cold-{time.time_ns()}")
+            cold = invoke(lambda_client, function_name, event)
+            results["cold"].append(cold["duration"])
+            if cold["init"] is not None:
+                results["cold init"].append(cold["init"])
+
+            set_marker(lambda_client, function_name, f"warm-{time.time_ns()}")
+            results["warm-up"].append(
+                invoke(lambda_client, function_name, WARMUP_EVENT)["duration"])
+            results["warmed"].append(invoke(lambda_client, function_name, event)["duration"])
+            results["steady"].append(invoke(lambda_client, function_name, event)["duration"])
+            print(f"round {round_number + 1}/{rounds} done", file=sys.stderr)
+    finally:
+        set_marker(lambda_client, function_name, None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("function_name", help="deployed function name")
+    parser.add_argument("event", help="JSON file with the event of a real request")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds per case")
+    parser.add_argument("--region", default="us-east-1", help="AWS region")
+    args = parser.parse_args()
+
+    with open(args.event, encoding="utf-8") as f:
+        event = json.load(f)
+    lambda_client = Session(region_name=args.region).client("lambda")
+    results = benchmark(lambda_client, args.function_name, event, args.rounds)
+
+    print(f"{'case':<12}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for case, durations in results.items():
+        if durations:
+            print(f"{case:<12}{statistics.median(durations):>12.1f}"
+                  f"{min(durations):>10.1f}{max(durations):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,4 +7,10 @@ variable "GOOGLE_GEMINI_API_KEY" {
 variable "REGION_NAME" {
   type        = string
   description = "AWS region where resources are deployed"
-}
\ No newline at end of file
+}
+
+variable "ENABLE_RESULT_QUEUE" {
+  type        = bool
+  description = "Route AI results to result-save-send through an SQS queue"
+  default     = false
+}